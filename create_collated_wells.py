@@ -3,14 +3,14 @@ import argparse
 from pathlib import Path
 from functools import partial
 
-import orjson
 import pandas as pd
 from tqdm.auto import tqdm
-from tqdm.contrib.concurrent import process_map
 
-from loader import load_plate
+from loader import is_metadata, load_plate, profile_size
 from id_mapping import JCP_MAPPER
 from nan_filling import fillna
+from jump.executor import map_frames
+from jump.io import load_structure
 from jump.utils import CONFIG
 
 
@@ -55,7 +55,8 @@ def assert_jcp_completed(plate: pd.DataFrame):
 
 def process_plate(plate_props, source_id, cpg_id):
     """Load profile, fill NaN values and find JCPIDs"""
-    plate = load_plate(plate_props, "default")
+    # Features are not needed to find the JCPIDs
+    plate = load_plate(plate_props, "default", columns=is_metadata)
     fillna(plate, plate_props, source_id)
     try:
         assert_jcp_completed(plate)
@@ -74,26 +75,30 @@ def map_all_datasets(dataset_paths, output_path):
     """Main loop to process all dataset"""
     errors = []
     metadata = []
+    # Plates of every batch of every dataset are processed at once
+    plates, source_ids, barcodes = [], [], []
     for jsonfile in tqdm(dataset_paths, desc="datasets"):
-        with open(jsonfile, "rb") as fread:
-            dataset = orjson.loads(fread.read())
-        cpg_id = CONFIG["cpg_id"]
-        dataset_id = dataset["dataset_id"]
-        for batch in tqdm(dataset["batches"], leave=False, desc=dataset_id):
-            par_func = partial(process_plate, source_id=dataset_id, cpg_id=cpg_id)
-            for plate in process_map(par_func, batch["plates"], leave=False):
-                if isinstance(plate, pd.DataFrame):
-                    metadata.append(plate)
-                else:
-                    plate_props, msg = plate
-                    errors.append(
-                        {
-                            "platemap": plate_props["platemap"]["path"],
-                            "barcode": batch["barcode_platemap"]["path"],
-                            "profile": plate_props["profiles"]["default"]["path"],
-                            "message": msg,
-                        }
-                    )
+        dataset = load_structure(jsonfile, lazy=True)
+        for batch in dataset["batches"]:
+            plates.extend(batch["plates"])
+            source_ids.extend([dataset["dataset_id"]] * len(batch["plates"]))
+            barcodes.extend([batch["barcode_platemap"]["path"]] * len(batch["plates"]))
+    par_func = partial(process_plate, cpg_id=CONFIG["cpg_id"])
+    sizes = [profile_size(plate) for plate in plates]
+    output = map_frames(par_func, plates, source_ids, sizes=sizes, desc="plates")
+    for plate, barcode in zip(output, barcodes):
+        if isinstance(plate, pd.DataFrame):
+            metadata.append(plate)
+        else:
+            plate_props, msg = plate
+            errors.append(
+                {
+                    "platemap": plate_props["platemap"]["path"],
+                    "barcode": barcode,
+                    "profile": plate_props["profiles"]["default"]["path"],
+                    "message": msg,
+                }
+            )
 
     errors = pd.DataFrame(errors)
     metadata = pd.concat(metadata)
@@ -115,7 +120,10 @@ def main():
         "dataset_paths",
         metavar="JSONFILE",
         nargs="+",
-        help="json file generated by create_structure script",
+        help=(
+            "json file generated by create_structure script, or its "
+            "structure.arrow folder"
+        ),
     )
     parser.add_argument(
         "--output_path",
@@ -1,16 +1,66 @@
 """Main file"""
 import argparse
+import csv
+import os
 from pathlib import Path
-import pandas as pd
 from tqdm.auto import tqdm
+from tqdm.contrib.concurrent import process_map
 
-from jump.parsing import process_line, datasets
-from jump import io
+from jump.parsing import (
+    process_line,
+    process_object,
+    format_line,
+    datasets,
+    parse,
+    split_shards,
+    read_shard,
+    merge_datasets,
+    reset,
+    select_subtrees,
+    SLOT_SUFFIXES,
+    SUBTREES,
+)
+from jump.dao import DuplicateError
+from jump import delta, index, inventory, io
+from jump.s3 import ObjectLister, url_name
 from jump.utils import get_logger
 
 logger = get_logger(__name__, "INFO")
 
 
+class ErrorWriter:
+    """Write the lines that could not be parsed into a csv file as soon as
+    they are found. The file is only created if there is at least one error."""
+
+    COLUMNS = ["path", "message_00"]
+
+    def __init__(self, filepath: Path):
+        self.filepath = filepath
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, error):
+        """Append a (line, message) tuple to the csv file"""
+        if self._writer is None:
+            self._file = self.filepath.open("w", encoding="utf8", newline="")
+            self._writer = csv.writer(self._file, lineterminator=os.linesep)
+            self._writer.writerow(self.COLUMNS)
+        self._writer.writerow(error)
+        self.count += 1
+
+    def close(self):
+        """Close the underlying file, if any"""
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def parse_line(line):
     """Parse a line from the output of the `aws ls` command"""
     if "DS_Store" not in line:
@@ -21,47 +71,329 @@ def parse_line(line):
     return None
 
 
-def parse_file(filepath: Path):
+def read_lines(filepath: Path):
+    """Lazily yield the lines of a text file containing the output of the
+    `aws ls` command"""
+    with filepath.open("r", encoding="utf8") as fread:
+        yield from fread
+
+
+def parse_file(filepath: Path, errorpath: Path) -> int:
     """
-    Read a text file containing the ouput of the `aws ls` command
+    Parse a text file containing the ouput of the `aws ls` command. Lines are
+    streamed from disk and errors are written to `errorpath` incrementally, so
+    memory usage does not depend on the size of the listing. Return the number
+    of lines that could not be parsed.
     """
-    logger.info("Reading File...")
-    with filepath.open("r", 2) as fread:
-        lines = fread.readlines()
-    logger.info("Read completed.")
-
     logger.info("Parsing File...")
-    errors = []
-    for line in tqdm(lines, desc=filepath.stem):
-        if error := parse_line(line):
-            errors.append(error)
+    with ErrorWriter(errorpath) as writer:
+        for line in tqdm(read_lines(filepath), desc=filepath.stem, unit="lines"):
+            if error := parse_line(line):
+                writer.write(error)
     logger.info("Parsing completed.")
+    return writer.count
+
+
+def parse_bucket(url: str, errorpath: Path, s3_options=None) -> int:
+    """
+    Parse the objects listed from a s3://bucket/prefix url, as `parse_file`
+    does with the output of `aws s3 ls --recursive` for that url. Listing
+    requests run concurrently with the parsing. `s3_options` are passed to
+    `jump.s3.ObjectLister`. Return the number of objects that could not be
+    parsed.
+    """
+    logger.info(f"Listing {url}...")
+    with ErrorWriter(errorpath) as writer:
+        objects = ObjectLister(url, **(s3_options or {}))
+        for key, size, date in tqdm(objects, desc=url_name(url), unit="objects"):
+            if "DS_Store" in key:
+                continue
+            try:
+                process_object(key, size, date)
+            except ValueError as exc:
+                writer.write((format_line(date, size, key).strip(), str(exc)))
+    logger.info("Parsing completed.")
+    return writer.count
+
+
+def parse_inventory(table, output_dir: Path) -> dict:
+    """
+    Parse the objects of a `jump.inventory.read_inventory` table, without
+    formatting them as lines of a listing. Errors are written to the
+    unknown_objects.csv of the dataset of each object. Return the number of
+    objects that could not be parsed by dataset_id
+    """
+    logger.info("Parsing inventory...")
+    writers = {}
+    try:
+        objects = inventory.iter_objects(table)
+        for key, size, epoch in tqdm(objects, total=len(table), unit="objects"):
+            if "DS_Store" in key:
+                continue
+            try:
+                process_object(key, size, epoch)
+            except ValueError as exc:
+                elems = key.split("/", 2)
+                dataset_id = elems[1] if len(elems) > 1 else ""
+                if dataset_id not in writers:
+                    dirpath = output_dir / dataset_id
+                    dirpath.mkdir(parents=True, exist_ok=True)
+                    writers[dataset_id] = ErrorWriter(dirpath / "unknown_objects.csv")
+                writers[dataset_id].write(
+                    (format_line(epoch, size, key).strip(), str(exc))
+                )
+    finally:
+        for writer in writers.values():
+            writer.close()
+    logger.info("Parsing completed.")
+    return {dataset_id: writer.count for dataset_id, writer in writers.items()}
+
+
+def parse_shard(filepath: Path, start: int, end: int, subtrees=None):
+    """
+    Parse a byte range of the listing into fresh datasets. Return these
+    datasets, the (offset, line, exception) errors found in the range and the
+    offsets of the objects that may be rejected when merging the datasets
+    """
+    select_subtrees(subtrees)
+    reset()
+    errors = []
+    offsets = {}
+    for offset, line in read_shard(filepath, start, end):
+        if "DS_Store" in line:
+            continue
+        try:
+            s3_obj = process_line(line)
+        except ValueError as exc:
+            errors.append((offset, line.strip(), exc.with_traceback(None)))
+            continue
+        if s3_obj is not None and s3_obj.filename.endswith(SLOT_SUFFIXES):
+            offsets.setdefault(s3_obj.path, offset)
+    shard = dict(datasets)
+    reset()
+    return shard, errors, offsets
+
+
+def resolve_conflicts(filepath: Path, errors, offsets: dict, conflicts):
+    """
+    Turn the duplicates found while merging a shard into errors, as a serial
+    parse would have reported them, and return all the errors of the shard in
+    file order. Only the lines of the duplicates are read again.
+    """
+    if not conflicts:
+        return errors
+    for conflict in conflicts:
+        # Later duplicates in this shard were compared against the object that
+        # has just been rejected. Point them to the object that was kept.
+        for _, _, exc in errors:
+            if isinstance(exc, DuplicateError) and exc.kept is conflict.s3_obj:
+                exc.kept = conflict.kept
+        path = conflict.s3_obj.path
+        offset = offsets[path]
+        for _, line in read_shard(filepath, offset, offset + 1):
+            if parse(line)[2] == path:
+                errors.append((offset, line.strip(), conflict))
+    errors.sort(key=lambda error: error[0])
     return errors
 
 
-def process_file(list_file: str, output_dir: str):
-    """method to process the aws list file"""
-    filepath = Path(list_file)
-    errors = parse_file(filepath)
+def parse_file_parallel(
+    filepath: Path, errorpath: Path, num_workers: int, subtrees=None
+) -> int:
+    """
+    Parse a text file containing the ouput of the `aws ls` command using
+    `num_workers` processes, each one parsing a byte range of the file. Shards
+    are merged in file order, so the resulting datasets and errors are the
+    same as the ones from `parse_file`. Return the number of lines that could
+    not be parsed.
+    """
+    logger.info("Parsing File...")
+    shards = split_shards(filepath, num_workers)
+    starts, ends = zip(*shards)
+    results = process_map(
+        parse_shard,
+        [filepath] * len(shards),
+        starts,
+        ends,
+        [subtrees] * len(shards),
+        max_workers=num_workers,
+        chunksize=1,
+        desc=filepath.stem,
+    )
+    logger.info("Merging shards...")
+    with ErrorWriter(errorpath) as writer:
+        for shard, errors, offsets in results:
+            conflicts = merge_datasets(shard)
+            for _, line, exc in resolve_conflicts(filepath, errors, offsets, conflicts):
+                writer.write((line, str(exc)))
+    logger.info("Parsing completed.")
+    return writer.count
 
-    dataset_id = filepath.stem
+
+def export_dataset(
+    dataset, dirpath: Path, subtrees=None, ndjson=False, arrow=False, sqlite=False
+):
+    """Write the structure json files and image counts of a dataset. If
+    `ndjson` is set, its batches are also written one per line to
+    structure_extensive.ndjson. If `arrow` is set, the structure is also
+    written as Arrow IPC tables to the structure.arrow folder. If `sqlite` is
+    set, all its objects are indexed in index.sqlite"""
+    jsonfile = dirpath / "structure.json"
+    jsonext_file = dirpath / "structure_extensive.json"
+    countsfile = dirpath / "image_counts.csv"
+    ndjson_file = dirpath / "structure_extensive.ndjson" if ndjson else None
+    io.to_json(dataset, jsonfile, jsonext_file, countsfile, subtrees, ndjson_file)
+    if arrow:
+        logger.info("writing arrow tables...")
+        io.to_arrow(dataset, dirpath / "structure.arrow", subtrees)
+    if sqlite:
+        logger.info("writing sqlite index...")
+        index.write_index(dataset, dirpath / "index.sqlite")
+
+
+def process_file(
+    list_file: str,
+    output_dir: str,
+    num_workers: int = 1,
+    subtrees=None,
+    s3_options=None,
+    ndjson=False,
+    arrow=False,
+    sqlite=False,
+):
+    """method to process the aws list file. If `subtrees` is given, only the
+    objects in these subtrees are parsed and exported. `list_file` can also be
+    a s3://bucket/prefix url to list, with `s3_options` for its ObjectLister"""
+    select_subtrees(subtrees)
+    is_url = str(list_file).startswith("s3://")
+    filepath = Path(list_file)
+    dataset_id = url_name(list_file) if is_url else filepath.stem
     dirpath = Path(output_dir) / dataset_id
     dirpath.mkdir(parents=True, exist_ok=True)
 
-    if len(errors) > 0:
-        errors = pd.DataFrame(errors, columns=["path", "message_00"])
-        errorpath = dirpath / "unknown_objects.csv"
-        errors.to_csv(errorpath, index=False)
+    errorpath = dirpath / "unknown_objects.csv"
+    if is_url:
+        num_errors = parse_bucket(list_file, errorpath, s3_options)
+    elif num_workers > 1:
+        num_errors = parse_file_parallel(filepath, errorpath, num_workers, subtrees)
+    else:
+        num_errors = parse_file(filepath, errorpath)
+    if num_errors > 0:
+        logger.warning(f"{num_errors} unknown objects found in {list_file}")
 
     if dataset_id not in datasets:
         logger.warning(f"Could not parse any line from {list_file} file")
         return
 
-    jsonfile = dirpath / "structure.json"
+    export_dataset(datasets[dataset_id], dirpath, subtrees, ndjson, arrow, sqlite)
+    reset(dataset_id)
+
+    logger.info("Export completed")
+
+
+def process_inventory(
+    manifest: str,
+    output_dir: str,
+    prefix: str = "",
+    subtrees=None,
+    ndjson=False,
+    arrow=False,
+    sqlite=False,
+):
+    """
+    Process the objects of an S3 Inventory report whose key starts with
+    `prefix`. The outputs of every dataset (e.g. every source in the bucket)
+    are written to their own folder in `output_dir`, as `process_file` does
+    with the listing of each one.
+    """
+    select_subtrees(subtrees)
+    output_dir = Path(output_dir)
+    logger.info(f"Reading {manifest}...")
+    table = inventory.read_inventory(manifest, prefix)
+    num_errors = parse_inventory(table, output_dir)
+    del table
+    for dataset_id, count in num_errors.items():
+        logger.warning(f"{count} unknown objects found in {dataset_id or 'bucket'}")
+
+    if not datasets:
+        logger.warning(f"Could not parse any object from {manifest}")
+        return
+    for dataset_id in list(datasets):
+        dirpath = output_dir / dataset_id
+        dirpath.mkdir(parents=True, exist_ok=True)
+        export_dataset(datasets[dataset_id], dirpath, subtrees, ndjson, arrow, sqlite)
+        reset(dataset_id)
+
+    logger.info("Export completed")
+
+
+def parse_affected(filepath: Path, errorpath: Path, affected: set, errors: dict):
+    """
+    Parse the lines of the listing that belong to the `affected` batches or to
+    no batch. Errors of the other lines are taken from the previous `errors`.
+    Return the number of errors and the batch keys in the order they appear
+    """
+    batch_keys = {}
+    with ErrorWriter(errorpath) as writer:
+        for line in tqdm(read_lines(filepath), desc=filepath.stem, unit="lines"):
+            if "DS_Store" in line:
+                continue
+            key = delta.line_batch_key(line)
+            if key is not None:
+                batch_keys.setdefault(key)
+            if key is None or key in affected:
+                if error := parse_line(line):
+                    writer.write(error)
+            elif errors and (messages := errors.get(line.strip())):
+                writer.write((line.strip(), messages.pop(0)))
+    return writer.count, list(batch_keys)
+
+
+def update_file(list_file: str, previous_file: str, output_dir: str):
+    """
+    Update the outputs of `process_file` for the previous version of the
+    listing. Only the batches with objects added, removed or changed are
+    parsed again, the rest are copied from the previous structure. The
+    batches and plates that changed are written to delta.json
+    """
+    filepath = Path(list_file)
+    dataset_id = filepath.stem
+    dirpath = Path(output_dir) / dataset_id
     jsonext_file = dirpath / "structure_extensive.json"
-    countsfile = dirpath / "image_counts.csv"
-    io.to_json(datasets[dataset_id], jsonfile, jsonext_file, countsfile)
-    datasets[dataset_id].clear()
+    errorpath = dirpath / "unknown_objects.csv"
+    if not jsonext_file.exists():
+        logger.warning(f"{jsonext_file} not found. Parsing the whole listing.")
+        process_file(list_file, output_dir)
+        return
+
+    logger.info("Comparing listings...")
+    changes = {delta.ADDED: 0, delta.REMOVED: 0, delta.CHANGED: 0}
+    affected = set()
+    for status, line in delta.diff_listings(previous_file, filepath):
+        changes[status] += 1
+        if (key := delta.line_batch_key(line)) is not None:
+            affected.add(key)
+    logger.info(f"{len(affected)} batches changed: {changes}")
+
+    errors = delta.read_errors(errorpath)
+    errorpath.unlink(missing_ok=True)
+    select_subtrees(None)
+    reset()
+    num_errors, batch_keys = parse_affected(filepath, errorpath, affected, errors)
+    if num_errors > 0:
+        logger.warning(f"{num_errors} unknown objects found in {list_file}")
+
+    batch_ids = [batch_id for key, batch_id in batch_keys if key == dataset_id]
+    if not batch_ids and dataset_id not in datasets:
+        logger.warning(f"Could not parse any line from {list_file} file")
+        return
+
+    affected = {batch_id for key, batch_id in affected if key == dataset_id}
+    batches, plates = delta.update_outputs(
+        dirpath, datasets.get(dataset_id), batch_ids, affected
+    )
+    delta.write_delta(dirpath / "delta.json", dataset_id, changes, batches, plates)
+    reset()
 
     logger.info("Export completed")
 
@@ -78,15 +410,108 @@ def main():
     parser.add_argument(
         "list_file",
         type=str,
-        help="text file containing the output of `aws ls` command.",
+        help=(
+            "text file containing the output of `aws ls` command, a "
+            "s3://bucket/prefix url to list, or the manifest.json of an "
+            "S3 Inventory report"
+        ),
     )
     parser.add_argument(
         "--output_dir",
         default="./outputs",
         help="output directory to store the json files",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to parse the file in parallel",
+    )
+    parser.add_argument(
+        "--subtrees",
+        nargs="+",
+        choices=list(SUBTREES),
+        help="only parse and export these subtrees. default: all of them",
+    )
+    parser.add_argument(
+        "--previous",
+        help=(
+            "previous version of the listing, whose outputs are in output_dir. "
+            "Only the batches that changed are parsed again"
+        ),
+    )
+    parser.add_argument(
+        "--endpoint_url",
+        help="S3 endpoint to list s3:// urls from. default: AWS",
+    )
+    parser.add_argument(
+        "--profile",
+        help="AWS profile used to list s3:// urls",
+    )
+    parser.add_argument(
+        "--prefix",
+        default="",
+        help="only process the objects of an S3 Inventory under this prefix",
+    )
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="also write structure_extensive.ndjson, with one batch per line",
+    )
+    parser.add_argument(
+        "--arrow",
+        action="store_true",
+        help="also write the structure as Arrow IPC tables to structure.arrow/",
+    )
+    parser.add_argument(
+        "--sqlite",
+        action="store_true",
+        help="also index all the objects in index.sqlite, see query_index.py",
+    )
     args = parser.parse_args()
-    process_file(args.list_file, args.output_dir)
+    is_url = args.list_file.startswith("s3://")
+    is_inventory = Path(args.list_file).name == "manifest.json"
+    if args.previous:
+        if (
+            args.subtrees
+            or args.workers > 1
+            or is_url
+            or is_inventory
+            or args.ndjson
+            or args.arrow
+            or args.sqlite
+        ):
+            parser.error(
+                "--previous can not be combined with --subtrees, --workers, "
+                "--ndjson, --arrow, --sqlite, s3:// urls or inventories"
+            )
+        update_file(args.list_file, args.previous, args.output_dir)
+    elif is_inventory:
+        if args.workers > 1:
+            parser.error("inventories are read in bulk, --workers is not used")
+        process_inventory(
+            args.list_file,
+            args.output_dir,
+            args.prefix,
+            args.subtrees,
+            args.ndjson,
+            args.arrow,
+            args.sqlite,
+        )
+    else:
+        if is_url and args.workers > 1:
+            parser.error("s3:// urls are listed concurrently, --workers is not used")
+        s3_options = {"endpoint_url": args.endpoint_url, "profile": args.profile}
+        process_file(
+            args.list_file,
+            args.output_dir,
+            args.workers,
+            args.subtrees,
+            s3_options,
+            args.ndjson,
+            args.arrow,
+            args.sqlite,
+        )
 
 
 if __name__ == "__main__":
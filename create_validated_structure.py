@@ -4,58 +4,142 @@ Validate schema
 import argparse
 import re
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import lru_cache
+import ijson
 import orjson
+from jsonschema.exceptions import ValidationError
 from jsonschema.validators import validator_for
+from tqdm.contrib.concurrent import process_map
 from validate_profiles import match_platemaps, remove_invalid_profiles
+from jump.io import load_structure, prune_schema, SUBTREE_KEYS
+from jump.cache import ValidationCache
 from jump.utils import get_logger
+from jump.validation import CompiledValidator
 
 logger = get_logger(__name__, "INFO")
 
 
 def create_validator(schema: dict, *args, **kwargs):
-    """Create validator given a schema"""
+    """Create validator given a schema. Unless other arguments are given, the
+    schema is compiled into a faster validator with the same errors"""
     cls = validator_for(schema)
     cls.check_schema(schema)
+    if not args and not kwargs:
+        try:
+            return CompiledValidator(schema)
+        except ValueError as exc:
+            logger.warning(f"Using jsonschema validator: {exc}")
     validator = cls(schema, *args, **kwargs)
     return validator
 
 
-PLATE_RGX = re.compile(r"\$.batches\[\d+\].plates\[\d+\]")
 BATCH_RGX = re.compile(r"\$.batches\[\d+\](\.platemaps|\.barcode_platemap|\.plates)?$")
 
 
-def remove_invalid_elements(dataset, validator):
-    """drop invalid elements in this json dataset according to the schema"""
-    errors = list(validator.iter_errors(dataset))
+def split_schema(schema: dict):
+    """
+    Split a structure schema into the schemas of a plate and of a batch, and
+    the schema of the dataset. Batches accept any plate in the last two
+    """
+    skeleton = orjson.loads(orjson.dumps(schema))
+    skeleton["$defs"]["batch"]["properties"]["plates"]["items"] = True
+    plate_schema = {"$ref": "#/$defs/plate", "$defs": schema["$defs"]}
+    batch_schema = {"$ref": "#/$defs/batch", "$defs": skeleton["$defs"]}
+    if "$schema" in schema:
+        plate_schema["$schema"] = batch_schema["$schema"] = schema["$schema"]
+    return plate_schema, batch_schema, skeleton
+
+
+@lru_cache(maxsize=None)
+def _plate_validator(plate_schema: bytes):
+    """Validator of a plate, created once per process"""
+    return create_validator(orjson.loads(plate_schema))
+
+
+def plate_errors(plate: dict, plate_schema: bytes) -> list:
+    """Path and message of the validation errors of a plate"""
+    validator = _plate_validator(plate_schema)
+    return [
+        (tuple(error.absolute_path), error.message)
+        for error in validator.iter_errors(plate)
+    ]
+
+
+def json_path(path) -> str:
+    """JSON path of the error at this path, as given by jsonschema"""
+    return ValidationError("", path=deque(path)).json_path
+
+
+def warn_plate(batch, batch_ix, plate_ix, plate, errors):
+    """Log the errors of an invalid plate"""
+    for path, message in errors:
+        path = ("batches", batch_ix, "plates", plate_ix) + path
+        logger.warning(
+            f'Deleting invalid plate {batch["batch_id"]}.{plate["plate_id"]}: {json_path(path)} {message}'
+        )
+
+
+def batch_errors(batch_validator, batch, batch_ix) -> list:
+    """JSON path and message of the errors that invalidate a batch"""
+    errors = []
+    for error in batch_validator.iter_errors(batch):
+        path = json_path(("batches", batch_ix) + tuple(error.absolute_path))
+        if BATCH_RGX.match(path):
+            errors.append((path, error.message))
+    return errors
+
+
+def warn_batch(batch, errors):
+    """Log the errors of an invalid batch"""
+    for path, message in errors:
+        logger.warning(f'Deleting invalid batch {batch["batch_id"]}: {path} {message}')
+
+
+def remove_invalid_elements(dataset, validator, workers=1):
+    """
+    drop invalid elements in this json dataset according to the schema.
+    Plates are validated independently, in `workers` processes, and batches
+    are then validated without their plates
+    """
+    plate_schema, batch_schema, skeleton = split_schema(validator.schema)
+    plate_schema = orjson.dumps(plate_schema)
+    plates = [
+        (batch_ix, plate_ix, plate)
+        for batch_ix, batch in enumerate(dataset["batches"])
+        if isinstance(batch, dict) and isinstance(batch.get("plates"), list)
+        for plate_ix, plate in enumerate(batch["plates"])
+    ]
+    if workers > 1:
+        results = process_map(
+            plate_errors,
+            [plate for _, _, plate in plates],
+            [plate_schema] * len(plates),
+            max_workers=workers,
+            chunksize=max(1, len(plates) // (workers * 4)),
+            leave=False,
+        )
+    else:
+        results = [plate_errors(plate, plate_schema) for _, _, plate in plates]
+
     bad_plates = defaultdict(set)
-    for error in errors:
-        if PLATE_RGX.match(error.json_path):
-            keys = error.absolute_path
-            batch_ix, plate_ix = keys[1], keys[3]
+    for (batch_ix, plate_ix, plate), errors in zip(plates, results):
+        if errors:
             bad_plates[batch_ix].add(plate_ix)
-            batch = dataset["batches"][batch_ix]
-            plate = batch["plates"][plate_ix]
-            logger.warning(
-                f'Deleting invalid plate {batch["batch_id"]}.{plate["plate_id"]}: {error.json_path} {error.message}'
-            )
+            warn_plate(dataset["batches"][batch_ix], batch_ix, plate_ix, plate, errors)
     # Drop plates
     for batch_ix, plates_ix in bad_plates.items():
         plates = dataset["batches"][batch_ix]["plates"]
         plates = [plate for ix, plate in enumerate(plates) if ix not in plates_ix]
         dataset["batches"][batch_ix]["plates"] = plates
 
+    # The remaining plates are valid, so only the rest of the dataset is checked
+    batch_validator = create_validator(batch_schema)
     bad_batches = set()
-    errors = list(validator.iter_errors(dataset))
-    for error in errors:
-        if BATCH_RGX.match(error.json_path):
-            keys = error.absolute_path
-            batch_ix = keys[1]
+    for batch_ix, batch in enumerate(dataset["batches"]):
+        if errors := batch_errors(batch_validator, batch, batch_ix):
             bad_batches.add(batch_ix)
-            batch = dataset["batches"][batch_ix]
-            logger.warning(
-                f'Deleting invalid batch {batch["batch_id"]}: {error.json_path} {error.message}'
-            )
+            warn_batch(batch, errors)
 
     # Drop batches
     batches = dataset["batches"]
@@ -63,33 +147,195 @@ def remove_invalid_elements(dataset, validator):
     dataset["batches"] = batches
 
     if dataset["batches"]:
-        validator.validate(dataset)
+        create_validator(skeleton).validate(dataset)
+
+
+CONTAINER_START = {"start_map", "start_array"}
+CONTAINER_END = {"end_map", "end_array"}
+
+
+def build_value(events, event, value):
+    """Build the json value that starts with this ijson event"""
+    if event not in CONTAINER_START:
+        return value
+    builder = ijson.common.ObjectBuilder()
+    add = builder.event
+    add(event, value)
+    depth = 1
+    for event, value in events:
+        add(event, value)
+        if event in CONTAINER_START:
+            depth += 1
+        elif event in CONTAINER_END:
+            depth -= 1
+            if not depth:
+                break
+    return builder.value
+
+
+class StreamValidator:
+    """
+    Remove the invalid plates and batches of a json structure while it is
+    parsed, writing the valid ones to the output as they complete. Only a
+    plate is loaded at a time, along with the other keys of its batch.
+    """
+
+    def __init__(self, validator, f_out):
+        plate_schema, batch_schema, skeleton = split_schema(validator.schema)
+        self.plate_schema = orjson.dumps(plate_schema)
+        self.batch_validator = create_validator(batch_schema)
+        self.validator = create_validator(skeleton)
+        self.f_out = f_out
+
+    def write_key(self, key, first):
+        """Write the key of an object"""
+        self.f_out.write(orjson.dumps(key) if first else b"," + orjson.dumps(key))
+        self.f_out.write(b":")
 
+    def validate(self, events):
+        """
+        Validate the dataset of these basic_parse events. The plates of every
+        batch are replaced by None in the returned dataset.
+        """
+        event, value = next(events)
+        if event != "start_map":
+            raise ValueError("The structure is not a json object")
+        dataset = {}
+        self.f_out.write(b"{")
+        for event, key in events:
+            if event == "end_map":
+                break
+            self.write_key(key, not dataset)
+            event, value = next(events)
+            if key == "batches" and event == "start_array":
+                dataset[key] = self.batches(events)
+            else:
+                dataset[key] = build_value(events, event, value)
+                self.f_out.write(orjson.dumps(dataset[key]))
+        self.f_out.write(b"}")
+        if dataset["batches"]:
+            self.validator.validate(dataset)
+        return dataset
 
-def validate_dataset(jsonfile, outputfile, validator, check_profile):
+    def batches(self, events) -> list:
+        """Validate and write the batches of the dataset"""
+        batches = []
+        self.f_out.write(b"[")
+        for batch_ix, (event, value) in enumerate(events):
+            if event == "end_array":
+                break
+            offset = self.f_out.tell()
+            if batches:
+                self.f_out.write(b",")
+            if event == "start_map":
+                batch = self.batch(events, batch_ix)
+            else:
+                batch = build_value(events, event, value)
+                self.f_out.write(orjson.dumps(batch))
+            if errors := batch_errors(self.batch_validator, batch, batch_ix):
+                warn_batch(batch, errors)
+                self.f_out.seek(offset)
+                self.f_out.truncate()
+            else:
+                batches.append(batch)
+        self.f_out.write(b"]")
+        return batches
+
+    def batch(self, events, batch_ix) -> dict:
+        """Validate and write the plates of a batch, along with its other keys"""
+        batch = {}
+        # Errors of plates that are found before the batch_id
+        pending = []
+        self.f_out.write(b"{")
+        for event, key in events:
+            if event == "end_map":
+                break
+            self.write_key(key, not batch)
+            event, value = next(events)
+            if key != "plates" or event != "start_array":
+                batch[key] = build_value(events, event, value)
+                self.f_out.write(orjson.dumps(batch[key]))
+                continue
+            batch[key] = []
+            self.f_out.write(b"[")
+            for plate_ix, (event, value) in enumerate(events):
+                if event == "end_array":
+                    break
+                plate = build_value(events, event, value)
+                if errors := plate_errors(plate, self.plate_schema):
+                    pending.append((plate_ix, plate, errors))
+                else:
+                    if batch[key]:
+                        self.f_out.write(b",")
+                    self.f_out.write(orjson.dumps(plate))
+                    batch[key].append(None)
+                if "batch_id" in batch:
+                    for args in pending:
+                        warn_plate(batch, batch_ix, *args)
+                    pending.clear()
+            self.f_out.write(b"]")
+        self.f_out.write(b"}")
+        for args in pending:
+            warn_plate(batch, batch_ix, *args)
+        return batch
+
+
+def stream_dataset(jsonfile, outputfile: Path, validator):
+    """
+    Create a new json file without the invalid plates and batches, parsing
+    the structure incrementally so that only a plate is in memory at a time.
+    The file is only created if the rest of the structure is valid.
+    """
+    logger.info(f"Validating {jsonfile}...")
+    tmppath = outputfile.with_suffix(".tmp")
+    try:
+        with open(jsonfile, "rb") as f_in, tmppath.open("wb") as f_out:
+            events = ijson.basic_parse(f_in, use_float=True)
+            StreamValidator(validator, f_out).validate(events)
+    except BaseException:
+        tmppath.unlink(missing_ok=True)
+        raise
+    tmppath.replace(outputfile)
+    logger.info(f"{outputfile} saved.")
+
+
+def validate_dataset(
+    jsonfile,
+    outputfile,
+    validator,
+    check_profile,
+    check_platemaps=True,
+    workers=1,
+    cache=None,
+    long_form=False,
+):
     """Create new json files that complies schema.json and whose
-    profiles are valid"""
+    profiles are valid. Plates are validated in `workers` processes, and the
+    platemap and profile checks are looked up in `cache` if given. The
+    status of every feature of every plate is saved if `long_form`"""
 
     logger.info("Reading structure...")
-    with open(jsonfile, "rb") as f_in:
-        dataset = orjson.loads(f_in.read())
+    dataset = load_structure(jsonfile)
     logger.info(f"Validating {jsonfile}...")
-    remove_invalid_elements(dataset, validator)
-    for batch in dataset["batches"]:
-        match_platemaps(batch)
+    remove_invalid_elements(dataset, validator, workers)
+    if check_platemaps:
+        for batch in dataset["batches"]:
+            match_platemaps(batch, cache=cache)
     if check_profile:
-        result = remove_invalid_profiles(dataset, "default")
+        report = remove_invalid_profiles(dataset, "default", cache)
 
         # Print counts
-        counts = (
-            result.query('status=="missing"').groupby("batch_id")["plate_id"].nunique()
-        )
-        missing_path = outputfile.parent / "missing_features.csv"
-        result.to_csv(missing_path, index=False)
+        counts = report.invalid_counts()
+        signatures_path = outputfile.parent / "feature_signatures.csv"
+        report.signatures().to_csv(signatures_path, index=False)
+        logger.info(f"{signatures_path} generated.")
+        if long_form:
+            missing_path = outputfile.parent / "missing_features.csv"
+            report.long_form().to_csv(missing_path, index=False)
+            logger.info(f"{missing_path} generated.")
         if len(counts) > 0:
             logger.info("Plates removed per batch due to missing features.")
             print(counts)
-            logger.info(f"{missing_path} generated.")
 
     with outputfile.open("wb") as f_out:
         f_out.write(orjson.dumps(dataset))
@@ -105,7 +351,12 @@ def main():
         ),
     )
     parser.add_argument(
-        "jsonfile", type=str, help="json file generated by create_structure script"
+        "jsonfile",
+        type=str,
+        help=(
+            "json file generated by create_structure script, or its "
+            "structure.arrow folder"
+        ),
     )
     parser.add_argument(
         "--output",
@@ -122,6 +373,40 @@ def main():
         dest="check_profile",
         action="store_false",
     )
+    parser.add_argument(
+        "--subtrees",
+        nargs="+",
+        choices=list(SUBTREE_KEYS),
+        help="subtrees the structure was created with. default: all of them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to validate the plates in parallel",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "parse the json file incrementally, keeping only a plate in memory. "
+            "Platemaps and profiles are not checked"
+        ),
+    )
+    parser.add_argument(
+        "--long-form",
+        action="store_true",
+        help=(
+            "save the status of every feature of every plate in " "missing_features.csv"
+        ),
+    )
+    parser.add_argument(
+        "--cache",
+        help=(
+            "SQLite file caching the platemap and profile checks across runs. "
+            "Only the plates whose files changed are checked again"
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -130,12 +415,39 @@ def main():
         args.output = path.parent / f"{path.stem}_validated.json"
     else:
         args.output = Path(args.output)
+    if args.stream and Path(args.jsonfile).is_dir():
+        parser.error("--stream needs a json file")
+    check_platemaps = not args.stream and (
+        args.subtrees is None or "metadata" in args.subtrees
+    )
+    if args.stream or args.subtrees is not None and "profiles" not in args.subtrees:
+        args.check_profile = False
     if not args.check_profile:
         logger.warning("Skipping check profile consistency.")
+    if not check_platemaps:
+        logger.warning("Skipping platemap matching.")
 
     with open(args.schema, "rb") as f_in:
-        validator = create_validator(orjson.loads(f_in.read()))
-    validate_dataset(args.jsonfile, args.output, validator, args.check_profile)
+        schema = prune_schema(orjson.loads(f_in.read()), args.subtrees)
+    validator = create_validator(schema)
+    if args.stream:
+        stream_dataset(args.jsonfile, args.output, validator)
+        return
+    cache = ValidationCache(args.cache, schema) if args.cache else None
+    try:
+        validate_dataset(
+            args.jsonfile,
+            args.output,
+            validator,
+            args.check_profile,
+            check_platemaps,
+            args.workers,
+            cache,
+            args.long_form,
+        )
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
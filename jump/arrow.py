@@ -0,0 +1,311 @@
+"""
+Store the structure of a dataset as normalized Arrow IPC tables
+"""
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from jump import dao
+from jump.io import default, dropna, serialize_plate
+
+OBJECT = pa.struct([("date", pa.string()), ("size", pa.int64()), ("path", pa.string())])
+PLATE_OBJECTS = (
+    "backend_csv",
+    "backend_sqlite",
+    "load_data_with_illum",
+    "load_data_csv",
+)
+OUTLINES = ("cell_outline", "nuclei_outline", "mito_outline", "mito_obj_outline")
+# Every table has a record batch for each batch of the dataset, in the same
+# order. Rows refer to their plate, well or site by their index in the record
+# batch of the same batch in the plates, wells and sites tables
+SCHEMAS = {
+    "batches": pa.schema(
+        [
+            ("batch_id", pa.string()),
+            ("platemaps", pa.list_(OBJECT)),
+            ("barcode_platemap", OBJECT),
+        ]
+    ),
+    "plates": pa.schema(
+        [("plate_id", pa.string())] + [(key, OBJECT) for key in PLATE_OBJECTS]
+    ),
+    "correction_files": pa.schema(
+        [("plate", pa.int32()), ("channel", pa.string()), ("file", OBJECT)]
+    ),
+    "profiles": pa.schema(
+        [("plate", pa.int32()), ("profile", pa.string()), ("file", OBJECT)]
+    ),
+    "containers": pa.schema(
+        [
+            ("plate", pa.int32()),
+            ("well", pa.int32()),
+            ("site", pa.int32()),
+            ("container", pa.string()),
+            ("file", OBJECT),
+        ]
+    ),
+    "wells": pa.schema([("plate", pa.int32()), ("well_id", pa.string())]),
+    "sites": pa.schema(
+        [("well", pa.int32()), ("site_id", pa.string())]
+        + [(key, OBJECT) for key in OUTLINES]
+    ),
+    "images": pa.schema(
+        [
+            ("plate", pa.int32()),
+            ("date", pa.string()),
+            ("size", pa.int64()),
+            ("path", pa.string()),
+        ]
+    ),
+}
+
+
+def _rows(props: dict, keys) -> dict:
+    """Columns of a table for the `keys` of a serialized element"""
+    return {key: props.get(key) for key in keys}
+
+
+def batch_tables(batch: dao.Batch, excluded=()) -> dict:
+    """Normalize a batch into a record batch for every table"""
+    batch_props = batch.to_dict()
+    for key in excluded:
+        batch_props.pop(key, None)
+    batch_props = dropna(batch_props)
+    rows = {name: [] for name in SCHEMAS}
+    rows["batches"].append(_rows(batch_props, SCHEMAS["batches"].names))
+    images = {"plate": [], "date": [], "size": [], "path": []}
+    num_wells = num_sites = 0
+    for plate_ix, plate in enumerate(batch.plates.values()):
+        plate_props = serialize_plate(plate)
+        plate_images = plate_props.pop("images")
+        plate_props = dropna(plate_props)
+        rows["plates"].append(_rows(plate_props, SCHEMAS["plates"].names))
+        for channel, obj in plate_props["correction_files"].items():
+            rows["correction_files"].append(
+                {"plate": plate_ix, "channel": channel, "file": obj}
+            )
+        for profile, obj in plate_props["profiles"].items():
+            rows["profiles"].append(
+                {"plate": plate_ix, "profile": profile, "file": obj}
+            )
+        containers = [(None, None, plate_props.get("containers", {}))]
+        for well_props in plate_props["wells"]:
+            rows["wells"].append({"plate": plate_ix, "well_id": well_props["well_id"]})
+            containers.append((num_wells, None, well_props.get("containers", {})))
+            for site_props in well_props["sites"]:
+                site_row = _rows(site_props, SCHEMAS["sites"].names)
+                site_row["well"] = num_wells
+                rows["sites"].append(site_row)
+                containers.append(
+                    (num_wells, num_sites, site_props.get("containers", {}))
+                )
+                num_sites += 1
+            num_wells += 1
+        for well_ix, site_ix, files in containers:
+            rows["containers"].extend(
+                {
+                    "plate": plate_ix,
+                    "well": well_ix,
+                    "site": site_ix,
+                    "container": name,
+                    "file": obj,
+                }
+                for name, obj in files.items()
+            )
+        for s3_obj in plate_images:
+            images["plate"].append(plate_ix)
+            images["date"].append(s3_obj.date)
+            images["size"].append(s3_obj.size)
+            images["path"].append(s3_obj.path)
+
+    tables = {
+        name: pa.RecordBatch.from_pylist(
+            orjson.loads(orjson.dumps(table, default=default)), schema=SCHEMAS[name]
+        )
+        for name, table in rows.items()
+        if name != "images"
+    }
+    tables["images"] = pa.RecordBatch.from_pydict(images, schema=SCHEMAS["images"])
+    return tables
+
+
+def write_arrow(dataset: dao.Dataset, dirpath, excluded=()):
+    """
+    Write a dataset as a folder with an Arrow IPC file for each table. Every
+    batch is written as a record batch of each file, so it can be loaded
+    without reading the rest. Keys in `excluded` are left out.
+    """
+    dirpath = Path(dirpath)
+    dirpath.mkdir(parents=True, exist_ok=True)
+    metadata = {
+        "dataset_id": dataset.dataset_id,
+        "excluded": orjson.dumps(sorted(excluded)),
+    }
+    writers = {
+        name: pa.ipc.new_file(
+            str(dirpath / f"{name}.arrow"), schema.with_metadata(metadata)
+        )
+        for name, schema in SCHEMAS.items()
+    }
+    try:
+        for batch in dataset.batches:
+            for name, table in batch_tables(batch, excluded).items():
+                writers[name].write_batch(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def _drop_none(row: dict) -> dict:
+    """Remove the null columns of a row. S3 objects have no null fields, so
+    this drops the same values as `dropna` on the serialized element"""
+    return {key: value for key, value in row.items() if value is not None}
+
+
+def _group(rows: list, key: str) -> dict:
+    """Group rows by one of their columns"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[key], []).append(row)
+    return groups
+
+
+def _objects(rows, key: str, name: str = "file") -> dict:
+    """Dict from the `key` of each row to its S3 object"""
+    return {row[key]: row[name] for row in rows}
+
+
+class ArrowStructure(Mapping):
+    """
+    Lazy view of a dataset written by `write_arrow`, with the "dataset_id"
+    and "batches" of the structure json files. The files are memory mapped
+    and batches are only read when they are accessed. Batches have the keys
+    of structure.json or, if `extensive`, of structure_extensive.json.
+    """
+
+    def __init__(self, dirpath, extensive=False):
+        self.dirpath = Path(dirpath)
+        self.extensive = extensive
+        self._readers = {}
+        metadata = self._reader("batches").schema.metadata
+        self.dataset_id = metadata[b"dataset_id"].decode("utf8")
+        self.excluded = set(orjson.loads(metadata[b"excluded"]))
+        self.batch_ids = (
+            self._reader("batches").read_all().column("batch_id").to_pylist()
+        )
+
+    def _reader(self, name):
+        if name not in self._readers:
+            source = pa.memory_map(str(self.dirpath / f"{name}.arrow"))
+            self._readers[name] = pa.ipc.open_file(source)
+        return self._readers[name]
+
+    def _read(self, name, batch_ix) -> list:
+        return self._reader(name).get_batch(batch_ix).to_pylist()
+
+    def __getitem__(self, key):
+        if key == "dataset_id":
+            return self.dataset_id
+        if key == "batches":
+            return BatchList(self)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(("dataset_id", "batches"))
+
+    def __len__(self):
+        return 2
+
+    def batch(self, batch_ix: int) -> dict:
+        """Reconstruct the serialized batch at the given index"""
+        batch_props = _drop_none(self._read("batches", batch_ix)[0])
+        plates = self._read("plates", batch_ix)
+        corrections = _group(self._read("correction_files", batch_ix), "plate")
+        profiles = _group(self._read("profiles", batch_ix), "plate")
+        rows = self._reader("containers").get_batch(batch_ix)
+        if not self.extensive:
+            # Only the containers of the plates are needed
+            rows = rows.filter(pc.is_null(rows.column("well")))
+        containers = {}
+        for row in rows.to_pylist():
+            key = row["plate"], row["well"], row["site"]
+            containers.setdefault(key, {})[row["container"]] = row["file"]
+        if self.extensive:
+            wells = self._wells(batch_ix, containers)
+            images = self._reader("images").get_batch(batch_ix)
+            ends = np.searchsorted(
+                images.column("plate").to_numpy(), np.arange(len(plates)), "right"
+            ).tolist()
+            images = [images.column(name).to_pylist() for name in OBJECT.names]
+
+        for plate_ix, plate in enumerate(plates):
+            plate["correction_files"] = _objects(
+                corrections.get(plate_ix, []), "channel"
+            )
+            plate["profiles"] = _objects(profiles.get(plate_ix, []), "profile")
+            if files := containers.get((plate_ix, None, None)):
+                plate["containers"] = files
+            if self.extensive:
+                plate["wells"] = wells.get(plate_ix, [])
+                start, end = ends[plate_ix - 1] if plate_ix else 0, ends[plate_ix]
+                plate["images"] = [
+                    dict(zip(OBJECT.names, obj))
+                    for obj in zip(*(column[start:end] for column in images))
+                ]
+            for key in self.excluded:
+                plate.pop(key, None)
+        batch_props["plates"] = [_drop_none(plate) for plate in plates]
+        return batch_props
+
+    def _wells(self, batch_ix, containers) -> dict:
+        """Serialized wells of a batch, with their sites, by plate index"""
+        sites = {}
+        for site_ix, site in enumerate(self._read("sites", batch_ix)):
+            well_ix = site.pop("well")
+            sites.setdefault(well_ix, []).append((site_ix, _drop_none(site)))
+        wells = {}
+        for well_ix, well in enumerate(self._read("wells", batch_ix)):
+            plate_ix = well.pop("plate")
+            if files := containers.get((plate_ix, well_ix, None)):
+                well["containers"] = files
+            well["sites"] = []
+            for site_ix, site in sites.get(well_ix, []):
+                if files := containers.get((plate_ix, well_ix, site_ix)):
+                    site["containers"] = files
+                well["sites"].append(site)
+            wells.setdefault(plate_ix, []).append(well)
+        return wells
+
+    def to_dict(self) -> dict:
+        """Load the whole dataset, as in the json files"""
+        return {"dataset_id": self.dataset_id, "batches": list(BatchList(self))}
+
+    def close(self):
+        """Release the memory maps"""
+        self._readers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchList(Sequence):
+    """Batches of an `ArrowStructure`, read when they are accessed"""
+
+    def __init__(self, structure: ArrowStructure):
+        self.structure = structure
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ix] for ix in range(len(self))[index]]
+        return self.structure.batch(range(len(self))[index])
+
+    def __len__(self):
+        return len(self.structure.batch_ids)
@@ -0,0 +1,97 @@
+"""
+Cache the results of the platemap and profile checks across runs
+"""
+import hashlib
+import sqlite3
+import time
+
+import orjson
+
+from jump.utils import CONFIG
+
+# Bump it when the format of the cached results changes
+VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (fingerprint TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    used REAL NOT NULL
+);
+"""
+MAX_ENTRIES = 100_000
+
+
+def cache_key(*objs) -> str:
+    """Hash of json serializable objects, e.g. the s3_object dicts (path,
+    size and date) a result depends on"""
+    return hashlib.sha256(orjson.dumps(objs, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def fingerprint(schema: dict) -> str:
+    """Hash of what invalidates every cached result: the schema and the
+    mandatory columns"""
+    with open(CONFIG["mandatory_columns_path"], "rb") as f_in:
+        columns = f_in.read()
+    return cache_key(VERSION, schema, columns.decode())
+
+
+class ValidationCache:
+    """
+    SQLite database of validation results keyed by `cache_key`. Results are
+    dropped when the fingerprint of the schema and mandatory columns changes,
+    and the least recently used ones when there are more than `max_entries`.
+    """
+
+    def __init__(self, dbpath, schema: dict, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.executescript(SCHEMA)
+        self.used = {}
+        current = fingerprint(schema)
+        row = self.conn.execute("SELECT fingerprint FROM meta").fetchone()
+        if row is None or row[0] != current:
+            with self.conn:
+                self.conn.execute("DELETE FROM meta")
+                self.conn.execute("DELETE FROM results")
+                self.conn.execute("INSERT INTO meta VALUES (?)", (current,))
+
+    def get(self, key: str):
+        """Cached result of a key, or None"""
+        row = self.conn.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.used[key] = time.time()
+        return orjson.loads(row[0])
+
+    def put(self, key: str, value):
+        """Cache the result of a key. It is committed on `close`"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            (key, orjson.dumps(value), time.time()),
+        )
+
+    def close(self):
+        """Commit the new results, record the use of the cached ones, evict
+        the least recently used ones and close the database"""
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE results SET used = ? WHERE key = ?",
+                    ((used, key) for key, used in self.used.items()),
+                )
+                self.conn.execute(
+                    "DELETE FROM results WHERE key NOT IN ("
+                    "SELECT key FROM results ORDER BY used DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,19 +2,70 @@
 Validator for s3 object in JUMP project
 """
 import re
+import sys
+import time
 import datetime
-from dataclasses import dataclass
+from array import array
+from functools import lru_cache
 from jump.utils import CONFIG
 
 # pylint: disable=too-few-public-methods
 
 
+class DuplicateError(ValueError):
+    """An object was added to a slot (a profile, csv file or correction) that
+    was already taken by `kept`. The message is formatted when printed"""
+
+    def __init__(self, kind: str, key: str, kept, s3_obj):
+        super().__init__(kind, key, kept, s3_obj)
+        self.kind = kind
+        self.key = key
+        self.kept = kept
+        self.s3_obj = s3_obj
+
+    def __reduce__(self):
+        return type(self), (self.kind, self.key, self.kept, self.s3_obj)
+
+    def __str__(self):
+        return f"Duplicated {self.kind} for {self.key}: {self.kept}, {self.s3_obj}"
+
+
+def merge_unique(add, s3_objs, conflicts: list):
+    """Insert s3 objects coming from another tree with the `add` method.
+    The DuplicateError of the objects rejected are appended to `conflicts`"""
+    for s3_obj in s3_objs:
+        try:
+            add(s3_obj)
+        except DuplicateError as exc:
+            conflicts.append(exc)
+
+
+def csv_suffixes(files, valid_ext) -> tuple:
+    """Precompute the (file, suffixes) pairs that identify analysis csv files"""
+    return tuple((file, tuple(f"{file}.{ext}" for ext in valid_ext)) for file in files)
+
+
+@lru_cache(maxsize=4096)
+def profile_suffixes(plate_id) -> tuple:
+    """Precompute the (profile, suffixes) pairs that identify the profiles of
+    a plate, in the order `Plate.add_profile` checks them"""
+    default = ("default", (f"{plate_id}.csv.gz", f"{plate_id}.csv"))
+    pairs = [
+        (profile, (f"{plate_id}_{profile}.csv.gz", f"{plate_id}_{profile}.csv"))
+        for profile in CONFIG["profiles"]
+    ]
+    return tuple(pairs[:1] + [default] + pairs[1:]) if pairs else ()
+
+
 class CSVAnalysisContainer:
     """Either a Plate, Well or a Site containing several CSV files related to
     the analysis folder"""
 
+    __slots__ = ("csv_files",)
+
     FILES = CONFIG["analysis_csv_files"]
     VALID_EXT = "csv", "csv.gz"
+    FILE_SUFFIXES = csv_suffixes(FILES, VALID_EXT)
 
     def __init__(self):
         self.csv_files = {}
@@ -24,33 +75,166 @@ class CSVAnalysisContainer:
         Add csv path to this Site object
         """
         path = s3_obj.path
-        if not any(map(path.endswith, self.VALID_EXT)):
+        if not path.endswith(self.VALID_EXT):
             raise ValueError("Invalid extension for a CSV file")
 
-        for file in self.FILES:
-            valid_suffix = [f"{file}.{ext}" for ext in self.VALID_EXT]
-            if any(map(path.endswith, valid_suffix)):
+        for file, suffixes in self.FILE_SUFFIXES:
+            if path.endswith(suffixes):
                 if file in self.csv_files:
-                    raise ValueError(
-                        f"Duplicated csv file for {file}: {self.csv_files[file]}, {path}"
-                    )
+                    raise DuplicateError("csv file", file, self.csv_files[file], s3_obj)
                 self.csv_files[file] = s3_obj
                 return
         raise ValueError(f"csv_file not valid in analysis folder: {path}")
 
+    def merge_csv_files(self, other, conflicts: list):
+        """Add csv files from another container of the same object"""
+        merge_unique(self.add_csv_file, other.csv_files.values(), conflicts)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECOND = datetime.timedelta(seconds=1)
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def date_to_epoch(date) -> int:
+    """Convert a date from the `aws ls` output ('%Y-%m-%d %H:%M:%S') into
+    seconds since epoch. Integers are already seconds since epoch"""
+    if isinstance(date, int):
+        return date
+    if isinstance(date, str):
+        if len(date) != 19:
+            raise ValueError(f"Invalid date format: {date}")
+        date = datetime.datetime.fromisoformat(date)
+    return (date - EPOCH) // SECOND
+
+
+def epoch_to_date(epoch: int) -> str:
+    """Convert seconds since epoch into a '%Y-%m-%d %H:%M:%S' string"""
+    return time.strftime(DATE_FORMAT, time.gmtime(epoch))
+
+
+def split_path(path: str):
+    """Split a path into its interned parent folder and its filename. Only
+    the folder is interned, filenames are rarely shared"""
+    index = path.rfind("/") + 1
+    return sys.intern(path[:index]), path[index:]
+
 
-@dataclass
 class S3Object:
-    """S3 object to be validated"""
+    """S3 object to be validated.
 
-    date: datetime.datetime
-    size: int
-    path: str
+    Objects only keep the filename, the parent folder is interned so that it
+    is shared with the rest of the objects in the same folder, and the date is
+    stored as seconds since epoch."""
+
+    __slots__ = ("folder", "filename", "epoch", "size")
+
+    def __init__(self, date, size: int, path: str):
+        self.folder, self.filename = split_path(path)
+        self.epoch = date_to_epoch(date)
+        self.size = size
+
+    @property
+    def path(self) -> str:
+        """Full path of the object"""
+        return self.folder + self.filename
+
+    @property
+    def date(self) -> str:
+        """Date as reported by `aws ls`"""
+        return epoch_to_date(self.epoch)
+
+    def to_dict(self):
+        """Serialize this object in a dict"""
+        return {"date": self.date, "size": self.size, "path": self.path}
+
+    def __eq__(self, other):
+        if not isinstance(other, S3Object):
+            return NotImplemented
+        return (self.path, self.epoch, self.size) == (
+            other.path,
+            other.epoch,
+            other.size,
+        )
+
+    def __repr__(self):
+        return f"S3Object(date={self.date!r}, size={self.size!r}, path={self.path!r})"
 
     def __str__(self):
         return self.path
 
 
+class ImageColumns:
+    """Array-backed list of S3 objects. Each object costs a few bytes plus its
+    filename instead of a full S3Object, which matters for the millions of
+    images in a source."""
+
+    __slots__ = (
+        "folders",
+        "_folder_ix",
+        "folder_ids",
+        "sizes",
+        "epochs",
+        "names",
+        "ends",
+    )
+
+    def __init__(self):
+        self.folders = []
+        self._folder_ix = {}
+        self.folder_ids = array("I")
+        self.sizes = array("q")
+        self.epochs = array("q")
+        self.names = bytearray()
+        self.ends = array("Q")
+
+    def _folder_id(self, folder: str) -> int:
+        folder_id = self._folder_ix.get(folder)
+        if folder_id is None:
+            folder_id = self._folder_ix[folder] = len(self.folders)
+            self.folders.append(folder)
+        return folder_id
+
+    def append(self, s3_obj: S3Object):
+        """Add an S3 object at the end"""
+        self.folder_ids.append(self._folder_id(s3_obj.folder))
+        self.sizes.append(s3_obj.size)
+        self.epochs.append(s3_obj.epoch)
+        self.names += s3_obj.filename.encode("utf8")
+        self.ends.append(len(self.names))
+
+    def extend(self, other: "ImageColumns"):
+        """Add all the objects from another ImageColumns at the end"""
+        mapping = [self._folder_id(folder) for folder in other.folders]
+        self.folder_ids.extend(mapping[folder_id] for folder_id in other.folder_ids)
+        self.sizes.extend(other.sizes)
+        self.epochs.extend(other.epochs)
+        offset = len(self.names)
+        self.names += other.names
+        self.ends.extend(end + offset for end in other.ends)
+
+    def __iter__(self):
+        start = 0
+        names = memoryview(self.names)
+        for folder_id, size, epoch, end in zip(
+            self.folder_ids, self.sizes, self.epochs, self.ends
+        ):
+            s3_obj = S3Object.__new__(S3Object)
+            s3_obj.folder = self.folders[folder_id]
+            s3_obj.filename = str(names[start:end], "utf8")
+            s3_obj.epoch = epoch
+            s3_obj.size = size
+            start = end
+            yield s3_obj
+
+    def to_list(self):
+        """Serialize all the objects as a list of dicts"""
+        return [s3_obj.to_dict() for s3_obj in self]
+
+    def __len__(self):
+        return len(self.sizes)
+
+
 class Batch:
     """Object representing batches"""
 
@@ -64,6 +248,7 @@ class Batch:
         self.plates = {}
         self.platemaps = []
         self.barcode_platemap = None
+        self.date = None
 
     def find_one_plate(self, path):
         """Find the plate whose ID is in the given path.
@@ -90,6 +275,20 @@ class Batch:
         self.plates[plate_id] = plate
         return plate
 
+    def merge(self, other, conflicts: list):
+        """Merge a batch with the same ID parsed from a later part of the
+        listing"""
+        for plate_id, plate in other.plates.items():
+            if plate_id in self.plates:
+                self.plates[plate_id].merge(plate, conflicts)
+            else:
+                self.plates[plate_id] = plate
+        self.platemaps.extend(other.platemaps)
+        if other.barcode_platemap is not None:
+            self.barcode_platemap = other.barcode_platemap
+        if other.date is not None:
+            self.date = other.date
+
     def to_dict(self):
         """Serialize this batch in a shallow dict"""
         return {
@@ -104,7 +303,7 @@ class Plate(CSVAnalysisContainer):  # pylint: disable=too-many-instance-attribut
 
     def __init__(self, plate_id):
         self.correction = IllumCorrection()
-        self.images = []
+        self.images = ImageColumns()
         self.date = None
         self.wells = {}
         self.plate_id = plate_id
@@ -129,30 +328,38 @@ class Plate(CSVAnalysisContainer):  # pylint: disable=too-many-instance-attribut
         Add profile path to this plate
         """
         path = s3_obj.path
-        for profile in CONFIG["profiles"]:
-            if path.endswith(f"{self.plate_id}_{profile}.csv.gz") or path.endswith(
-                f"{self.plate_id}_{profile}.csv"
-            ):
-
+        for profile, suffixes in profile_suffixes(self.plate_id):
+            if path.endswith(suffixes):
                 if profile in self.profiles:
-                    raise ValueError(
-                        f"Duplicated profile for {profile}: {self.profiles[profile]}, {path}"
-                    )
-                self.profiles[profile] = s3_obj
-                return
-            if path.endswith(f"{self.plate_id}.csv.gz") or path.endswith(
-                f"{self.plate_id}.csv"
-            ):
-
-                profile = "default"
-                if profile in self.profiles:
-                    raise ValueError(
-                        f"Duplicated profile for {profile}: {self.profiles[profile]}, {path}"
+                    raise DuplicateError(
+                        "profile", profile, self.profiles[profile], s3_obj
                     )
                 self.profiles[profile] = s3_obj
                 return
         raise ValueError(f"Profile is not valid for plate {self.plate_id}: {path}")
 
+    def merge(self, other, conflicts: list):
+        """Merge a plate with the same ID parsed from a later part of the
+        listing"""
+        self.correction.merge(other.correction, conflicts)
+        self.images.extend(other.images)
+        for well_id, well in other.wells.items():
+            if well_id in self.wells:
+                self.wells[well_id].merge(well, conflicts)
+            else:
+                self.wells[well_id] = well
+        for attr in (
+            "date",
+            "backend_csv",
+            "backend_sqlite",
+            "load_data_with_illum",
+            "load_data_csv",
+        ):
+            if (value := getattr(other, attr)) is not None:
+                setattr(self, attr, value)
+        merge_unique(self.add_profile, other.profiles.values(), conflicts)
+        self.merge_csv_files(other, conflicts)
+
     def to_dict(self):
         """Serialize this plate in a shallow dict"""
         props = {
@@ -173,6 +380,8 @@ class Plate(CSVAnalysisContainer):  # pylint: disable=too-many-instance-attribut
 class Well(CSVAnalysisContainer):
     """Well"""
 
+    __slots__ = ("well_id", "_sites")
+
     ID_REGEX = re.compile(r"^[a-zA-Z]{1,2}\d\d$")
 
     def __init__(self, well_id):
@@ -196,6 +405,16 @@ class Well(CSVAnalysisContainer):
                     site.csv_files = self.csv_files
         return self._sites
 
+    def merge(self, other, conflicts: list):
+        """Merge a well with the same ID parsed from a later part of the
+        listing"""
+        for site_id, site in other._sites.items():
+            if site_id in self._sites:
+                self._sites[site_id].merge(site, conflicts)
+            else:
+                self._sites[site_id] = site
+        self.merge_csv_files(other, conflicts)
+
     def to_dict(self):
         """Serialize this well in a shallow dict"""
         props = {
@@ -215,6 +434,14 @@ class Well(CSVAnalysisContainer):
 class Site(CSVAnalysisContainer):
     """Site"""
 
+    __slots__ = (
+        "site_id",
+        "cell_outline",
+        "nuclei_outline",
+        "mito_outline",
+        "mito_obj_outline",
+    )
+
     def __init__(self, site_id):
         self.site_id = site_id
         self.cell_outline = None
@@ -223,6 +450,19 @@ class Site(CSVAnalysisContainer):
         self.mito_obj_outline = None
         super().__init__()
 
+    def merge(self, other, conflicts: list):
+        """Merge a site with the same ID parsed from a later part of the
+        listing"""
+        for attr in (
+            "cell_outline",
+            "nuclei_outline",
+            "mito_outline",
+            "mito_obj_outline",
+        ):
+            if (value := getattr(other, attr)) is not None:
+                setattr(self, attr, value)
+        self.merge_csv_files(other, conflicts)
+
     def to_dict(self):
         """Serialize this site in a shallow dict"""
         props = {
@@ -243,6 +483,7 @@ class IllumCorrection:
     """
 
     CHANNELS = CONFIG["illumination_channels"]
+    CHANNEL_SUFFIXES = tuple((channel, f"{channel}.npy") for channel in CHANNELS)
 
     def __init__(self):
         self.resources = {}
@@ -256,16 +497,20 @@ class IllumCorrection:
             raise ValueError(
                 "Invalid format for Illumination Correction. Expected .npy"
             )
-        for channel in self.CHANNELS:
-            if path.endswith(f"{channel}.npy"):
+        for channel, suffix in self.CHANNEL_SUFFIXES:
+            if path.endswith(suffix):
                 if channel in self.resources:
-                    raise ValueError(
-                        f"Duplicated correction for {channel}: {self.resources[channel]}, {path}"
+                    raise DuplicateError(
+                        "correction", channel, self.resources[channel], s3_obj
                     )
                 self.resources[channel] = s3_obj
                 return
         raise ValueError(f"Channel is not valid for Illumination: {path}")
 
+    def merge(self, other, conflicts: list):
+        """Add correction files from another object of the same plate"""
+        merge_unique(self.add_npy, other.resources.values(), conflicts)
+
 
 class Dataset:
     """Object representing all the data from a source"""
@@ -289,10 +534,26 @@ class Dataset:
         """Add a new metadata resource"""
         self._metadata.append(s3_obj)
 
+    @property
+    def metadata(self):
+        """Return the external metadata resources"""
+        return list(self._metadata)
+
     def has_batch(self, batch_id):
         """Check if batch exists in this dataset"""
         return batch_id in self._batches
 
+    def merge(self, other, conflicts: list):
+        """Merge a dataset with the same ID parsed from a later part of the
+        listing. The DuplicateError of the objects that a serial parse would
+        have rejected are appended to `conflicts`"""
+        self._metadata.extend(other._metadata)
+        for batch_id, batch in other._batches.items():
+            if batch_id in self._batches:
+                self._batches[batch_id].merge(batch, conflicts)
+            else:
+                self._batches[batch_id] = batch
+
     @property
     def batches(self):
         """Return all batches"""
@@ -0,0 +1,232 @@
+"""
+Compare `aws ls` listings to rebuild only the batches that changed
+"""
+import csv
+import os
+import re
+import mmap
+import orjson
+import pandas as pd
+from jump.io import serialize
+from jump.parsing import parse, batch_key
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+# (dataset_id, batch_id) of the canonical lines, as `batch_key` would return
+# them. Lines that do not match are resolved with `batch_key`
+BATCH_KEY_RGX = re.compile(
+    r"^[^ ]+ +[^ ]+ +[0-9]+ +[^/]*/(?P<dataset>[^/]*)/(?:"
+    r"images/(?P<images>[^/]*)/"
+    r"|workspace/(?:"
+    r"(?ai:analysis|profiles)/(?P<plates>[^/]*)/"
+    r"|(?ai:backend|load_data_csv)/(?P<files>[^/]*)/"
+    r"|(?ai:metadata)/platemaps/(?P<platemaps>[^/]*)/"
+    r"))"
+)
+# Start of each batch in the json files written by `jump.io`. Quotes within
+# strings are escaped, so this can only be a batch
+BATCH_START_RGX = re.compile(rb'\{"batch_id":("(?:[^"\\]|\\.)*")')
+
+
+def read_entries(filepath):
+    """Yield the lines of a listing without line breaks, skipping the
+    .DS_Store objects as create_structure does"""
+    with open(filepath, "r", encoding="utf8") as fread:
+        for line in fread:
+            if "DS_Store" not in line:
+                yield line.rstrip("\n")
+
+
+def line_path(line):
+    """Return the path of the object in a line of the listing, or None if the
+    line can not be parsed"""
+    try:
+        return parse(line)[2]
+    except ValueError:
+        return None
+
+
+def line_batch_key(line):
+    """Return the (dataset_id, batch_id) of the batch a line of the listing
+    belongs to, or None"""
+    if "//" not in line and (match := BATCH_KEY_RGX.match(line)):
+        return match["dataset"], match[match.lastindex]
+    if (path := line_path(line)) is None:
+        return None
+    return batch_key(path)
+
+
+def diff_listings(old_file, new_file):
+    """
+    Yield (status, line) for the objects added, removed or changed (i.e.
+    different size or date) in the `new_file` listing with respect to
+    `old_file`. Both listings are streamed in a merge by path, `aws s3 ls`
+    sorts them by key. Unsorted listings only yield more changes than needed.
+    """
+    old_lines, new_lines = read_entries(old_file), read_entries(new_file)
+    old, new = next(old_lines, None), next(new_lines, None)
+    while old is not None or new is not None:
+        if old == new:
+            old, new = next(old_lines, None), next(new_lines, None)
+            continue
+        old_path = None if old is None else line_path(old) or old
+        new_path = None if new is None else line_path(new) or new
+        if new is None or (old is not None and old_path < new_path):
+            yield REMOVED, old
+            old = next(old_lines, None)
+        elif old is None or new_path < old_path:
+            yield ADDED, new
+            new = next(new_lines, None)
+        else:
+            yield CHANGED, new
+            old, new = next(old_lines, None), next(new_lines, None)
+
+
+def read_errors(errorpath) -> dict:
+    """Read unknown_objects.csv as a dict from line to its error messages"""
+    errors = {}
+    if not errorpath.exists():
+        return errors
+    with errorpath.open("r", encoding="utf8", newline="") as fread:
+        reader = csv.reader(fread)
+        next(reader, None)
+        for line, message in reader:
+            errors.setdefault(line, []).append(message)
+    return errors
+
+
+def read_counts(countsfile) -> dict:
+    """Read image_counts.csv as a dict from batch_id to its rows"""
+    counts = {}
+    with open(countsfile, "r", encoding="utf8", newline="") as fread:
+        for row in csv.DictReader(fread):
+            counts.setdefault(row["batch_id"], []).append(row)
+    return counts
+
+
+def split_batches(data) -> dict:
+    """Split a structure json file written by `jump.io` into its batches.
+    Return a dict from batch_id to a memoryview of the serialized batch"""
+    view = memoryview(data)
+    starts = [
+        (match.start(), orjson.loads(match.group(1)))
+        for match in BATCH_START_RGX.finditer(data)
+    ]
+    # Batches are separated by ',' and the file ends with ']}'
+    ends = [start - 1 for start, _ in starts[1:]] + [len(data) - 2]
+    return {batch_id: view[start:end] for (start, batch_id), end in zip(starts, ends)}
+
+
+def write_batches(filepath, dataset_id, batches):
+    """Write serialized batches as a structure json file. The file is
+    replaced once it is complete, so the batches can come from it"""
+    tmppath = filepath.with_suffix(".tmp")
+    with open(tmppath, "wb") as fwriter:
+        fwriter.write(orjson.dumps({"dataset_id": dataset_id, "batches": []})[:-2])
+        for ix, batch in enumerate(batches):
+            if ix:
+                fwriter.write(b",")
+            fwriter.write(batch)
+        fwriter.write(b"]}")
+    os.replace(tmppath, filepath)
+
+
+def _status(old, new):
+    """Status of an element given its serialized versions"""
+    if old is None:
+        return ADDED
+    if new is None:
+        return REMOVED
+    if old != new:
+        return CHANGED
+    return None
+
+
+def compare_batches(batch_id, old, new):
+    """Return the status of a batch and the status of its plates that are
+    different, given the serialized versions of the batch"""
+    old_plates, new_plates = {}, {}
+    for serialized, batch in ((old_plates, old), (new_plates, new)):
+        if batch is not None:
+            for plate in orjson.loads(batch)["plates"]:
+                serialized[plate["plate_id"]] = orjson.dumps(plate)
+    plates = []
+    for plate_id in sorted(old_plates.keys() | new_plates.keys()):
+        status = _status(old_plates.get(plate_id), new_plates.get(plate_id))
+        if status:
+            plates.append(
+                {"batch_id": batch_id, "plate_id": plate_id, "status": status}
+            )
+    old = None if old is None else bytes(old)
+    return _status(old, new), plates
+
+
+def update_outputs(dirpath, dataset, batch_ids, affected: set):
+    """
+    Update the structure json files and image counts of a dataset. The
+    `affected` batches are serialized from `dataset`, which does not need to
+    contain the rest, and the others are copied from the previous files.
+    `batch_ids` is the order of the batches in the listing. Return the status
+    of the batches and plates that changed.
+    """
+    jsonfile = dirpath / "structure.json"
+    jsonext_file = dirpath / "structure_extensive.json"
+    countsfile = dirpath / "image_counts.csv"
+    dataset_id = dirpath.name
+    old_counts = read_counts(countsfile)
+    with open(jsonext_file, "rb") as fext, open(jsonfile, "rb") as fjson:
+        old_ext = split_batches(mmap.mmap(fext.fileno(), 0, access=mmap.ACCESS_READ))
+        old_json = split_batches(mmap.mmap(fjson.fileno(), 0, access=mmap.ACCESS_READ))
+
+        ext_batches, json_batches, counts = [], [], []
+        batch_status, plate_status = [], []
+        for batch_id in batch_ids:
+            if batch_id in affected:
+                if dataset is None or not dataset.has_batch(batch_id):
+                    # Its lines do not create it anymore
+                    continue
+                extensive, compact, batch_counts = serialize(
+                    dataset.get_batch(batch_id), dataset_id
+                )
+                status, plates = compare_batches(
+                    batch_id, old_ext.get(batch_id), extensive
+                )
+                if status:
+                    batch_status.append({"batch_id": batch_id, "status": status})
+                plate_status.extend(plates)
+            elif batch_id in old_ext:
+                extensive, compact = old_ext[batch_id], old_json[batch_id]
+                batch_counts = old_counts.get(batch_id, [])
+            else:
+                # Lines of this batch did not create it in the previous run
+                continue
+            ext_batches.append(extensive)
+            json_batches.append(compact)
+            counts.extend(batch_counts)
+
+        written = {batch_id for batch_id in batch_ids if batch_id not in affected}
+        if dataset is not None:
+            written |= {batch.batch_id for batch in dataset.batches}
+        for batch_id in sorted(old_ext.keys() - written):
+            status, plates = compare_batches(batch_id, old_ext[batch_id], None)
+            batch_status.append({"batch_id": batch_id, "status": status})
+            plate_status.extend(plates)
+
+        write_batches(jsonext_file, dataset_id, ext_batches)
+        write_batches(jsonfile, dataset_id, json_batches)
+    pd.DataFrame(counts).to_csv(countsfile, index=False)
+    return batch_status, plate_status
+
+
+def write_delta(deltafile, dataset_id, changes: dict, batches, plates):
+    """Write the objects, batches and plates that changed to a json file"""
+    delta = {
+        "dataset_id": dataset_id,
+        "objects": changes,
+        "batches": batches,
+        "plates": plates,
+    }
+    with open(deltafile, "wb") as fwriter:
+        fwriter.write(orjson.dumps(delta, option=orjson.OPT_INDENT_2))
@@ -0,0 +1,140 @@
+"""
+Process pool shared by every parallel step of a run
+"""
+import atexit
+import mmap
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import pandas as pd
+from tqdm.auto import tqdm
+
+_executor = None
+_workers = None
+# Frames returned by the workers are written here, in memory if possible
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+ALIGNMENT = 64
+
+
+def shared_executor(workers=None) -> ProcessPoolExecutor:
+    """Process pool of `workers` processes, by default one per core. It is
+    created on the first call and reused by the next ones, so its processes
+    (and what they cached) are kept across batches and datasets"""
+    global _executor, _workers  # pylint: disable=global-statement
+    if _executor is None or workers != _workers:
+        shutdown()
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _workers = workers
+    return _executor
+
+
+def shutdown():
+    """Stop the shared process pool, if any"""
+    global _executor  # pylint: disable=global-statement
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+atexit.register(shutdown)
+
+
+def map_largest_first(func, *iterables, sizes, workers=None, **tqdm_kwargs) -> list:
+    """
+    Return `[func(*args) for args in zip(*iterables)]`, computed in the shared
+    process pool. Tasks are submitted one at a time from the largest to the
+    smallest of `sizes`, so that a large task does not start last and keep
+    the rest of the processes idle.
+    """
+    tasks = list(zip(*iterables))
+    if not tasks:
+        return []
+    order = sorted(range(len(tasks)), key=lambda ix: sizes[ix] or 0, reverse=True)
+    executor = shared_executor(workers)
+    futures = [None] * len(tasks)
+    try:
+        for ix in order:
+            futures[ix] = executor.submit(func, *tasks[ix])
+        for _ in tqdm(as_completed(futures), total=len(futures), **tqdm_kwargs):
+            pass
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            if future is not None:
+                future.cancel()
+        raise
+
+
+class SharedFrame:
+    """
+    File in shared memory with a frame returned by a worker. The frame is
+    pickled with protocol 5, so the arrays of its columns are written as they
+    are, after the pickle, and read back as views of the mapped file
+    """
+
+    __slots__ = ("path", "sizes")
+
+    def __init__(self, path: str, sizes: list):
+        self.path = path
+        self.sizes = sizes
+
+    @classmethod
+    def write(cls, frame: pd.DataFrame, folder: str) -> "SharedFrame":
+        """Write a frame in a new file of `folder`"""
+        buffers = []
+        data = pickle.dumps(frame, protocol=5, buffer_callback=buffers.append)
+        fd, path = tempfile.mkstemp(suffix=".pkl", dir=folder)
+        sizes = [len(data)]
+        with os.fdopen(fd, "wb") as f_out:
+            f_out.write(data)
+            for buffer in buffers:
+                raw = buffer.raw()
+                # Arrays start at aligned offsets
+                f_out.write(b"\0" * (-f_out.tell() % ALIGNMENT))
+                f_out.write(raw)
+                sizes.append(raw.nbytes)
+        return cls(path, sizes)
+
+    def read(self) -> pd.DataFrame:
+        """Map the file, without copying it, remove it and load the frame.
+        Pages are only copied if the frame is changed in place"""
+        with open(self.path, "rb") as f_in:
+            mapped = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_COPY)
+        os.unlink(self.path)
+        view = memoryview(mapped)
+        data = view[: self.sizes[0]]
+        buffers = []
+        offset = self.sizes[0]
+        for size in self.sizes[1:]:
+            offset += -offset % ALIGNMENT
+            buffers.append(view[offset : offset + size])
+            offset += size
+        return pickle.loads(data, buffers=buffers)
+
+
+def _shared_frame(func, folder, *args):
+    """Call `func` and write the frame it returns, if any, to `folder`"""
+    result = func(*args)
+    if isinstance(result, pd.DataFrame):
+        return SharedFrame.write(result, folder)
+    return result
+
+
+def map_frames(func, *iterables, sizes, **kwargs) -> list:
+    """
+    `map_largest_first` for functions returning DataFrames. They are sent
+    back through files in shared memory instead of the pipes of the pool,
+    and their arrays are not copied until they are concatenated or changed.
+    Other results are returned as they are.
+    """
+    with tempfile.TemporaryDirectory(prefix="jump-", dir=SHARED_DIR) as folder:
+        output = map_largest_first(
+            partial(_shared_frame, func, folder), *iterables, sizes=sizes, **kwargs
+        )
+        return [
+            result.read() if isinstance(result, SharedFrame) else result
+            for result in output
+        ]
@@ -0,0 +1,213 @@
+"""
+Index the parsed S3 objects in a SQLite database
+"""
+import os
+import re
+import sqlite3
+from pathlib import Path
+
+from jump import dao
+
+# Kinds of objects, by where they are in the folder structure
+PLATEMAP = "platemap"
+BARCODE_PLATEMAP = "barcode_platemap"
+EXTERNAL_METADATA = "external_metadata"
+BACKEND = "backend"
+LOAD_DATA = "load_data"
+ILLUM = "illum"
+PROFILE = "profile"
+ANALYSIS = "analysis"
+OUTLINE = "outline"
+IMAGE = "image"
+OUTLINES = ("cell_outline", "nuclei_outline", "mito_outline", "mito_obj_outline")
+
+COLUMNS = (
+    "source",
+    "batch",
+    "plate",
+    "well",
+    "site",
+    "kind",
+    "name",
+    "path",
+    "size",
+    "date",
+)
+SCHEMA = """
+CREATE TABLE objects (
+    source TEXT NOT NULL,
+    batch TEXT,
+    plate TEXT,
+    well TEXT,
+    site TEXT,
+    kind TEXT NOT NULL,
+    name TEXT,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE TABLE plates (source TEXT NOT NULL, batch TEXT NOT NULL, plate TEXT NOT NULL);
+"""
+# Indexes and totals are created once the objects are inserted, which is
+# faster than updating them on every insert. Totals answer the aggregations
+# by plate or batch without scanning all the objects
+INDEXES = """
+CREATE INDEX objects_source_batch_plate_kind ON objects (source, batch, plate, kind);
+CREATE INDEX objects_kind_name ON objects (kind, name);
+CREATE UNIQUE INDEX plates_source_batch_plate ON plates (source, batch, plate);
+CREATE TABLE totals AS
+SELECT source, batch, plate, kind, COUNT(*) AS num_objects, SUM(size) AS bytes
+FROM objects GROUP BY source, batch, plate, kind;
+CREATE INDEX totals_source_batch_plate_kind ON totals (source, batch, plate, kind);
+"""
+INSERT = f"INSERT INTO objects VALUES ({', '.join('?' * len(COLUMNS))})"
+
+# Named queries of query_index.py. Parameters are given as :name
+QUERIES = {
+    "bytes_per_batch": (
+        "SELECT source, batch, kind, SUM(num_objects) AS num_objects, "
+        "SUM(bytes) AS bytes FROM totals "
+        "GROUP BY source, batch, kind ORDER BY source, batch, kind"
+    ),
+    "images_per_plate": (
+        "SELECT plates.source, plates.batch, plates.plate, "
+        "COALESCE(totals.num_objects, 0) AS num_images, "
+        "COALESCE(totals.bytes, 0) AS bytes "
+        "FROM plates LEFT JOIN totals ON totals.source = plates.source "
+        "AND totals.batch = plates.batch AND totals.plate = plates.plate "
+        f"AND totals.kind = '{IMAGE}' "
+        "ORDER BY plates.source, plates.batch, plates.plate"
+    ),
+    "missing_illum": (
+        "SELECT source, batch, plate FROM plates WHERE NOT EXISTS ("
+        "SELECT 1 FROM objects WHERE objects.source = plates.source "
+        "AND objects.batch = plates.batch AND objects.plate = plates.plate "
+        f"AND objects.kind = '{ILLUM}' AND objects.name = :channel) ORDER BY source, batch, plate"
+    ),
+    "missing_profile": (
+        "SELECT source, batch, plate FROM plates WHERE NOT EXISTS ("
+        "SELECT 1 FROM objects WHERE objects.source = plates.source "
+        "AND objects.batch = plates.batch AND objects.plate = plates.plate "
+        f"AND objects.kind = '{PROFILE}' AND objects.name = :profile) ORDER BY source, batch, plate"
+    ),
+}
+
+PARAM_RGX = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+def missing_params(sql: str, params: dict) -> list:
+    """Parameters of a named query that are not in `params`. Other queries
+    are not checked"""
+    names = PARAM_RGX.findall(QUERIES.get(sql, ""))
+    return sorted(set(names) - set(params))
+
+
+def plate_objects(plate: dao.Plate):
+    """Yield (well_id, site_id, kind, name, s3_obj) for every object of a
+    plate"""
+    for name in ("backend_csv", "backend_sqlite"):
+        if (s3_obj := getattr(plate, name)) is not None:
+            yield None, None, BACKEND, name, s3_obj
+    for name in ("load_data_with_illum", "load_data_csv"):
+        if (s3_obj := getattr(plate, name)) is not None:
+            yield None, None, LOAD_DATA, name, s3_obj
+    for channel, s3_obj in plate.correction.resources.items():
+        yield None, None, ILLUM, channel, s3_obj
+    for profile, s3_obj in plate.profiles.items():
+        yield None, None, PROFILE, profile, s3_obj
+    for name, s3_obj in plate.csv_files.items():
+        yield None, None, ANALYSIS, name, s3_obj
+    for well in plate.wells.values():
+        well_id = well.well_id
+        for name, s3_obj in well.csv_files.items():
+            yield well_id, None, ANALYSIS, name, s3_obj
+        for site in well.sites.values():
+            # Sites without their own csv files share the ones of the well
+            if site.csv_files is not well.csv_files:
+                for name, s3_obj in site.csv_files.items():
+                    yield well_id, site.site_id, ANALYSIS, name, s3_obj
+            for name in OUTLINES:
+                if (s3_obj := getattr(site, name)) is not None:
+                    yield well_id, site.site_id, OUTLINE, name, s3_obj
+    for s3_obj in plate.images:
+        yield None, None, IMAGE, None, s3_obj
+
+
+def batch_objects(batch: dao.Batch):
+    """Yield (plate_id, well_id, site_id, kind, name, s3_obj) for every object
+    of a batch"""
+    for s3_obj in batch.platemaps:
+        yield None, None, None, PLATEMAP, None, s3_obj
+    if batch.barcode_platemap is not None:
+        yield None, None, None, BARCODE_PLATEMAP, None, batch.barcode_platemap
+    for plate_id, plate in batch.plates.items():
+        for obj in plate_objects(plate):
+            yield plate_id, *obj
+
+
+def batch_rows(source: str, batch: dao.Batch):
+    """Yield a row of the objects table for every object of a batch"""
+    batch_id = batch.batch_id
+    for plate_id, well_id, site_id, kind, name, s3_obj in batch_objects(batch):
+        yield (
+            source,
+            batch_id,
+            plate_id,
+            well_id,
+            site_id,
+            kind,
+            name,
+            s3_obj.path,
+            s3_obj.size,
+            s3_obj.date,
+        )
+
+
+def write_index(dataset: dao.Dataset, dbpath):
+    """
+    Write the objects of a dataset to a SQLite database, replacing it if it
+    exists. Objects are inserted batch by batch, each one in a transaction,
+    and the database is moved to `dbpath` once it is complete.
+    """
+    dbpath = Path(dbpath)
+    tmppath = dbpath.with_suffix(".tmp")
+    tmppath.unlink(missing_ok=True)
+    source = dataset.dataset_id
+    conn = sqlite3.connect(tmppath)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(SCHEMA)
+        with conn:
+            conn.executemany(
+                INSERT,
+                (
+                    (source, None, None, None, None, EXTERNAL_METADATA, None)
+                    + (obj.path, obj.size, obj.date)
+                    for obj in dataset.metadata
+                ),
+            )
+        for batch in dataset.batches:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO plates VALUES (?, ?, ?)",
+                    ((source, batch.batch_id, plate_id) for plate_id in batch.plates),
+                )
+                conn.executemany(INSERT, batch_rows(source, batch))
+        conn.executescript(INDEXES)
+    finally:
+        conn.close()
+    os.replace(tmppath, dbpath)
+
+
+def query(dbpath, sql: str, params=None):
+    """Run a query in a database written by `write_index`. Return the names
+    of the columns and the rows"""
+    uri = f"{Path(dbpath).resolve().as_uri()}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        cursor = conn.execute(QUERIES.get(sql, sql), params or {})
+        columns = [column[0] for column in cursor.description or ()]
+        return columns, cursor.fetchall()
+    finally:
+        conn.close()
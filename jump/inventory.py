@@ -0,0 +1,163 @@
+"""
+Read the objects of an S3 Inventory report
+"""
+import time
+from pathlib import Path
+from urllib.parse import unquote_plus
+
+import numpy as np
+import orjson
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pa_csv
+    from pyarrow import parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+
+FORMATS = "CSV", "Parquet"
+# Columns of the Parquet data files, by the name used in the fileSchema of the
+# CSV ones
+PARQUET_COLUMNS = {
+    "Bucket": "bucket",
+    "Key": "key",
+    "Size": "size",
+    "LastModifiedDate": "last_modified_date",
+    "IsLatest": "is_latest",
+    "IsDeleteMarker": "is_delete_marker",
+}
+
+
+def read_manifest(manifest) -> dict:
+    """Read the manifest.json of an inventory report"""
+    with open(manifest, "rb") as fread:
+        manifest = orjson.loads(fread.read())
+    if manifest.get("fileFormat") not in FORMATS:
+        raise ValueError(
+            f"Invalid inventory format: {manifest.get('fileFormat')}. "
+            f"Expected one of {FORMATS}"
+        )
+    return manifest
+
+
+def data_files(manifest_path: Path, manifest: dict) -> list[Path]:
+    """
+    Local paths of the data files of an inventory report. Reports are
+    downloaded with their layout in the destination bucket, i.e. the data
+    files of .../{config_id}/{date}/manifest.json are in .../{config_id}/data/
+    """
+    data_dir = Path(manifest_path).parent.parent / "data"
+    return [data_dir / Path(file["key"]).name for file in manifest["files"]]
+
+
+def read_csv(filepath, schema: list[str]):
+    """Read a gzipped CSV data file, whose columns are given by the
+    fileSchema of the manifest"""
+    columns = [name for name in PARQUET_COLUMNS if name in schema]
+    types = {
+        "Key": pa.string(),
+        "Size": pa.int64(),
+        "LastModifiedDate": pa.timestamp("ms", "UTC"),
+        "IsLatest": pa.bool_(),
+        "IsDeleteMarker": pa.bool_(),
+    }
+    table = pa_csv.read_csv(
+        filepath,
+        read_options=pa_csv.ReadOptions(column_names=schema),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=columns,
+            column_types={name: types[name] for name in columns if name in types},
+        ),
+    )
+    table = table.rename_columns([PARQUET_COLUMNS[name] for name in columns])
+    # Keys are url-encoded in the CSV data files
+    keys = table["key"]
+    if pc.any(pc.match_substring_regex(keys, "[%+]")).as_py():
+        keys = pa.array([unquote_plus(key) for key in keys.to_pylist()], pa.string())
+        table = table.set_column(table.column_names.index("key"), "key", keys)
+    return table
+
+
+def read_parquet(filepath):
+    """Read a Parquet data file"""
+    names = pq.read_schema(filepath).names
+    return pq.read_table(
+        filepath, columns=[name for name in PARQUET_COLUMNS.values() if name in names]
+    )
+
+
+def current_objects(table, prefix: str = ""):
+    """Keep the current version of the objects whose key starts with `prefix`"""
+    mask = pc.starts_with(table["key"], prefix)
+    if "is_latest" in table.column_names:
+        mask = pc.and_(mask, pc.fill_null(table["is_latest"], True))
+    if "is_delete_marker" in table.column_names:
+        mask = pc.and_not(mask, pc.fill_null(table["is_delete_marker"], False))
+    return table.filter(mask).select(["key", "size", "last_modified_date"])
+
+
+def local_epochs(dates) -> np.ndarray:
+    """
+    Seconds since epoch of the local time of each date, as the dates printed
+    by `aws s3 ls` are parsed. The UTC offset is computed once for every hour
+    in the dates. Some zones change it at half past or a quarter past, so
+    the dates in an hour whose offset changes are converted one by one.
+    """
+    seconds = pc.cast(dates, pa.timestamp("s", "UTC"), safe=False)
+    epochs = seconds.cast(pa.int64()).to_numpy()
+    hours, index = np.unique(epochs // 3600, return_inverse=True)
+    starts = hours * 3600
+    offsets = np.array(
+        [time.localtime(start).tm_gmtoff for start in starts.tolist()],
+        dtype=np.int64,
+    )
+    ends = np.array(
+        [time.localtime(start + 3599).tm_gmtoff for start in starts.tolist()],
+        dtype=np.int64,
+    )
+    local = epochs + offsets[index]
+    if (changed := (offsets != ends)[index]).any():
+        local[changed] = [
+            epoch + time.localtime(epoch).tm_gmtoff
+            for epoch in epochs[changed].tolist()
+        ]
+    return local
+
+
+def read_inventory(manifest_path, prefix: str = ""):
+    """
+    Read the current objects of an inventory report whose key starts with
+    `prefix`. Return a table with their key, size and epoch, i.e. the seconds
+    since epoch of their local last modified date, sorted by key as
+    `aws s3 ls --recursive` lists them.
+    """
+    if pa is None:
+        raise ImportError(
+            "pyarrow is required to read S3 inventories. "
+            "Install it with `pip install pyarrow`"
+        )
+    manifest = read_manifest(manifest_path)
+    tables = []
+    for filepath in data_files(manifest_path, manifest):
+        if manifest["fileFormat"] == "CSV":
+            schema = [name.strip() for name in manifest["fileSchema"].split(",")]
+            table = read_csv(filepath, schema)
+        else:
+            table = read_parquet(filepath)
+        tables.append(current_objects(table, prefix))
+    table = pa.concat_tables(tables).combine_chunks()
+    table = table.take(pc.sort_indices(table, [("key", "ascending")]))
+    return pa.table(
+        {
+            "key": table["key"],
+            "size": table["size"].cast(pa.int64()),
+            "epoch": local_epochs(table["last_modified_date"]),
+        }
+    )
+
+
+def iter_objects(table, batch_size: int = 65536):
+    """Yield (key, size, epoch) for every row of a `read_inventory` table"""
+    for batch in table.to_batches(batch_size):
+        yield from zip(*(column.to_pylist() for column in batch.columns))
@@ -1,6 +1,8 @@
 """
 Read and write objects
 """
+from io import BytesIO
+from pathlib import Path
 import orjson
 import pandas as pd
 from jump import dao
@@ -22,6 +24,15 @@ def dropna(obj):
     return obj
 
 
+def default(obj):
+    """Serialize the objects that orjson does not support natively"""
+    if isinstance(obj, dao.S3Object):
+        return obj.to_dict()
+    if isinstance(obj, dao.ImageColumns):
+        return obj.to_list()
+    raise TypeError
+
+
 def serialize_plate(plate: dao.Plate) -> dict:
     """Serialize plate with wells and images"""
     plate_props = plate.to_dict()
@@ -37,42 +48,218 @@ def serialize_plate(plate: dao.Plate) -> dict:
     return plate_props
 
 
-def to_json(dataset: dao.Dataset, jsonfile, jsonext_file, countsfile):
-    """Export a dataset to json file"""
+# Keys of the batches and plates in structure.json filled by each subtree
+SUBTREE_KEYS = {
+    "images": ("images",),
+    "illum": ("correction_files",),
+    "analysis": ("containers", "wells"),
+    "backend": ("backend_csv", "backend_sqlite"),
+    "load_data": ("load_data_with_illum", "load_data_csv"),
+    "metadata": ("platemaps", "barcode_platemap"),
+    "profiles": ("profiles",),
+}
 
-    structure = {"dataset_id": dataset.dataset_id, "batches": []}
-    counts = []
-    for batch in dataset.batches:
-        plates = []
-        for plate_id, plate in batch.plates.items():
-            counts.append(
-                {
-                    "dataset_id": dataset.dataset_id,
-                    "batch_id": batch.batch_id,
-                    "plate_id": plate_id,
-                    "num_images": len(plate.images),
-                }
-            )
-            plates.append(serialize_plate(plate))
+
+def excluded_keys(subtrees=None) -> set:
+    """Keys of structure.json that are not filled when only `subtrees` are
+    parsed"""
+    if subtrees is None:
+        return set()
+    return {
+        key
+        for subtree, keys in SUBTREE_KEYS.items()
+        if subtree not in subtrees
+        for key in keys
+    }
+
+
+def prune_schema(schema: dict, subtrees=None) -> dict:
+    """Copy of the schema for a structure.json that only contains `subtrees`"""
+    excluded = excluded_keys(subtrees)
+    schema = orjson.loads(orjson.dumps(schema))
+    for name in ("batch", "plate"):
+        definition = schema["$defs"][name]
+        for key in excluded:
+            definition["properties"].pop(key, None)
+        if "required" in definition:
+            definition["required"] = [
+                key for key in definition["required"] if key not in excluded
+            ]
+    return schema
+
+
+class StructureWriter:
+    """
+    Write structure_extensive.json and structure.json at the same time, batch
+    by batch and plate by plate, so only one plate is serialized at a time.
+    The images of the plates are written in chunks. `ndjson_file`, if given,
+    gets every batch of structure_extensive.json in its own line.
+    """
+
+    IMAGES_CHUNK_SIZE = 4096
+
+    def __init__(self, dataset_id, jsonfile, jsonext_file, ndjson_file=None):
+        self.dataset_id = dataset_id
+        self._files = []
+        self._json = self._open(jsonfile)
+        self._extensive = [self._open(jsonext_file)]
+        self._ndjson = None
+        if ndjson_file is not None:
+            self._ndjson = self._open(ndjson_file)
+            self._extensive.append(self._ndjson)
+        self._num_batches = 0
+        head = orjson.dumps({"dataset_id": dataset_id, "batches": []})[:-2]
+        self._json.write(head)
+        self._extensive[0].write(head)
+
+    def _open(self, filepath):
+        if hasattr(filepath, "write"):
+            return filepath
+        fwriter = open(filepath, "wb")  # pylint: disable=consider-using-with
+        self._files.append(fwriter)
+        return fwriter
+
+    def _write_extensive(self, data):
+        for fwriter in self._extensive:
+            fwriter.write(data)
+
+    def _write(self, data):
+        self._json.write(data)
+        self._write_extensive(data)
+
+    def write_batch(self, batch: dao.Batch, excluded=()) -> list:
+        """Write a batch, leaving out the `excluded` keys and the None
+        values. Return the image counts of its plates"""
+        if self._num_batches:
+            self._json.write(b",")
+            self._extensive[0].write(b",")
+        self._num_batches += 1
 
         batch_props = batch.to_dict()
-        batch_props["plates"] = plates
-        structure["batches"].append((batch_props))
-
-    logger.info("dropping None values...")
-    structure = dropna(structure)
-    logger.info("writing structure_extensive object...")
-    with open(jsonext_file, "wb") as fwriter:
-        fwriter.write(orjson.dumps(structure))
-    logger.info("structure_extensive object saved.")
-
-    # remove wells and images to get a smaller json
-    for batch in structure["batches"]:
-        for plate_props in batch["plates"]:
-            del plate_props["wells"]
-            del plate_props["images"]
-    with open(jsonfile, "wb") as fwriter:
-        fwriter.write(orjson.dumps(structure))
+        for key in excluded:
+            batch_props.pop(key, None)
+        batch_props = dropna(batch_props)
+        batch_props["plates"] = []
+        self._write(orjson.dumps(batch_props, default=default)[:-2])
+
+        counts = []
+        for ix, plate in enumerate(batch.plates.values()):
+            if ix:
+                self._write(b",")
+            counts.append(self.write_plate(batch.batch_id, plate, excluded))
+        self._write(b"]}")
+        if self._ndjson is not None:
+            self._ndjson.write(b"\n")
+        return counts
+
+    def write_plate(self, batch_id, plate: dao.Plate, excluded=()) -> dict:
+        """Write a plate of the current batch and return its image count"""
+        plate_props = serialize_plate(plate)
+        for key in excluded:
+            plate_props.pop(key, None)
+        images = plate_props.pop("images", None)
+        plate_props = dropna(plate_props)
+        wells = plate_props.pop("wells", None)
+        self._json.write(orjson.dumps(plate_props, default=default))
+
+        if wells is not None:
+            plate_props["wells"] = wells
+        if images is None:
+            self._write_extensive(orjson.dumps(plate_props, default=default))
+        else:
+            plate_props["images"] = []
+            self._write_extensive(orjson.dumps(plate_props, default=default)[:-2])
+            self._write_images(images)
+            self._write_extensive(b"]}")
+        return {
+            "dataset_id": self.dataset_id,
+            "batch_id": batch_id,
+            "plate_id": plate_props["plate_id"],
+            "num_images": 0 if images is None else len(images),
+        }
+
+    def _write_images(self, images):
+        chunk = []
+        separator = b""
+        for s3_obj in images:
+            chunk.append(s3_obj.to_dict())
+            if len(chunk) == self.IMAGES_CHUNK_SIZE:
+                self._write_extensive(separator + orjson.dumps(chunk)[1:-1])
+                chunk.clear()
+                separator = b","
+        if chunk:
+            self._write_extensive(separator + orjson.dumps(chunk)[1:-1])
+
+    def close(self):
+        """Terminate the json arrays and close the files"""
+        self._json.write(b"]}")
+        self._extensive[0].write(b"]}")
+        for fwriter in self._files:
+            fwriter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def serialize(batch: dao.Batch, dataset_id):
+    """Serialize a batch as in structure_extensive.json and structure.json,
+    along with its image counts"""
+    extensive, compact = BytesIO(), BytesIO()
+    writer = StructureWriter(dataset_id, compact, extensive)
+    head = len(compact.getvalue())
+    counts = writer.write_batch(batch)
+    return extensive.getvalue()[head:], compact.getvalue()[head:], counts
+
+
+def to_json(
+    dataset: dao.Dataset,
+    jsonfile,
+    jsonext_file,
+    countsfile,
+    subtrees=None,
+    ndjson_file=None,
+):
+    """Export a dataset to json file. If `subtrees` is given, only their keys
+    are exported. Batches are written as they are serialized, see
+    `StructureWriter`"""
+
+    excluded = excluded_keys(subtrees)
+    counts = []
+    logger.info("writing structure objects...")
+    with StructureWriter(
+        dataset.dataset_id, jsonfile, jsonext_file, ndjson_file
+    ) as writer:
+        for batch in dataset.batches:
+            counts.extend(writer.write_batch(batch, excluded))
+    logger.info("structure objects saved.")
 
     counts = pd.DataFrame(counts)
     counts.to_csv(countsfile, index=False)
+
+
+def to_arrow(dataset: dao.Dataset, dirpath, subtrees=None):
+    """Export a dataset to a folder of Arrow IPC tables, see `jump.arrow`. If
+    `subtrees` is given, only their keys are exported"""
+    from jump.arrow import write_arrow  # pylint: disable=import-outside-toplevel
+
+    write_arrow(dataset, dirpath, excluded_keys(subtrees))
+
+
+def load_structure(path, lazy=False, extensive=False):
+    """
+    Load a structure json file, or a folder written by `to_arrow`. Folders
+    are loaded with the keys of structure.json or, if `extensive`, of
+    structure_extensive.json. If `lazy`, they are returned as an
+    `ArrowStructure` whose batches are read when they are accessed.
+    """
+    path = Path(path)
+    if path.is_dir():
+        from jump.arrow import ArrowStructure  # pylint: disable=import-outside-toplevel
+
+        structure = ArrowStructure(path, extensive)
+        return structure if lazy else structure.to_dict()
+    with open(path, "rb") as fread:
+        return orjson.loads(fread.read())
@@ -1,10 +1,12 @@
 """
 Functions to parse `aws ls` output into python objects
 """
+import io
+import os
 import re
 import datetime
 from jump.ptypes import S3Folder, ImageFolder, WorkspaceFolder, MetadataFolder
-from jump.dao import Dataset, S3Object, Well, Batch
+from jump.dao import Dataset, S3Object, Well, Batch, DATE_FORMAT, epoch_to_date
 
 BLANK_RGX = re.compile(r" +")
 DATE_RGX_POTS = (
@@ -48,34 +50,347 @@ def parse(line, date_as_string=True):
     return date, size, path
 
 
+def split_shards(filepath, num_shards: int) -> list[tuple[int, int]]:
+    """Split a file into `num_shards` contiguous byte ranges of similar size"""
+    size = os.path.getsize(filepath)
+    bounds = [size * i // num_shards for i in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_shard(filepath, start: int, end: int):
+    """Yield (offset, line) for every line of the file starting in the
+    [start, end) byte range. Lines are split as a text-mode file would do"""
+    with open(filepath, "rb") as fread:
+        if start > 0:
+            # Skip the line that started in the previous shard
+            fread.seek(start - 1)
+            fread.readline()
+        offset = fread.tell()
+        while offset < end:
+            raw = fread.readline()
+            if not raw:
+                break
+            text = raw.decode("utf8")
+            if "\r" in text:
+                # Mimic universal newlines
+                for line in io.StringIO(text, newline=None):
+                    yield offset, line
+            else:
+                yield offset, text
+            offset += len(raw)
+
+
 datasets = {}
 
+# Objects that can take a slot of their container (a profile, csv file or
+# correction), i.e. the ones that can be rejected when merging shards
+SLOT_SUFFIXES = ".csv", ".csv.gz", ".npy"
+
+# Max number of image folders whose plate is memoized
+IMAGE_FOLDER_CACHE_SIZE = 1024
+# Folder of image objects -> (Dataset, Plate) the folder was resolved to
+image_folders = {}
+
+
+def reset(dataset_id=None):
+    """Clear the parsed datasets, or only `dataset_id`, and forget the image
+    folders memoized for them, so that their objects can be freed"""
+    if dataset_id is None:
+        datasets.clear()
+    else:
+        datasets.pop(dataset_id).clear()
+    image_folders.clear()
+
+
+def merge_datasets(shard: dict) -> list:
+    """Merge the datasets parsed from a later shard of a listing into the
+    module level `datasets`. Return the DuplicateError of the objects that a
+    serial parse would have rejected"""
+    conflicts = []
+    for dataset_id, dataset in shard.items():
+        if dataset_id in datasets:
+            datasets[dataset_id].merge(dataset, conflicts)
+        else:
+            datasets[dataset_id] = dataset
+    return conflicts
+
+
+# A folder or file name, and the end of one
+_NAME = "[^/]*"
+_END = "(?:/|$)"
+
+# Top level subtrees of the folder structure and the path prefix (after
+# <bucket>/<dataset_id>/) of their objects
+SUBTREES = {
+    "images": f"images/{_NAME}/images/",
+    "illum": f"images/{_NAME}/illum/",
+    "analysis": "workspace/(?ai:analysis)/",
+    "backend": "workspace/(?ai:backend)/",
+    "load_data": "workspace/(?ai:load_data_csv)/",
+    "metadata": "workspace/(?ai:metadata)/",
+    "profiles": "workspace/(?ai:profiles)/",
+}
+# Match the raw `aws ls` lines and the paths of the subtrees that are not
+# parsed
+skip_rgx = None
+skip_path_rgx = None
+
+
+def select_subtrees(subtrees=None):
+    """
+    Restrict `process_line` and `process_object` to the objects in the given
+    subtrees (see SUBTREES). Objects from other subtrees are skipped before
+    being parsed. None selects all the subtrees.
+    """
+    global skip_rgx, skip_path_rgx  # pylint: disable=global-statement
+    skip_rgx = skip_path_rgx = None
+    if subtrees is None:
+        return
+    unknown = set(subtrees) - set(SUBTREES)
+    if unknown:
+        raise ValueError(f"Invalid subtrees: {sorted(unknown)}")
+    skipped = [prefix for name, prefix in SUBTREES.items() if name not in subtrees]
+    if not skipped:
+        return
+    path_pattern = f"{_NAME}/{_NAME}/(?:{'|'.join(skipped)})"
+    skip_rgx = re.compile(f"^[^ ]+ +[^ ]+ +[^ ]+ +{path_pattern}")
+    skip_path_rgx = re.compile(path_pattern)
+
+
+def _get_dataset(dataset_id) -> Dataset:
+    if dataset_id not in datasets:
+        datasets[dataset_id] = Dataset(dataset_id)
+    return datasets[dataset_id]
+
+
+def _get_batch(dataset_id, batch_id) -> Batch:
+    dataset = _get_dataset(dataset_id)
+    if not dataset.has_batch(batch_id):
+        dataset.add_batch(batch_id)
+    return dataset.get_batch(batch_id)
+
 
 def get_dataset(s3_obj) -> Dataset:
     """Get (or create) a dataset"""
     elems = s3_obj.path.split("/")
     # elems[0] expected to be jump
     dataset_id = elems[1]
-    if dataset_id not in datasets:
-        datasets[dataset_id] = Dataset(dataset_id)
-    return datasets[dataset_id]
+    return _get_dataset(dataset_id)
 
 
 def get_batch(batch_id, s3_obj: S3Object) -> Batch:
     """Get batch from a dataset"""
-    dataset = get_dataset(s3_obj)
-    if not dataset.has_batch(batch_id):
-        # date = extract_date(batch_id)
-        dataset.add_batch(batch_id)
-    return dataset.get_batch(batch_id)
+    # date = extract_date(batch_id)
+    return _get_batch(s3_obj.path.split("/")[1], batch_id)
+
+
+# Canonical layouts of the folder structure. A path matching any of them is
+# resolved to its route (the name of the outer group) and the ids it contains
+# in a single regex match, without splitting the path or building Enums.
+# Anything else goes through `process_path`, which raises the errors.
+ROUTE_PATTERNS = {
+    "illum": f"images/(?P<illum_batch>{_NAME})/illum/(?P<illum_plate>{_NAME}){_END}",
+    "image": f"images/(?P<image_batch>{_NAME})/images/(?P<image_folder>{_NAME}){_END}",
+    "analysis": (
+        f"workspace/(?ai:analysis)/(?P<analysis_batch>{_NAME})/"
+        f"(?P<analysis_plate>{_NAME})/analysis/(?P<analysis_dir>{_NAME})/"
+        f"(?P<analysis_subdir>{_NAME})(?:/(?P<analysis_file>{_NAME}))?{_END}"
+    ),
+    "backend": (
+        f"workspace/(?ai:backend)/(?P<backend_batch>{_NAME})/"
+        f"(?P<backend_plate>{_NAME}){_END}"
+    ),
+    "load_data": (
+        f"workspace/(?ai:load_data_csv)/(?P<load_data_batch>{_NAME})/"
+        f"(?P<load_data_plate>{_NAME}){_END}"
+    ),
+    "platemap": (
+        f"workspace/(?ai:metadata)/platemaps/(?P<platemap_batch>{_NAME})/"
+        f"(?P<platemap_kind>{_NAME}){_END}"
+    ),
+    "external_metadata": f"workspace/(?ai:metadata)/external_metadata{_END}",
+    "profile": (
+        f"workspace/(?ai:profiles)/(?P<profile_batch>{_NAME})/"
+        f"(?P<profile_plate>{_NAME}){_END}"
+    ),
+}
+PATH_RGX = re.compile(
+    f"^{_NAME}/(?P<dataset>{_NAME})/(?:"
+    + "|".join(f"(?P<{route}>{pattern})" for route, pattern in ROUTE_PATTERNS.items())
+    + ")"
+)
+
+
+def classify(path):
+    """
+    Resolve a path to its route in the folder structure. Return the route name
+    (e.g. 'image', 'profile') and a dict with the ids found in the path
+    (dataset, batch, plate, ...), or (None, {}) for non canonical paths.
+    """
+    match = PATH_RGX.match(path)
+    if not match:
+        return None, {}
+    route = match.lastgroup
+    prefix = f"{route}_"
+    ids = {"dataset": match["dataset"]}
+    for key, value in match.groupdict().items():
+        if key.startswith(prefix) and value is not None:
+            ids[key[len(prefix) :]] = value
+    return route, ids
+
+
+# Min number of elements after workspace/ for process_workspace to reach
+# get_batch, per workspace folder
+BATCH_PAYLOAD_SIZES = {
+    WorkspaceFolder.ANALYSIS.value: 3,
+    WorkspaceFolder.BACKEND.value: 2,
+    WorkspaceFolder.LOAD_DATA.value: 2,
+    WorkspaceFolder.PROFILES.value: 3,
+}
+
+
+def batch_key(path):
+    """
+    Return the (dataset_id, batch_id) of the batch that `process_line` creates
+    or updates when processing a path, or None if the path does not reach any
+    batch
+    """
+    elems = path.split("/")
+    if len(elems) < 4:
+        return None
+    if elems[2] == S3Folder.IMAGE.value:
+        return elems[1], elems[3]
+    if elems[2] != S3Folder.WORKSPACE.value:
+        return None
+    payload = elems[3:]
+    folder = payload[0].lower()
+    if folder == WorkspaceFolder.METADATA.value:
+        if len(payload) > 2 and payload[1] == MetadataFolder.PLATEMAPS.value:
+            return elems[1], payload[2]
+        return None
+    if len(payload) >= BATCH_PAYLOAD_SIZES.get(folder, len(payload) + 1):
+        return elems[1], payload[1]
+    return None
+
+
+def _route_illum(match, s3_obj):
+    batch_id = match["illum_batch"]
+    batch = _get_batch(match["dataset"], batch_id)
+    batch.date = extract_date(batch_id)
+    add_illum(batch, match["illum_plate"], s3_obj)
+
+
+def _route_image(match, s3_obj):
+    batch_id = match["image_batch"]
+    batch = _get_batch(match["dataset"], batch_id)
+    batch.date = extract_date(batch_id)
+    plate = add_image(batch, match["image_folder"], s3_obj)
+    if len(s3_obj.folder) > match.end("image_folder"):
+        # Every object under this folder goes to the same plate
+        if len(image_folders) >= IMAGE_FOLDER_CACHE_SIZE:
+            # Evict the oldest folder, listings are sorted by path
+            del image_folders[next(iter(image_folders))]
+        image_folders[s3_obj.folder] = datasets[match["dataset"]], plate
+
+
+def _route_analysis(match, s3_obj):
+    batch = _get_batch(match["dataset"], match["analysis_batch"])
+    plate = batch.get_plate(match["analysis_plate"])
+    if match["analysis_subdir"] != "outlines":
+        process_csv_file(plate, match["analysis_dir"], s3_obj)
+    elif match["analysis_file"] is not None:
+        process_outline(plate, match["analysis_file"], s3_obj)
+    else:
+        process_path(s3_obj.path, s3_obj)
+
+
+def _route_backend(match, s3_obj):
+    batch = _get_batch(match["dataset"], match["backend_batch"])
+    add_backend(batch.get_plate(match["backend_plate"]), s3_obj)
+
+
+def _route_load_data(match, s3_obj):
+    batch = _get_batch(match["dataset"], match["load_data_batch"])
+    add_load_data(batch.get_plate(match["load_data_plate"]), s3_obj)
+
+
+def _route_platemap(match, s3_obj):
+    batch = _get_batch(match["dataset"], match["platemap_batch"])
+    add_platemap(batch, match["platemap_kind"], s3_obj)
+
+
+def _route_external_metadata(match, s3_obj):
+    _get_dataset(match["dataset"]).add_metadata(s3_obj)
+
+
+def _route_profile(match, s3_obj):
+    batch = _get_batch(match["dataset"], match["profile_batch"])
+    batch.get_plate(match["profile_plate"]).add_profile(s3_obj)
+
+
+ROUTES = {
+    "illum": _route_illum,
+    "image": _route_image,
+    "analysis": _route_analysis,
+    "backend": _route_backend,
+    "load_data": _route_load_data,
+    "platemap": _route_platemap,
+    "external_metadata": _route_external_metadata,
+    "profile": _route_profile,
+}
+
+
+def format_line(date, size, path):
+    """Format an object as a line of the `aws s3 ls --recursive` output"""
+    if isinstance(date, int):
+        date = epoch_to_date(date)
+    elif not isinstance(date, str):
+        # aws cli prints the dates in local time
+        date = date.astimezone().strftime(DATE_FORMAT)
+    return f"{date} {size:>10} {path}"
 
 
 def process_line(line):
-    """Create s3 object from a line"""
+    """Create s3 object from a line. Return it, or None if it was skipped"""
+    if skip_rgx is not None and skip_rgx.match(line):
+        return None
     date, size, path = parse(line)
+    return add_object(date, size, path)
+
+
+def process_object(path, size, date):
+    """Create s3 object from a listed object, e.g. the Key, Size and
+    LastModified of a ListObjectsV2 response. Same as `process_line` with
+    its `format_line`. The date can also be the seconds since epoch of the
+    local date, as stored by `S3Object`"""
+    path = path.replace("//", "/")
+    if skip_path_rgx is not None and skip_path_rgx.match(path):
+        return
+    if isinstance(date, datetime.datetime):
+        date = date.astimezone().strftime(DATE_FORMAT)
+    add_object(date, size, path)
+
+
+def add_object(date, size, path):
+    """Add the s3 object to the datasets and return it"""
+    s3_obj = S3Object(date, size, path)
+    if cached := image_folders.get(s3_obj.folder):
+        dataset, plate = cached
+        # Ignore folders memoized before `datasets` was cleared
+        if datasets.get(dataset.dataset_id) is dataset:
+            plate.images.append(s3_obj)
+            return s3_obj
+    if match := PATH_RGX.match(path):
+        ROUTES[match.lastgroup](match, s3_obj)
+    else:
+        process_path(path, s3_obj)
+    return s3_obj
+
+
+def process_path(path, s3_obj):
+    """Process a s3_obj whose path is not in a canonical layout"""
     elems = path.split("/")
     # elems[0] expected to be jump
-    s3_obj = S3Object(date, size, path)
 
     s3_folder = S3Folder(elems[2])  # 'images' or 'workspace'
 
@@ -96,28 +411,37 @@ def process_image(batch_id, payload, s3_obj):
     batch.date = date
     image_folder = ImageFolder(payload[0])
     if image_folder is ImageFolder.ILLUM:
-        plate_id = payload[1]
-        plate = batch.get_plate(plate_id)
-        filename = "/".join(payload[2:])
-        plate.correction.add_npy(s3_obj)
+        add_illum(batch, payload[1], s3_obj)
     elif image_folder is ImageFolder.IMAGE:
-        filename = payload[1]
-        plate_id = None
-
-        # try first split with double '__', otherwise, with '_'
-        tokens = filename.split("__")
-        if len(tokens) == 1:
-            tokens = filename.split("_")
-        for token in tokens:
-            # Avoid short ids. see
-            # https://github.com/jump-cellpainting/aws/issues/75#issuecomment-1021746324
-            if len(token) > 4:
-                plate_id = token
-                break
-        if not plate_id:
-            raise ValueError(f"Unable to find a valid plate_id in {filename}")
-        plate = batch.get_plate(plate_id)
-        plate.images.append(s3_obj)
+        add_image(batch, payload[1], s3_obj)
+
+
+def add_illum(batch, plate_id, s3_obj):
+    """Add an illumination correction file to a plate"""
+    plate = batch.get_plate(plate_id)
+    plate.correction.add_npy(s3_obj)
+
+
+def add_image(batch, folder, s3_obj):
+    """Add an image to the plate whose ID is in the image folder name.
+    Return the plate"""
+    plate_id = None
+
+    # try first split with double '__', otherwise, with '_'
+    tokens = folder.split("__")
+    if len(tokens) == 1:
+        tokens = folder.split("_")
+    for token in tokens:
+        # Avoid short ids. see
+        # https://github.com/jump-cellpainting/aws/issues/75#issuecomment-1021746324
+        if len(token) > 4:
+            plate_id = token
+            break
+    if not plate_id:
+        raise ValueError(f"Unable to find a valid plate_id in {folder}")
+    plate = batch.get_plate(plate_id)
+    plate.images.append(s3_obj)
+    return plate
 
 
 def process_workspace(payload, s3_obj):
@@ -223,12 +547,18 @@ def process_backend(payload, s3_obj):
     batch = get_batch(batch_id, s3_obj)
     plate_id = payload[2]
     plate = batch.get_plate(plate_id)
-    if s3_obj.path.endswith("sqlite"):
+    add_backend(plate, s3_obj)
+
+
+def add_backend(plate, s3_obj):
+    """Add a backend file to a plate"""
+    path = s3_obj.path
+    if path.endswith("sqlite"):
         plate.backend_sqlite = s3_obj
-    elif s3_obj.path.endswith("csv"):
+    elif path.endswith("csv"):
         plate.backend_csv = s3_obj
     else:
-        raise ValueError(f"Invalid backend value: {s3_obj.path}")
+        raise ValueError(f"Invalid backend value: {path}")
 
 
 def process_load_data(payload, s3_obj):
@@ -237,22 +567,30 @@ def process_load_data(payload, s3_obj):
     batch = get_batch(batch_id, s3_obj)
     plate_id = payload[2]
     plate = batch.get_plate(plate_id)
-    if s3_obj.path.endswith("load_data.csv.gz") or s3_obj.path.endswith(
-        "load_data.csv"
-    ):
+    add_load_data(plate, s3_obj)
+
+
+LOAD_DATA_SUFFIXES = "load_data.csv.gz", "load_data.csv"
+LOAD_DATA_ILLUM_SUFFIXES = (
+    "load_data_with_illum.csv.gz",
+    "load_data_with_illum.csv",
+    "load_data_illum.csv.gz",
+    "load_data_illum.csv",
+)
+
+
+def add_load_data(plate, s3_obj):
+    """Add a load_data file to a plate"""
+    path = s3_obj.path
+    if path.endswith(LOAD_DATA_SUFFIXES):
         plate.load_data_csv = s3_obj
-    elif (
-        s3_obj.path.endswith("load_data_with_illum.csv.gz")
-        or s3_obj.path.endswith("load_data_with_illum.csv")
-        or s3_obj.path.endswith("load_data_illum.csv.gz")
-        or s3_obj.path.endswith("load_data_illum.csv")
-    ):
+    elif path.endswith(LOAD_DATA_ILLUM_SUFFIXES):
         plate.load_data_with_illum = s3_obj
-    elif "load_data_with_illum_split-" in s3_obj.path:
+    elif "load_data_with_illum_split-" in path:
         # Ignore split illum files
         pass
     else:
-        raise ValueError(f"Invalid load_data file: {s3_obj.path}")
+        raise ValueError(f"Invalid load_data file: {path}")
 
 
 def process_metadata(payload, s3_obj):
@@ -264,12 +602,17 @@ def process_metadata(payload, s3_obj):
     elif metadata_folder is MetadataFolder.PLATEMAPS:
         batch_id = payload[2]
         batch = get_batch(batch_id, s3_obj)
-        if payload[3] == "platemap":
-            batch.platemaps.append(s3_obj)
-        elif payload[3] == "barcode_platemap.csv":
-            batch.barcode_platemap = s3_obj
-        else:
-            raise ValueError(f"Invalid platemap file: {s3_obj.path}")
+        add_platemap(batch, payload[3], s3_obj)
+
+
+def add_platemap(batch, kind, s3_obj):
+    """Add a platemap or the barcode_platemap file to a batch"""
+    if kind == "platemap":
+        batch.platemaps.append(s3_obj)
+    elif kind == "barcode_platemap.csv":
+        batch.barcode_platemap = s3_obj
+    else:
+        raise ValueError(f"Invalid platemap file: {s3_obj.path}")
 
 
 def process_profile(payload, s3_obj):
@@ -0,0 +1,183 @@
+"""
+List S3 objects with concurrent ListObjectsV2 requests
+"""
+import asyncio
+import contextlib
+import threading
+from urllib.parse import urlparse
+
+
+def split_url(url: str):
+    """Split a s3://bucket/prefix url into bucket and prefix"""
+    parsed = urlparse(url)
+    if parsed.scheme != "s3" or not parsed.netloc:
+        raise ValueError(f"Invalid S3 url: {url}")
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def url_name(url: str) -> str:
+    """Name of the last folder in a s3 url, e.g. source_4 for
+    s3://cellpainting-gallery/jump/source_4/"""
+    return split_url(url)[1].rstrip("/").rsplit("/", 1)[-1]
+
+
+async def list_pages(client, bucket, prefix, page_size, delimiter=None):
+    """Yield the pages of a ListObjectsV2 listing"""
+    paginator = client.get_paginator("list_objects_v2")
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    async for page in paginator.paginate(
+        **kwargs, PaginationConfig={"PageSize": page_size}
+    ):
+        yield page
+
+
+async def split_prefix(client, bucket, prefix, depth, page_size, semaphore):
+    """
+    Split the listing of a prefix in segments sorted by key. Segments are
+    either lists of objects or prefixes `depth` folders below `prefix` that
+    can be listed concurrently
+    """
+    if depth == 0:
+        return [prefix]
+    items = []
+    async with semaphore:
+        async for page in list_pages(client, bucket, prefix, page_size, "/"):
+            items.extend((obj["Key"], obj) for obj in page.get("Contents", []))
+            items.extend(
+                (pre["Prefix"], None) for pre in page.get("CommonPrefixes", [])
+            )
+    items.sort(key=lambda item: item[0])
+    subprefixes = iter(
+        await asyncio.gather(
+            *(
+                split_prefix(client, bucket, key, depth - 1, page_size, semaphore)
+                for key, obj in items
+                if obj is None
+            )
+        )
+    )
+    segments = []
+    for _, obj in items:
+        if obj is None:
+            segments.extend(next(subprefixes))
+        elif segments and isinstance(segments[-1], list):
+            segments[-1].append(obj)
+        else:
+            segments.append([obj])
+    return segments
+
+
+async def fill_queue(client, bucket, prefix, page_size, semaphore, queue):
+    """List a prefix into a queue of pages. The queue ends with None, or
+    with the exception raised while listing"""
+    try:
+        async with semaphore:
+            async for page in list_pages(client, bucket, prefix, page_size):
+                await queue.put(page.get("Contents", []))
+    except Exception as exc:  # pylint: disable=broad-except
+        await queue.put(exc)
+    else:
+        await queue.put(None)
+
+
+class ObjectLister:
+    """
+    List the objects under a s3://bucket/prefix url sorted by key, as
+    `aws s3 ls --recursive` does. The prefixes `depth` folders below the url
+    are listed concurrently by an event loop running in a background thread,
+    so the network latency is overlapped with the processing of the objects
+    """
+
+    def __init__(
+        self,
+        url: str,
+        endpoint_url=None,
+        profile=None,
+        depth: int = 3,
+        max_requests: int = 16,
+        queue_pages: int = 4,
+        page_size: int = 1000,
+    ):
+        self.bucket, self.prefix = split_url(url)
+        self.endpoint_url = endpoint_url
+        self.profile = profile
+        self.depth = depth
+        self.max_requests = max_requests
+        self.queue_pages = queue_pages
+        self.page_size = page_size
+        self._loop = None
+        self._stack = None
+        self._tasks = []
+
+    def _run(self, coro):
+        """Run a coroutine in the event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _start(self):
+        """Open the client and start listing the segments of the prefix"""
+        try:
+            from aiobotocore.session import AioSession
+        except ImportError as exc:
+            raise ImportError(
+                "aiobotocore is required to list S3 objects. "
+                "Install it with `pip install aiobotocore`"
+            ) from exc
+        self._stack = contextlib.AsyncExitStack()
+        self._tasks = []
+        client = await self._stack.enter_async_context(
+            AioSession(profile=self.profile).create_client(
+                "s3", endpoint_url=self.endpoint_url
+            )
+        )
+        semaphore = asyncio.Semaphore(self.max_requests)
+        segments = await split_prefix(
+            client, self.bucket, self.prefix, self.depth, self.page_size, semaphore
+        )
+        queues = []
+        for segment in segments:
+            if isinstance(segment, list):
+                queues.append(segment)
+                continue
+            queue = asyncio.Queue(self.queue_pages)
+            self._tasks.append(
+                asyncio.create_task(
+                    fill_queue(
+                        client, self.bucket, segment, self.page_size, semaphore, queue
+                    )
+                )
+            )
+            queues.append(queue)
+        return queues
+
+    async def _stop(self):
+        """Cancel the pending requests and close the client"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._stack is not None:
+            await self._stack.aclose()
+        self._stack, self._tasks = None, []
+
+    def __iter__(self):
+        """Yield (key, size, last_modified) for every object"""
+        self._loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            for queue in self._run(self._start()):
+                if isinstance(queue, list):
+                    pages = [queue]
+                else:
+                    pages = iter(lambda q=queue: self._run(q.get()), None)
+                for page in pages:
+                    if isinstance(page, Exception):
+                        raise page
+                    for obj in page:
+                        yield obj["Key"], obj["Size"], obj["LastModified"]
+        finally:
+            self._run(self._stop())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            thread.join()
+            self._loop.close()
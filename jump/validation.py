@@ -0,0 +1,418 @@
+"""
+Compile a JSON schema into specialized Python validation functions
+"""
+from collections import deque
+from numbers import Number
+from operator import itemgetter
+
+from jsonschema.exceptions import ValidationError
+
+# Keywords that do not constrain the instance. Formats are annotations only,
+# as in jsonschema validators created without a format checker
+ANNOTATIONS = {
+    "$schema",
+    "$id",
+    "$defs",
+    "$comment",
+    "title",
+    "description",
+    "format",
+    "default",
+    "examples",
+}
+KEYWORDS = ANNOTATIONS | {
+    "type",
+    "$ref",
+    "properties",
+    "required",
+    "additionalProperties",
+    "minProperties",
+    "items",
+    "minItems",
+    "minimum",
+}
+TYPES = {
+    "object": "isinstance({0}, dict)",
+    "array": "isinstance({0}, list)",
+    "string": "isinstance({0}, str)",
+    "number": "(isinstance({0}, Number) and not isinstance({0}, bool))",
+    "integer": (
+        "(isinstance({0}, int) and not isinstance({0}, bool)"
+        " or isinstance({0}, float) and {0}.is_integer())"
+    ),
+    "boolean": "isinstance({0}, bool)",
+    "null": "({0} is None)",
+}
+# Exact python types of the columns checked by the fast path of record lists
+COLUMN_TYPES = {
+    "string": frozenset({str}),
+    "number": frozenset({int, float}),
+    "integer": frozenset({int}),
+    "boolean": frozenset({bool}),
+}
+
+
+def _error(message, keyword, schema, instance, path):
+    """Error with the same attributes as the ones raised by jsonschema"""
+    return ValidationError(
+        message,
+        validator=keyword,
+        validator_value=schema[keyword],
+        instance=instance,
+        schema=schema,
+        path=deque(path),
+    )
+
+
+def _extras(extras) -> str:
+    """Message of an additionalProperties error"""
+    extras = sorted(extras, key=str)
+    verb = "was" if len(extras) == 1 else "were"
+    joined = ", ".join(repr(extra) for extra in extras)
+    return f"Additional properties are not allowed ({joined} {verb} unexpected)"
+
+
+class _Compiler:
+    """
+    Generate the source of two functions for every subschema: `_vN(instance)`
+    returns whether it is valid, and `_eN(instance, path, errors)` appends its
+    errors. Error functions are only called on invalid instances.
+    """
+
+    def __init__(self, schema: dict):
+        self.defs = schema.get("$defs", {})
+        self.namespace = {
+            "Number": Number,
+            "_error": _error,
+            "_extras": _extras,
+            "ValidationError": ValidationError,
+            "deque": deque,
+        }
+        self.functions = {}
+        self.pending = []
+        self.source = []
+
+    def const(self, value) -> str:
+        """Name of a constant in the namespace of the generated code"""
+        name = f"_c{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def resolve(self, node):
+        """Follow the $ref of a node without other keywords"""
+        while isinstance(node, dict) and set(node) - ANNOTATIONS == {"$ref"}:
+            node = self.ref(node["$ref"])
+        return node
+
+    def ref(self, ref: str) -> dict:
+        """Subschema of a local reference"""
+        if not ref.startswith("#/$defs/") or ref[8:] not in self.defs:
+            raise ValueError(f"Unsupported reference: {ref}")
+        return self.defs[ref[8:]]
+
+    def function(self, node) -> int:
+        """Number of the functions of a subschema, compiled on first use"""
+        if id(node) not in self.functions:
+            self.functions[id(node)] = len(self.functions)
+            self.pending.append(node)
+        return self.functions[id(node)]
+
+    def compile(self, root):
+        """Compile every subschema reachable from the root"""
+        self.function(root)
+        while self.pending:
+            node = self.pending.pop()
+            num = self.functions[id(node)]
+            self.source.append(
+                f"def _v{num}(v):\n    return {self.check(node, 'v', 0)}"
+            )
+            self.source.append(
+                f"def _e{num}(v, path, errors):\n    pass\n"
+                + "\n".join(self.errors(node))
+            )
+        exec("\n".join(self.source), self.namespace)  # pylint: disable=exec-used
+        num = self.functions[id(root)]
+        return self.namespace[f"_v{num}"], self.namespace[f"_e{num}"]
+
+    def simple(self, node, seen=()) -> bool:
+        """Whether a subschema has no arrays or maps of subschemas, so its
+        check can be inlined"""
+        if not isinstance(node, dict):
+            return True
+        if "items" in node or isinstance(node.get("additionalProperties"), dict):
+            return False
+        if "$ref" in node:
+            target = self.ref(node["$ref"])
+            if id(target) in seen or not self.simple(target, seen + (id(target),)):
+                return False
+        return all(
+            self.simple(sub, seen) for sub in node.get("properties", {}).values()
+        )
+
+    def child(self, node, var: str, depth: int) -> str:
+        """Check of a subschema, inlined if it is simple"""
+        if self.simple(node):
+            return self.check(node, var, depth)
+        return f"_v{self.function(node)}({var})"
+
+    def check(self, node, var: str, depth: int) -> str:
+        """Expression that is true if `var` is valid against the subschema"""
+        if node is True or node == {}:
+            return "True"
+        if node is False:
+            return "False"
+        unknown = set(node) - KEYWORDS
+        if unknown:
+            raise ValueError(f"Unsupported keywords: {sorted(unknown)}")
+        conds, objects, arrays, numbers = [], [], [], []
+        types = node.get("type", [])
+        types = [types] if isinstance(types, str) else types
+        if types:
+            conds.append(f"({' or '.join(TYPES[t].format(var) for t in types)})")
+        if "$ref" in node:
+            conds.append(self.child(self.ref(node["$ref"]), var, depth))
+        props = node.get("properties", {})
+        for key, sub in props.items():
+            item = f"{var}[{key!r}]"
+            objects.append(f"({key!r} not in {var} or {self.child(sub, item, depth)})")
+        objects.extend(f"{key!r} in {var}" for key in node.get("required", []))
+        if "minProperties" in node:
+            objects.append(f"len({var}) >= {node['minProperties']!r}")
+        extra = node.get("additionalProperties", True)
+        if extra is False:
+            objects.append(f"{var}.keys() <= {self.const(frozenset(props))}")
+        elif extra is not True and extra != {}:
+            value = f"_x{depth}"
+            objects.append(
+                f"all({self.child(extra, value, depth + 1)} for _k{depth}, {value} "
+                f"in {var}.items() if _k{depth} not in {self.const(frozenset(props))})"
+            )
+        if "minItems" in node:
+            arrays.append(f"len({var}) >= {node['minItems']!r}")
+        if "items" in node:
+            arrays.append(self.items(node["items"], var, depth))
+        if "minimum" in node:
+            numbers.append(f"not {var} < {node['minimum']!r}")
+
+        for kind, kind_conds in (
+            ("object", objects),
+            ("array", arrays),
+            ("number", numbers),
+        ):
+            if not kind_conds:
+                continue
+            if types == [kind]:
+                conds.extend(kind_conds)
+            else:
+                guard = TYPES[kind].format(var)
+                conds.append(f"(not {guard} or ({' and '.join(kind_conds)}))")
+        return f"({' and '.join(conds)})" if conds else "True"
+
+    def items(self, node, var: str, depth: int) -> str:
+        """Check of every element of an array"""
+        record = self.resolve(node)
+        columns = self.columns(record)
+        if columns is not None:
+            return self.records(record, columns, var, depth)
+        if self.simple(node):
+            item = f"_i{depth}"
+            return f"all({self.check(node, item, depth + 1)} for {item} in {var})"
+        return f"all(map(_v{self.function(node)}, {var}))"
+
+    def columns(self, node):
+        """
+        Columns of a record subschema: an object whose properties all have a
+        plain type and that does not allow other properties. None for other
+        subschemas.
+        """
+        if not isinstance(node, dict) or node.get("type") != "object":
+            return None
+        props = node.get("properties", {})
+        if (
+            not set(node) - ANNOTATIONS
+            <= {"type", "properties", "required", "additionalProperties"}
+            or node.get("additionalProperties", True) is not False
+            or not set(node.get("required", [])) <= set(props)
+        ):
+            return None
+        for sub in props.values():
+            if (
+                not isinstance(sub, dict)
+                or set(sub) - ANNOTATIONS - {"minimum"} != {"type"}
+                or sub["type"] not in COLUMN_TYPES
+                or ("minimum" in sub and sub["type"] not in ("number", "integer"))
+            ):
+                return None
+        return props
+
+    def records(self, node, columns: dict, var: str, depth: int) -> str:
+        """
+        Fast path for arrays of records, like lists of S3 objects: if all the
+        elements are dicts with the same keys, each key is checked column by
+        column with builtins instead of element by element. Arrays that do not
+        pass are checked element by element.
+        """
+        num = len(self.source)
+        item = f"_i{depth}"
+        checks = []
+        for key, sub in columns.items():
+            getter = self.const(itemgetter(key))
+            check = (
+                f"set(map(type, map({getter}, v))) <= "
+                f"{self.const(COLUMN_TYPES[sub['type']])}"
+            )
+            if "minimum" in sub:
+                minimum = sub["minimum"]
+                check += f" and not min(map({getter}, v)) < {minimum!r}"
+            checks.append(f"{key!r}: lambda v: {check}")
+        self.source.append(
+            "\n".join(
+                [
+                    f"_columns{num} = {{{', '.join(checks)}}}",
+                    f"def _records{num}(v):",
+                    f"    if v and set(map(type, v)) <= {self.const(frozenset({dict}))}:",
+                    "        keys = v[0].keys()",
+                    f"        if keys <= {self.const(frozenset(columns))} "
+                    f"and keys >= {self.const(frozenset(node.get('required', [])))} "
+                    "and all(map(keys.__eq__, map(dict.keys, v))):",
+                    f"            if all(_columns{num}[key](v) for key in keys):",
+                    "                return True",
+                    f"    return all({self.check(node, item, depth + 1)} for {item} in v)",
+                ]
+            )
+        )
+        return f"_records{num}({var})"
+
+    def errors(self, node) -> list:
+        """Lines of the error function of a subschema, following the order of
+        its keywords as jsonschema does"""
+        if node is True or node == {}:
+            return []
+        if node is False:
+            return [
+                "    errors.append(ValidationError("
+                "f'False schema does not allow {v!r}', validator=None, "
+                "validator_value=None, instance=v, schema=False, path=deque(path)))"
+            ]
+        schema = self.const(node)
+        lines = []
+        for keyword, value in node.items():
+            if keyword in ANNOTATIONS or value is True:
+                continue
+            # Appends an error of this keyword with the message expression
+            add = "errors.append(_error(%s, " + f"{keyword!r}, {schema}, v, path))"
+            if keyword == "type":
+                types = [value] if isinstance(value, str) else value
+                check = " or ".join(TYPES[t].format("v") for t in types)
+                message = self.const(" is not of type " + ", ".join(map(repr, types)))
+                lines += [
+                    f"    if not ({check}):",
+                    "        " + add % f"repr(v) + {message}",
+                ]
+            elif keyword == "$ref":
+                target = self.function(self.ref(value))
+                lines += [
+                    f"    if not _v{target}(v):",
+                    f"        _e{target}(v, path, errors)",
+                ]
+            elif keyword == "properties":
+                lines.append("    if isinstance(v, dict):")
+                for key, sub in value.items():
+                    target = self.function(sub)
+                    lines += [
+                        f"        if {key!r} in v and not _v{target}(v[{key!r}]):",
+                        f"            _e{target}(v[{key!r}], path + ({key!r},), errors)",
+                    ]
+            elif keyword == "required":
+                lines += [
+                    "    if isinstance(v, dict):",
+                    f"        for key in {self.const(tuple(value))}:",
+                    "            if key not in v:",
+                    "                " + add % "repr(key) + ' is a required property'",
+                ]
+            elif keyword == "additionalProperties":
+                props = self.const(frozenset(node.get("properties", {})))
+                lines += [
+                    "    if isinstance(v, dict):",
+                    f"        extras = [key for key in v if key not in {props}]",
+                ]
+                if value is False:
+                    lines += [
+                        "        if extras:",
+                        "            " + add % "_extras(extras)",
+                    ]
+                else:
+                    target = self.function(value)
+                    lines += [
+                        "        for key in extras:",
+                        f"            if not _v{target}(v[key]):",
+                        f"                _e{target}(v[key], path + (key,), errors)",
+                    ]
+            elif keyword == "minProperties":
+                message = (
+                    " should be non-empty"
+                    if value == 1
+                    else " does not have enough properties"
+                )
+                lines += [
+                    f"    if isinstance(v, dict) and len(v) < {value!r}:",
+                    "        " + add % f"repr(v) + {message!r}",
+                ]
+            elif keyword == "items":
+                target = self.function(value)
+                lines += [
+                    "    if isinstance(v, list):",
+                    "        for ix, item in enumerate(v):",
+                    f"            if not _v{target}(item):",
+                    f"                _e{target}(item, path + (ix,), errors)",
+                ]
+            elif keyword == "minItems":
+                message = " should be non-empty" if value == 1 else " is too short"
+                lines += [
+                    f"    if isinstance(v, list) and len(v) < {value!r}:",
+                    "        " + add % f"repr(v) + {message!r}",
+                ]
+            elif keyword == "minimum":
+                message = f" is less than the minimum of {value!r}"
+                lines += [
+                    f"    if {TYPES['number'].format('v')} and v < {value!r}:",
+                    "        " + add % f"repr(v) + {message!r}",
+                ]
+        return lines
+
+
+def compile_schema(schema: dict):
+    """
+    Compile a schema into a function returning whether an instance is valid
+    and a function appending its errors to a list. Raise ValueError if the
+    schema uses keywords or references that are not supported.
+    """
+    return _Compiler(schema).compile(schema)
+
+
+class CompiledValidator:
+    """
+    Validator with the `is_valid`, `iter_errors` and `validate` methods of
+    jsonschema validators, using code generated from the schema. Errors have
+    the same message, path and json_path as the ones of jsonschema.
+    """
+
+    def __init__(self, schema: dict):
+        self.schema = schema
+        self._is_valid, self._errors = compile_schema(schema)
+
+    def is_valid(self, instance) -> bool:
+        """Whether the instance is valid"""
+        return self._is_valid(instance)
+
+    def iter_errors(self, instance):
+        """Iterate over the validation errors of an instance"""
+        errors = []
+        if not self._is_valid(instance):
+            self._errors(instance, (), errors)
+        return iter(errors)
+
+    def validate(self, instance):
+        """Raise the first validation error of an instance, if any"""
+        for error in self.iter_errors(instance):
+            raise error
@@ -1,20 +1,67 @@
 """
 Functions to browse the folders and load information
 """
+from collections import OrderedDict
 from pathlib import Path
-from functools import partial
+from functools import lru_cache, partial
+import csv
+import gzip
 import logging
+import os
 
+import numpy as np
 import pandas as pd
-from tqdm.auto import tqdm
-from tqdm.contrib.concurrent import process_map
-from jump.utils import CONFIG
+from jump.cache import cache_key
+from jump.executor import map_frames
+from jump.utils import CONFIG, FEATURE_SET
 
 import re
 
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:  # pragma: no cover
+    pa = None
+
 logger = logging.getLogger(__name__)
 
 WELL_REGEX = re.compile(r"^([a-zA-Z]{1,2})([0-9]{1,2})$")
+# Compressions of csv files read by pandas, besides gzip
+COMPRESSIONS = (".bz2", ".zip", ".xz", ".zst", ".tar")
+# Values read as missing, as pandas.read_csv does by default
+NA_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+FEATURES = set(FEATURE_SET)
+# Bytes of a profile parsed at once by pyarrow. Profile rows are wide, so
+# small blocks split every column in many chunks
+PROFILE_BLOCK_SIZE = 16 << 20
+# Types of the FEATURE_SET columns, selected with the "feature_precision"
+# setting. float32 halves the memory and parquet bytes of the profiles
+PRECISIONS = ("float64", "float32")
+# Platemaps and barcodes parsed by this process, by kind, path, size and
+# date, least recently used first. Most plates of a batch share a few
+FRAMES = OrderedDict()
+FRAMES_SIZE = 128
+COPY_ON_WRITE = int(pd.__version__.split(".", 1)[0]) >= 3
 
 
 def s3_to_path(s3_obj: dict) -> Path:
@@ -24,31 +71,85 @@ def s3_to_path(s3_obj: dict) -> Path:
     return Path(CONFIG["local_copy_path"]) / suffix
 
 
+@lru_cache(maxsize=None)
+def normalize_well(well: str) -> str:
+    """Normalize a well position, e.g. a1 to A01"""
+    match = WELL_REGEX.match(well)
+    return f"{match[1].upper()}{int(match[2]):02d}"
+
+
 def normalize_well_position(series: pd.Series) -> pd.Series:
-    """Normalize well position"""
-    row = series.apply(lambda x: WELL_REGEX.match(x)[1])
-    col = series.apply(lambda x: WELL_REGEX.match(x)[2])
-    position = row.str.upper() + col.astype(int).apply(
-        "{:02d}".format
-    )  # pylint: disable=consider-using-f-string
-    return position
+    """Normalize well position. Every distinct position is normalized once"""
+    codes, wells = pd.factorize(series, use_na_sentinel=False)
+    positions = np.array([normalize_well(well) for well in wells], dtype=object)
+    return pd.Series(
+        positions[codes], index=series.index, name=series.name, dtype="str"
+    )
 
 
-def load_barcode(batch: dict) -> pd.DataFrame:
-    """Get barcode list for a given batch"""
-    if not batch["barcode_platemap"]:
-        raise ValueError(f'missing barcode in {batch["batch_id"]}')
+def frame_cache_file(key: tuple):
+    """Feather file of a frame in the "frame_cache_path" folder, or None if
+    it is not set"""
+    folder = CONFIG.get("frame_cache_path")
+    if not folder:
+        return None
+    return Path(folder) / f"{cache_key(*key)}.feather"
 
-    barcode_path = s3_to_path(batch["barcode_platemap"])
+
+def cached_frame(kind: str, s3_obj: dict, load) -> pd.DataFrame:
+    """
+    Frame loaded by `load(s3_obj)`, cached by the local path, size and date
+    of the object. Frames are kept in a per-process LRU cache and, if the
+    "frame_cache_path" setting is given, in Feather files shared by the
+    worker processes. Callers get a copy they can edit in place.
+    """
+    path = str(s3_to_path(s3_obj))
+    key = (kind, path, s3_obj.get("size"), s3_obj.get("date"))
+    frame = FRAMES.get(key)
+    if frame is not None:
+        FRAMES.move_to_end(key)
+    else:
+        cache_file = frame_cache_file(key)
+        if cache_file is not None and cache_file.exists():
+            frame = pd.read_feather(cache_file)
+        else:
+            frame = load(s3_obj)
+            if cache_file is not None:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+                frame.to_feather(tmp_file)
+                os.replace(tmp_file, cache_file)
+        FRAMES[key] = frame
+        if len(FRAMES) > FRAMES_SIZE:
+            FRAMES.popitem(last=False)
+    # Shallow copies are enough with Copy-on-Write
+    return frame.copy(deep=not COPY_ON_WRITE)
+
+
+def read_barcode(s3_obj: dict) -> pd.DataFrame:
+    """Read a barcode platemap"""
+    barcode_path = s3_to_path(s3_obj)
     barcode = pd.read_csv(barcode_path, sep=",", dtype=str)
     if len(barcode) == 0:
         raise ValueError(f"{barcode_path} is empty")
-
     return barcode
 
 
+def load_barcode(batch: dict) -> pd.DataFrame:
+    """Get barcode list for a given batch"""
+    if not batch["barcode_platemap"]:
+        raise ValueError(f'missing barcode in {batch["batch_id"]}')
+
+    return cached_frame("barcode", batch["barcode_platemap"], read_barcode)
+
+
 def load_platemap(s3_obj: dict) -> pd.DataFrame:
     """Load platemap for a given plate"""
+    return cached_frame("platemap", s3_obj, read_platemap)
+
+
+def read_platemap(s3_obj: dict) -> pd.DataFrame:
+    """Read a platemap and normalize its well positions"""
     platemap_path = s3_to_path(s3_obj)
     platemap = pd.read_csv(platemap_path, sep="\t", dtype=str)
     if len(platemap) == 0:
@@ -62,11 +163,107 @@ def load_platemap(s3_obj: dict) -> pd.DataFrame:
     return platemap
 
 
-def load_profile(s3_obj: dict) -> pd.DataFrame:
-    """Load a profile given the s3_obj info"""
+def is_metadata(column: str) -> bool:
+    """Whether a profile column is metadata"""
+    return column.startswith("Metadata_")
+
+
+# Metadata columns of the profiles that are always read as strings
+METADATA_DTYPES = {"Metadata_Plate": "str", "Metadata_plate_map_name": "str"}
+
+
+def profile_dtypes(columns: list, precision: str = "float64") -> dict:
+    """Declared types of the columns of a profile: METADATA_DTYPES and the
+    FEATURE_SET columns as floats of `precision`. Other columns are
+    inferred"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown feature_precision {precision}")
+    dtypes = {}
+    for column in columns:
+        if column in METADATA_DTYPES:
+            dtypes[column] = METADATA_DTYPES[column]
+        elif column in FEATURES:
+            dtypes[column] = precision
+    return dtypes
+
+
+def select_columns(path: Path, names: list, columns) -> list:
+    """Columns of a profile to read, in the order of the file. `columns` is a
+    list of names, a function telling whether to read a column, or None to
+    read them all. Metadata_Well is always read"""
+    if columns is None:
+        return names
+    wanted = set(filter(columns, names)) if callable(columns) else set(columns)
+    wanted.add("Metadata_Well")
+    missing = wanted.difference(names)
+    if missing:
+        raise ValueError(f"{path} misses columns {sorted(missing)}")
+    return [name for name in names if name in wanted]
+
+
+def read_profile_pandas(
+    path: Path, names: list, columns: list, dtypes: dict
+) -> pd.DataFrame:
+    """Read the columns of a profile with pandas.read_csv. Floats are parsed
+    to the closest value, as pyarrow does"""
+    usecols = None if len(columns) == len(names) else columns
+    return pd.read_csv(
+        path,
+        usecols=usecols,
+        dtype=dtypes,
+        low_memory=False,
+        float_precision="round_trip",
+    )
+
+
+def read_profile_pyarrow(
+    path: Path, names: list, columns: list, dtypes: dict
+) -> pd.DataFrame:
+    """Read the columns of a profile with pyarrow.csv, which parses blocks of
+    the file in several threads"""
+    if pa is None:
+        raise ImportError(
+            "pyarrow is required to read profiles with it. "
+            "Install it with `pip install pyarrow`"
+        )
+    types = {"str": pa.string(), "float64": pa.float64(), "float32": pa.float32()}
+    column_types = {column: types[dtype] for column, dtype in dtypes.items()}
+    table = pa_csv.read_csv(
+        path,
+        # Columns are named as pandas does
+        read_options=pa_csv.ReadOptions(
+            column_names=names, skip_rows=1, block_size=PROFILE_BLOCK_SIZE
+        ),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=columns,
+            column_types=column_types,
+            null_values=NA_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+
+# Engines reading profiles, selected with the "profile_reader" setting
+PROFILE_READERS = {"pandas": read_profile_pandas, "pyarrow": read_profile_pyarrow}
+
+
+def load_profile(s3_obj: dict, columns=None, precision=None) -> pd.DataFrame:
+    """Load a profile given the s3_obj info. Only `columns` are read, see
+    `select_columns`. FEATURE_SET columns are floats of `precision`, by
+    default the "feature_precision" setting"""
     path = s3_to_path(s3_obj)
-    dtypes = {"Metadata_Plate": str, "Metadata_plate_map_name": str}
-    profile = pd.read_csv(path, dtype=dtypes, low_memory=False)
+    precision = precision or CONFIG.get("feature_precision", "float64")
+    engine = CONFIG.get("profile_reader", "pandas")
+    if engine not in PROFILE_READERS:
+        raise ValueError(f"unknown profile_reader {engine}")
+    if path.suffix in COMPRESSIONS:
+        # Other compressions are left to pandas
+        engine = "pandas"
+    names = read_header(path)
+    columns = select_columns(path, names, columns)
+    dtypes = profile_dtypes(columns, precision)
+    profile = PROFILE_READERS[engine](path, names, columns, dtypes)
     profile["Metadata_Well"] = normalize_well_position(profile["Metadata_Well"])
 
     # Check for duplicates in wells
@@ -75,29 +272,116 @@ def load_profile(s3_obj: dict) -> pd.DataFrame:
     return profile
 
 
-def load_plate(plate_props: dict, profile_key: str) -> pd.DataFrame:
-    """Load profile and metadata from platemap"""
+def relative_errors(reference: pd.DataFrame, values: pd.DataFrame) -> pd.Series:
+    """Maximum relative error of every column of `values` against the same
+    column of `reference`. Missing values are ignored"""
+    expected = reference[values.columns].to_numpy(dtype="float64")
+    actual = values.to_numpy(dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        errors = np.abs(actual - expected) / np.abs(expected)
+    # Exact zeros have no error
+    errors[actual == expected] = 0
+    return pd.Series(np.nanmax(errors, axis=0, initial=0), index=values.columns)
+
+
+def load_plate(plate_props: dict, profile_key: str, columns=None) -> pd.DataFrame:
+    """Load profile and metadata from platemap. Only `columns` of the profile
+    are read, see `select_columns`"""
     platemap = load_platemap(plate_props["platemap"])
-    profile = load_profile(plate_props["profiles"][profile_key])
+    profile = load_profile(plate_props["profiles"][profile_key], columns)
     profile = pd.merge(profile, platemap, how="left", on="Metadata_Well")
     return profile.copy()
 
 
+def header_names(names: list) -> list:
+    """Name the empty columns of a header and rename its duplicated columns
+    as pandas.read_csv does"""
+    names = list(names)
+    named = [ix for ix, name in enumerate(names) if name]
+    unnamed = [ix for ix, name in enumerate(names) if not name]
+    for ix in unnamed:
+        names[ix] = f"Unnamed: {ix}"
+    # Named columns keep their names before the unnamed ones are renamed
+    counts = {}
+    for ix in named + unnamed:
+        name = old_name = names[ix]
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[old_name] = count + 1
+            name = f"{old_name}.{count}"
+            count = count + 1 if name in names else counts.get(name, 0)
+        names[ix] = name
+        counts[name] = count + 1
+    return names
+
+
+def open_csv(path: Path, sep: str = ","):
+    """csv reader of a .csv or .csv.gz file, with its file"""
+    opener = gzip.open if path.suffix == ".gz" else open
+    f_in = opener(path, "rt", encoding="utf-8-sig", newline="")
+    return csv.reader(f_in, delimiter=sep), f_in
+
+
+def read_header(path: Path, sep: str = ",") -> list:
+    """
+    Column names of a .csv or .csv.gz file, named as pandas.read_csv does.
+    Only the first line is read and decompressed.
+    """
+    if path.suffix in COMPRESSIONS:
+        # Other compressions are left to pandas
+        return list(pd.read_csv(path, sep=sep, dtype=str, nrows=0).columns)
+    reader, f_in = open_csv(path, sep)
+    with f_in:
+        # Blank lines are skipped
+        names = next((row for row in reader if row), None)
+    if names is None:
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    return header_names(names)
+
+
+def merge_columns(left: list, right: list, on: str) -> list:
+    """Columns of `pd.merge` on `on` of DataFrames with these columns"""
+    for columns in (left, right):
+        if on not in columns:
+            raise KeyError(on)
+    common = (set(left) & set(right)) - {on}
+    columns = [f"{name}_x" if name in common else name for name in left] + [
+        f"{name}_y" if name in common else name for name in right if name != on
+    ]
+    if len(set(columns)) < len(columns):
+        raise pd.errors.MergeError("Passing 'suffixes' which cause duplicate columns")
+    return columns
+
+
+def load_plate_columns(plate_props: dict, profile_key: str) -> list:
+    """Columns of the DataFrame returned by `load_plate`. Only the header of
+    the profile is read. The platemap is loaded, so its wells are checked"""
+    platemap = list(load_platemap(plate_props["platemap"]).columns)
+    profile = read_header(s3_to_path(plate_props["profiles"][profile_key]))
+    return merge_columns(profile, platemap, "Metadata_Well")
+
+
+def profile_size(plate: dict, profile_key: str = "default") -> int:
+    """Size of the profile of a plate, used to schedule the largest first"""
+    return plate["profiles"].get(profile_key, {}).get("size", 0)
+
+
 def load_batch(batch: dict, profile_key: str) -> pd.DataFrame:
     """Load all plates from a given batch"""
+    return load_batches([batch], profile_key)
+
 
+def load_batches(batches, profile_key: str) -> list:
+    """Load all plates from a list of batches, in the shared process pool.
+    Plates are sent back through shared memory, see `map_frames`"""
+    plates = [plate for batch in batches for plate in batch["plates"]]
     par_func = partial(load_plate, profile_key=profile_key)
-    plates = process_map(par_func, batch["plates"], leave=False)
-    return plates
+    sizes = [profile_size(plate, profile_key) for plate in plates]
+    return map_frames(par_func, plates, sizes=sizes, leave=False)
 
 
 def load_source(batches, profile_key: str) -> pd.DataFrame:
     """Load all plates from a list of batches"""
-    all_plates = []
-    for batch_props in tqdm(batches, leave=False):
-        batch_plates = load_batch(batch_props, profile_key)
-        all_plates.extend(batch_plates)
-
-    all_plates = pd.concat(all_plates)
+    all_plates = pd.concat(load_batches(batches, profile_key))
     all_plates.reset_index(drop=True, inplace=True)
     return all_plates
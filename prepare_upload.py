@@ -4,15 +4,18 @@ Script to create a folder to be synced in the cpg-0006 s3 folder
 import argparse
 from pathlib import Path
 from functools import partial
-from tqdm.auto import tqdm
-from tqdm.contrib.concurrent import process_map
-import orjson
-from loader import load_profile
-from jump.utils import FEATURE_SET
+import numpy as np
+import pandas as pd
+from loader import load_profile, profile_size, relative_errors
+from jump.executor import map_largest_first
+from jump.io import load_structure
+from jump.utils import CONFIG, FEATURE_SET
 
 
-def write_parquet(plate, dataset_id, batch_id, output_path):
-    """write parquet file with the minimum set of columns"""
+def write_parquet(plate, dataset_id, batch_id, output_path, report=False):
+    """write parquet file with the minimum set of columns. Features are
+    stored with the "feature_precision" setting. If `report`, return the
+    maximum relative error of every feature against float64"""
     plate_id = plate["plate_id"]
     filepath = (
         f"{output_path}/{dataset_id}/workspace/profiles/"
@@ -20,29 +23,51 @@ def write_parquet(plate, dataset_id, batch_id, output_path):
     )
     filepath = Path(filepath)
     filepath.parent.mkdir(parents=True, exist_ok=True)
-    dframe = load_profile(plate["profiles"]["default"])
+    columns = ["Metadata_Plate", "Metadata_Well"] + FEATURE_SET
+    # Features are always read as float64 and then cast, so the file does not
+    # depend on `report`
+    dframe = load_profile(plate["profiles"]["default"], columns, "float64")
+    precision = CONFIG.get("feature_precision", "float64")
+    features = dframe[FEATURE_SET].astype(precision)
+    errors = relative_errors(dframe, features) if report else None
+    dframe = pd.concat([dframe.drop(columns=FEATURE_SET), features], axis=1)
     dframe["Metadata_Source"] = dataset_id
     dframe["Metadata_Plate"] = dframe["Metadata_Plate"].astype(str)
     dframe = dframe[
         ["Metadata_Source", "Metadata_Plate", "Metadata_Well"] + FEATURE_SET
     ]
     dframe.to_parquet(filepath, index=False)
+    return errors
 
 
-def write_dataset(jsonfile, output_path):
-    """Write dataset"""
-    with open(jsonfile, "rb") as f_in:
-        dataset = orjson.loads(f_in.read())
+def write_dataset(jsonfile, output_path, precision_report=False):
+    """Write dataset. If `precision_report`, save the maximum relative error
+    of every feature in the dataset against float64"""
+    dataset = load_structure(jsonfile, lazy=True)
     dataset_id = dataset["dataset_id"]
-    for batch in tqdm(dataset["batches"], leave=False, desc=dataset_id):
-        batch_id = batch["batch_id"]
-        par_func = partial(
-            write_parquet,
-            dataset_id=dataset_id,
-            batch_id=batch_id,
-            output_path=output_path,
-        )
-        process_map(par_func, batch["plates"], leave=False)
+    plates, batch_ids = [], []
+    for batch in dataset["batches"]:
+        plates.extend(batch["plates"])
+        batch_ids.extend([batch["batch_id"]] * len(batch["plates"]))
+    par_func = partial(write_parquet, output_path=output_path, report=precision_report)
+    output = map_largest_first(
+        par_func,
+        plates,
+        [dataset_id] * len(plates),
+        batch_ids,
+        sizes=[profile_size(plate) for plate in plates],
+        leave=False,
+        desc=dataset_id,
+    )
+    max_errors = pd.Series(0.0, index=FEATURE_SET)
+    for errors in output:
+        if errors is not None:
+            max_errors = np.maximum(max_errors, errors)
+    if precision_report:
+        report_path = Path(output_path) / dataset_id / "feature_precision.csv"
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        report = max_errors.rename_axis("feature").rename("max_relative_error")
+        report.reset_index().to_csv(report_path, index=False)
 
 
 def main():
@@ -58,9 +83,18 @@ def main():
         help="output dir to write the parquet files",
     )
 
+    parser.add_argument(
+        "--precision-report",
+        action="store_true",
+        help=(
+            "save the maximum relative error of every feature against float64 "
+            "in feature_precision.csv"
+        ),
+    )
+
     args = parser.parse_args()
 
-    write_dataset(args.jsonfile, args.output)
+    write_dataset(args.jsonfile, args.output, args.precision_report)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+"""
+Query the index.sqlite files written by create_structure.py --sqlite
+"""
+import argparse
+import csv
+import sys
+
+from jump.index import QUERIES, missing_params, query
+
+
+def parse_params(params: list) -> dict:
+    """Parse name=value parameters"""
+    parsed = {}
+    for param in params:
+        name, sep, value = param.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid parameter, expected name=value: {param}")
+        parsed[name] = value
+    return parsed
+
+
+def main():
+    """Parse input params"""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run a SQL query, or one of the named queries, on the objects "
+            "table of an index and print the results as csv"
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("index", help="index.sqlite file created by create_structure")
+    parser.add_argument(
+        "query",
+        help=f"SQL query or one of the named queries: {', '.join(QUERIES)}",
+    )
+    parser.add_argument(
+        "--param",
+        nargs="+",
+        default=[],
+        help="name=value parameters of the query, e.g. channel=IllumDNA",
+    )
+    args = parser.parse_args()
+    try:
+        params = parse_params(args.param)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if missing := missing_params(args.query, params):
+        parser.error(f"missing parameters of {args.query}: {', '.join(missing)}")
+    columns, rows = query(args.index, args.query, params)
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Tests"""
+import pytest
+
+from jump import io
+from jump.parsing import datasets, process_line
+
+pytest.importorskip("pyarrow")
+
+PREFIX = "2023-02-09 17:47:37   22161878 jump/source_4/"
+LINES = [
+    "images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "images/B1/images/PLATE2__2021/Images/r01c01f01.tiff",
+    "images/B2/images/PLATE3__2021/Images/r01c01f01.tiff",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/outlines/A01_s1--cell_outlines.png",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-2/Nuclei.csv",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-B02-1/Cells.csv",
+    "workspace/analysis/B1/PLATE2/analysis/PLATE2-A01-1/Cells.csv",
+    "workspace/backend/B1/PLATE1/PLATE1.csv",
+    "workspace/load_data_csv/B1/PLATE1/load_data.csv",
+    "workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "workspace/metadata/platemaps/B1/platemap/pm1.txt",
+    "workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+    "workspace/profiles/B1/PLATE1/PLATE1_normalized.csv.gz",
+    "workspace/profiles/B3/PLATE4/PLATE4.csv.gz",
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+@pytest.mark.parametrize("subtrees", [None, ["images", "profiles"], ["analysis"]])
+def test_arrow_structure(tmp_path, subtrees):
+    """Test the arrow tables are loaded as the json files"""
+    for line in LINES:
+        process_line(f"{PREFIX}{line}")
+    dataset = datasets["source_4"]
+    io.to_json(
+        dataset,
+        tmp_path / "structure.json",
+        tmp_path / "structure_extensive.json",
+        tmp_path / "image_counts.csv",
+        subtrees,
+    )
+    io.to_arrow(dataset, tmp_path / "structure.arrow", subtrees)
+
+    for name, extensive in (
+        ("structure.json", False),
+        ("structure_extensive.json", True),
+    ):
+        expected = io.load_structure(tmp_path / name)
+        structure = io.load_structure(tmp_path / "structure.arrow", extensive=extensive)
+        assert structure == expected
+        assert list(structure["batches"][0]["plates"][0]) == list(
+            expected["batches"][0]["plates"][0]
+        )
+
+        lazy = io.load_structure(tmp_path / "structure.arrow", True, extensive)
+        assert lazy["dataset_id"] == "source_4"
+        assert len(lazy["batches"]) == len(expected["batches"])
+        assert lazy["batches"][-1] == expected["batches"][-1]
+        assert list(lazy["batches"]) == expected["batches"]
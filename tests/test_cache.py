@@ -0,0 +1,34 @@
+"""Tests"""
+from jump.cache import ValidationCache, cache_key
+
+S3_OBJ = {"path": "jump/source_4/P1.csv.gz", "size": 10, "date": "2023-02-09"}
+
+
+def test_validation_cache(tmp_path):
+    """Test results are kept across runs until the schema changes"""
+    dbpath = tmp_path / "cache.sqlite"
+    key = cache_key("profile", S3_OBJ)
+    assert key == cache_key("profile", dict(reversed(S3_OBJ.items())))
+    assert key != cache_key("profile", {**S3_OBJ, "size": 11})
+    with ValidationCache(dbpath, {"type": "object"}) as cache:
+        assert cache.get(key) is None
+        cache.put(key, [["a"], []])
+    with ValidationCache(dbpath, {"type": "object"}) as cache:
+        assert cache.get(key) == [["a"], []]
+    with ValidationCache(dbpath, {"type": "array"}) as cache:
+        assert cache.get(key) is None
+
+
+def test_validation_cache_eviction(tmp_path):
+    """Test the least recently used results are evicted"""
+    dbpath = tmp_path / "cache.sqlite"
+    keys = [cache_key(ix) for ix in range(3)]
+    with ValidationCache(dbpath, {}, max_entries=2) as cache:
+        for ix, key in enumerate(keys):
+            cache.put(key, ix)
+    with ValidationCache(dbpath, {}, max_entries=2) as cache:
+        assert cache.get(keys[0]) is None
+        assert cache.get(keys[1]) == 1
+        cache.put(keys[0], 0)
+    with ValidationCache(dbpath, {}, max_entries=2) as cache:
+        assert [cache.get(key) for key in keys] == [0, 1, None]
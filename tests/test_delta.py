@@ -0,0 +1,115 @@
+"""Tests"""
+import orjson
+import pytest
+
+from create_structure import process_file, update_file
+from jump import delta
+from jump.parsing import batch_key, datasets, parse
+
+PREFIX = "2023-02-09 17:47:37   22161878 jump/source_4/"
+LINES = [
+    "images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "images/B2/images/PLATE2__2021/Images/r01c01f01.tiff",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+    "workspace/profiles/B1/PLATE1/README.txt",
+    "workspace/profiles/B2/PLATE2/PLATE2.csv.gz",
+    "workspace/profiles/B3/PLATE3/PLATE3.csv.gz",
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+def write_listing(path, lines):
+    """Write a listing sorted by path"""
+    path.write_text("".join(f"{PREFIX}{line}\n" for line in sorted(lines)))
+
+
+@pytest.mark.parametrize(
+    "path",
+    LINES
+    + [
+        "images/B1",
+        "images/B1/",
+        "workspace/Analysis/B1/PLATE1",
+        "workspace/backend/B1",
+        "workspace/metadata/platemaps/B1",
+        "workspace/metadata/external_metadata/meta.tsv",
+        "workspace/qc/B1/x.csv",
+        "workspace/PROFILES/B1/PLATE1/x.csv",
+        "workspace//profiles/B1/PLATE1/x.csv",
+        "other/B1/x.csv",
+    ],
+)
+def test_line_batch_key(path):
+    """Test batch keys of raw lines match the ones of parsed paths"""
+    line = f"{PREFIX}{path}\n"
+    assert delta.line_batch_key(line) == batch_key(parse(line)[2])
+
+
+def test_diff_listings(tmp_path):
+    """Test objects added, removed and changed between listings"""
+    write_listing(tmp_path / "old.txt", LINES[:-1])
+    new_lines = [f"{PREFIX}{line}" for line in sorted(LINES[1:])]
+    new_lines[0] = new_lines[0].replace("22161878", "22161879")
+    (tmp_path / "new.txt").write_text("\n".join(new_lines))
+    changes = [
+        (status, parse(line)[2].split("/", 2)[-1])
+        for status, line in delta.diff_listings(
+            tmp_path / "old.txt", tmp_path / "new.txt"
+        )
+    ]
+    assert changes == [
+        (delta.REMOVED, LINES[0]),
+        (delta.CHANGED, LINES[1]),
+        (delta.ADDED, LINES[-1]),
+    ]
+
+
+def test_update_file(tmp_path):
+    """Test the incremental update writes the same files as a full parse"""
+    list_file = tmp_path / "previous" / "source_4.txt"
+    list_file.parent.mkdir()
+    write_listing(list_file, LINES)
+    process_file(list_file, tmp_path / "inc")
+    new_lines = (
+        LINES[:2]
+        + LINES[3:-1]
+        + [
+            "workspace/profiles/B0/PLATE0/PLATE0.csv.gz",
+            "workspace/profiles/B1/PLATE1/PLATE1.csv",
+        ]
+    )
+    new_file = tmp_path / "source_4.txt"
+    write_listing(new_file, new_lines)
+
+    update_file(new_file, list_file, tmp_path / "inc")
+    process_file(new_file, tmp_path / "full")
+    for name in [
+        "structure.json",
+        "structure_extensive.json",
+        "image_counts.csv",
+        "unknown_objects.csv",
+    ]:
+        full = (tmp_path / "full" / "source_4" / name).read_bytes()
+        assert (tmp_path / "inc" / "source_4" / name).read_bytes() == full
+
+    changes = orjson.loads((tmp_path / "inc" / "source_4" / "delta.json").read_bytes())
+    assert changes["objects"] == {"added": 2, "removed": 2, "changed": 0}
+    assert changes["batches"] == [
+        {"batch_id": "B1", "status": "changed"},
+        {"batch_id": "B0", "status": "added"},
+        {"batch_id": "B3", "status": "removed"},
+    ]
+    assert changes["plates"] == [
+        {"batch_id": "B1", "plate_id": "PLATE1", "status": "changed"},
+        {"batch_id": "B0", "plate_id": "PLATE0", "status": "added"},
+        {"batch_id": "B3", "plate_id": "PLATE3", "status": "removed"},
+    ]
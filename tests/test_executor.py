@@ -0,0 +1,65 @@
+"""Tests"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from jump import executor
+from jump.executor import map_frames, map_largest_first, shared_executor
+
+
+def started(value, offset):
+    """Value plus offset, with when and where it was computed"""
+    return value + offset, time.monotonic_ns(), os.getpid()
+
+
+def test_map_largest_first():
+    """Test tasks start from the largest and results keep their order"""
+    sizes = [3, None, 10, 1, 5]
+    output = map_largest_first(
+        started, range(5), [10] * 5, sizes=sizes, workers=1, disable=True
+    )
+    assert [value for value, _, _ in output] == [10, 11, 12, 13, 14]
+    starts = sorted(range(5), key=lambda ix: output[ix][1])
+    assert starts == [2, 4, 0, 3, 1]
+
+    # The processes are kept for the next calls
+    again = map_largest_first(started, [0], [0], sizes=[0], workers=1, disable=True)
+    assert again[0][2] == output[0][2]
+    assert shared_executor(1) is shared_executor(1)
+    assert map_largest_first(started, [], [], sizes=[]) == []
+
+
+def test_map_largest_first_error():
+    """Test errors are raised"""
+    with pytest.raises(TypeError):
+        map_largest_first(started, [1, "a"], [1, 1], sizes=[1, 2], disable=True)
+
+
+def plate_frame(rows):
+    """Frame of a plate with `rows` wells, or an error for no rows"""
+    if rows == 0:
+        return {"plate": "P0"}, "empty plate"
+    return pd.DataFrame(
+        {
+            "Metadata_Well": [f"A{ix:02d}" for ix in range(rows)],
+            "feature": np.arange(rows, dtype="float32"),
+            f"column_{rows}": "x",
+        }
+    )
+
+
+def test_map_frames(tmp_path, monkeypatch):
+    """Test frames are sent back through files, which are removed, and can be
+    changed"""
+    monkeypatch.setattr(executor, "SHARED_DIR", str(tmp_path))
+    rows = [2, 0, 3]
+    output = map_frames(plate_frame, rows, sizes=rows, workers=1, disable=True)
+    assert output[1] == ({"plate": "P0"}, "empty plate")
+    assert list(tmp_path.iterdir()) == []
+    for frame, num_rows in zip(output[::2], rows[::2]):
+        pd.testing.assert_frame_equal(frame, plate_frame(num_rows))
+    output[0].loc[0, "feature"] = 5
+    assert output[0]["feature"].tolist() == [5, 1]
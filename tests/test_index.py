@@ -0,0 +1,92 @@
+"""Tests"""
+import pytest
+
+from jump import index
+from jump.parsing import datasets, process_line
+from query_index import parse_params
+
+PREFIX = "2023-02-09 17:47:37   22161878 jump/source_4/"
+LINES = [
+    "images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "images/B1/illum/PLATE2/PLATE2_IllumAGP.npy",
+    "images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "images/B2/images/PLATE3__2021/Images/r01c01f01.tiff",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/outlines/A01_s1--cell_outlines.png",
+    "workspace/metadata/external_metadata/meta.tsv",
+    "workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+@pytest.fixture(name="dbpath")
+def fixture_dbpath(tmp_path):
+    """Index of the objects in LINES"""
+    for line in LINES:
+        process_line(f"{PREFIX}{line}")
+    dbpath = tmp_path / "index.sqlite"
+    index.write_index(datasets["source_4"], dbpath)
+    return dbpath
+
+
+def test_write_index(dbpath):
+    """Test every object is indexed with its plate, well, site and kind"""
+    columns, rows = index.query(
+        dbpath, "SELECT batch, plate, well, site, kind, name, path FROM objects"
+    )
+    assert columns == ["batch", "plate", "well", "site", "kind", "name", "path"]
+    assert sorted(row[-1] for row in rows) == sorted(
+        f"jump/source_4/{line}" for line in LINES
+    )
+    assert (
+        "B1",
+        "PLATE1",
+        "A01",
+        "1",
+        index.OUTLINE,
+        "cell_outline",
+        f"jump/source_4/{LINES[6]}",
+    ) in rows
+    assert (None, None, None, None, index.EXTERNAL_METADATA, None) in [
+        row[:-1] for row in rows
+    ]
+
+
+def test_named_queries(dbpath):
+    """Test the named queries"""
+    _, rows = index.query(dbpath, "missing_illum", {"channel": "IllumDNA"})
+    assert rows == [("source_4", "B1", "PLATE2"), ("source_4", "B2", "PLATE3")]
+    _, rows = index.query(dbpath, "images_per_plate")
+    assert [row[:4] for row in rows] == [
+        ("source_4", "B1", "PLATE1", 2),
+        ("source_4", "B1", "PLATE2", 0),
+        ("source_4", "B2", "PLATE3", 1),
+    ]
+    _, rows = index.query(dbpath, "bytes_per_batch")
+    assert ("source_4", "B1", index.IMAGE, 2, 2 * 22161878) in rows
+
+
+def test_missing_params():
+    """Test the parameters of the named queries are checked"""
+    assert index.missing_params("missing_illum", {}) == ["channel"]
+    assert index.missing_params("missing_profile", {"channel": "x"}) == ["profile"]
+    assert not index.missing_params("missing_profile", {"profile": "default"})
+    assert not index.missing_params("bytes_per_batch", {})
+    assert not index.missing_params("SELECT :x FROM objects", {})
+
+
+def test_parse_params():
+    """Test query parameters"""
+    assert parse_params(["channel=IllumDNA", "a=b=c"]) == {
+        "channel": "IllumDNA",
+        "a": "b=c",
+    }
+    with pytest.raises(ValueError):
+        parse_params(["channel"])
@@ -0,0 +1,161 @@
+"""Tests"""
+import csv
+import datetime
+import gzip
+import time
+from urllib.parse import quote_plus
+
+import orjson
+import pytest
+
+from create_structure import process_file, process_inventory
+from jump.inventory import local_epochs
+from jump.parsing import datasets, format_line
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+DATE = datetime.datetime(2023, 2, 9, 17, 47, 37, 512000, tzinfo=datetime.timezone.utc)
+KEYS = [
+    "jump/source_4/.DS_Store",
+    "jump/source_4/images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "jump/source_4/images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "jump/source_4/images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "jump/source_4/images/B2/images/PLATE2__2021/Images/r01c01f01.tiff",
+    "jump/source_4/unknown file+1.txt",
+    "jump/source_4/workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "jump/source_4/workspace/metadata/external_metadata/meta data.tsv",
+    "jump/source_4/workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "jump/source_4/workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+    "jump/source_5/workspace/profiles/B1/PLATE5/PLATE5.csv.gz",
+    "jump/source_5/workspace/profiles/B1/PLATE5/unknown.txt",
+]
+# (is_latest, is_delete_marker) of the extra versions that are not listed
+VERSIONS = {
+    "jump/source_4/workspace/profiles/B1/PLATE1/PLATE1.csv.gz": (False, False),
+    "jump/source_4/workspace/profiles/B9/PLATE9/PLATE9.csv.gz": (True, True),
+}
+OUTPUTS = [
+    "structure.json",
+    "structure_extensive.json",
+    "image_counts.csv",
+    "unknown_objects.csv",
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+def inventory_rows():
+    """Rows of the inventory, unsorted as in the data files"""
+    rows = [
+        ("bucket", key, ix, DATE + datetime.timedelta(days=30 * ix), True, False)
+        for ix, key in enumerate(KEYS)
+    ]
+    rows.extend(
+        ("bucket", key, None if marker else 1, DATE, latest, marker)
+        for key, (latest, marker) in VERSIONS.items()
+    )
+    return rows[::-1]
+
+
+def write_inventory(dirpath, file_format):
+    """Write a fake inventory report with two data files"""
+    rows = inventory_rows()
+    files = [rows[: len(rows) // 2], rows[len(rows) // 2 :]]
+    (dirpath / "data").mkdir(parents=True)
+    keys = []
+    for ix, chunk in enumerate(files):
+        if file_format == "CSV":
+            key = f"inventory/bucket/config/data/{ix}.csv.gz"
+            with gzip.open(dirpath / "data" / f"{ix}.csv.gz", "wt", newline="") as fw:
+                writer = csv.writer(fw, quoting=csv.QUOTE_ALL)
+                for bucket, name, size, date, latest, marker in chunk:
+                    writer.writerow(
+                        [
+                            bucket,
+                            quote_plus(name, safe="/"),
+                            "" if size is None else size,
+                            date.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                            str(latest).lower(),
+                            str(marker).lower(),
+                        ]
+                    )
+        else:
+            key = f"inventory/bucket/config/data/{ix}.parquet"
+            names = [
+                "bucket",
+                "key",
+                "size",
+                "last_modified_date",
+                "is_latest",
+                "is_delete_marker",
+            ]
+            pq.write_table(
+                pa.table(dict(zip(names, map(list, zip(*chunk))))),
+                dirpath / "data" / f"{ix}.parquet",
+            )
+        keys.append({"key": key, "size": 1, "MD5checksum": ""})
+    manifest = {
+        "sourceBucket": "bucket",
+        "destinationBucket": "arn:aws:s3:::inventory",
+        "fileFormat": file_format,
+        "fileSchema": "Bucket, Key, Size, LastModifiedDate, IsLatest, IsDeleteMarker",
+        "files": keys,
+    }
+    manifest_path = dirpath / "2023-02-10T01-00Z" / "manifest.json"
+    manifest_path.parent.mkdir()
+    manifest_path.write_bytes(orjson.dumps(manifest))
+    return manifest_path
+
+
+@pytest.mark.parametrize("file_format", ["CSV", "Parquet"])
+def test_process_inventory(tmp_path, file_format):
+    """Test an inventory writes the same files as the listing of each source"""
+    manifest = write_inventory(tmp_path / "inventory", file_format)
+    process_inventory(manifest, tmp_path / "inventory_outputs", prefix="jump/")
+
+    for source in ["source_4", "source_5"]:
+        list_file = tmp_path / f"{source}.txt"
+        list_file.write_text(
+            "".join(
+                f"{format_line(DATE + datetime.timedelta(days=30 * ix), ix, key)}\n"
+                for ix, key in enumerate(KEYS)
+                if key.startswith(f"jump/{source}/")
+            )
+        )
+        datasets.clear()
+        process_file(list_file, tmp_path / "outputs")
+        for name in OUTPUTS:
+            expected = (tmp_path / "outputs" / source / name).read_bytes()
+            actual = tmp_path / "inventory_outputs" / source / name
+            assert actual.read_bytes() == expected
+
+
+def test_inventory_prefix(tmp_path):
+    """Test only the objects under the prefix are processed"""
+    manifest = write_inventory(tmp_path / "inventory", "Parquet")
+    process_inventory(manifest, tmp_path / "outputs", prefix="jump/source_5/")
+    assert not (tmp_path / "outputs" / "source_4").exists()
+    assert (tmp_path / "outputs" / "source_5" / "structure.json").exists()
+
+
+@pytest.mark.parametrize(
+    "zone", ["Australia/Adelaide", "America/St_Johns", "Australia/Lord_Howe"]
+)
+def test_local_epochs(monkeypatch, zone):
+    """Test dates around UTC offset changes at half past the hour"""
+    monkeypatch.setenv("TZ", zone)
+    time.tzset()
+    try:
+        # Every minute of 2023
+        epochs = list(range(1672531200, 1704067200, 60))
+        dates = pa.array([epoch * 1000 for epoch in epochs], pa.timestamp("ms", "UTC"))
+        expected = [epoch + time.localtime(epoch).tm_gmtoff for epoch in epochs]
+        assert local_epochs(dates).tolist() == expected
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,76 @@
+"""Tests"""
+import orjson
+import pytest
+
+from jump import io
+from jump.parsing import datasets, process_line
+
+PREFIX = "2023-02-09 17:47:37   22161878 jump/source_4/"
+LINES = [
+    "images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "images/B1/images/PLATE1__2021/Images/r01c01f03.tiff",
+    "images/B2/images/PLATE2__2021/Images/r01c01f01.tiff",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "workspace/analysis/B1/PLATE3/analysis/PLATE3-A01-1/Cells.csv",
+    "workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+    "workspace/profiles/B3/PLATE3/PLATE3.csv.gz",
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+def structure_dict(dataset, excluded):
+    """Serialize a dataset as a whole dict, dropping the None values"""
+    batches = []
+    for batch in dataset.batches:
+        plates = []
+        for plate in batch.plates.values():
+            plate_props = io.serialize_plate(plate)
+            for key in excluded:
+                plate_props.pop(key, None)
+            plates.append(plate_props)
+        batch_props = batch.to_dict()
+        for key in excluded:
+            batch_props.pop(key, None)
+        batch_props["plates"] = plates
+        batches.append(batch_props)
+    return io.dropna({"dataset_id": dataset.dataset_id, "batches": batches})
+
+
+@pytest.mark.parametrize("subtrees", [None, ["images", "profiles"], ["analysis"]])
+@pytest.mark.parametrize("chunk_size", [1, 2, 4096])
+def test_structure_writer(tmp_path, monkeypatch, subtrees, chunk_size):
+    """Test the streamed files are the same as dumping the whole structure"""
+    monkeypatch.setattr(io.StructureWriter, "IMAGES_CHUNK_SIZE", chunk_size)
+    for line in LINES:
+        process_line(f"{PREFIX}{line}")
+    dataset = datasets["source_4"]
+    io.to_json(
+        dataset,
+        tmp_path / "structure.json",
+        tmp_path / "structure_extensive.json",
+        tmp_path / "image_counts.csv",
+        subtrees,
+        tmp_path / "structure_extensive.ndjson",
+    )
+
+    structure = structure_dict(dataset, io.excluded_keys(subtrees))
+    extensive = orjson.dumps(structure, default=io.default)
+    assert (tmp_path / "structure_extensive.json").read_bytes() == extensive
+    for batch in structure["batches"]:
+        for plate_props in batch["plates"]:
+            plate_props.pop("wells", None)
+            plate_props.pop("images", None)
+    compact = orjson.dumps(structure, default=io.default)
+    assert (tmp_path / "structure.json").read_bytes() == compact
+
+    lines = (tmp_path / "structure_extensive.ndjson").read_bytes().splitlines()
+    batches = orjson.loads(extensive)["batches"]
+    assert [orjson.loads(line) for line in lines] == batches
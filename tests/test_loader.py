@@ -0,0 +1,151 @@
+"""Tests"""
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import loader
+from loader import normalize_well_position
+from jump.utils import FEATURE_SET
+
+
+def test_normalize_well_position():
+    """Test well positions are normalized to an upper case row and two digits"""
+    wells = pd.Series(["a1", "B12", "af48", "a1", "A01"], index=[3, 4, 5, 6, 7])
+    expected = pd.Series(["A01", "B12", "AF48", "A01", "A01"], index=[3, 4, 5, 6, 7])
+    pd.testing.assert_series_equal(
+        normalize_well_position(wells), expected, check_dtype=False
+    )
+    assert len(normalize_well_position(pd.Series([], dtype=str))) == 0
+
+
+@pytest.mark.parametrize("well", ["A100", "1A", np.nan])
+def test_normalize_invalid_well_position(well):
+    """Test unknown well positions raise the same errors"""
+    with pytest.raises(TypeError):
+        normalize_well_position(pd.Series(["A1", well]))
+
+
+@pytest.mark.parametrize("engine", ["pandas", "pyarrow"])
+def test_load_profile(monkeypatch, tmp_path, engine):
+    """Test profiles are read with the declared types and only the columns
+    asked for"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path))
+    monkeypatch.setitem(loader.CONFIG, "profile_reader", engine)
+    features = list(FEATURE_SET[:2])
+    header = [
+        "Metadata_Plate",
+        "Metadata_Well",
+        "Metadata_Row",
+        "Metadata_Site",
+        *features,
+        "Extra",
+    ]
+    with gzip.open(tmp_path / "P1.csv.gz", "wt") as f_out:
+        f_out.write(",".join(header) + "\n0012,a1,A,1,1,NA,3\n0012,A2,,2,4,5.5,6\n")
+    s3_obj = {"path": f"{loader.CONFIG['aws_prefix']}P1.csv.gz"}
+
+    profile = loader.load_profile(s3_obj)
+    assert list(profile.columns) == header
+    assert profile["Metadata_Plate"].tolist() == ["0012", "0012"]
+    assert profile["Metadata_Well"].tolist() == ["A01", "A02"]
+    assert profile["Metadata_Row"].isna().tolist() == [False, True]
+    # Other metadata keep their inferred types
+    assert profile["Metadata_Site"].dtype == "int64"
+    assert (profile[features].dtypes == "float64").all()
+    assert profile[features[1]].isna().tolist() == [True, False]
+    assert profile["Extra"].tolist() == [3, 6]
+
+    profile = loader.load_profile(s3_obj, loader.is_metadata)
+    assert list(profile.columns) == header[:4]
+    profile = loader.load_profile(s3_obj, features)
+    assert list(profile.columns) == ["Metadata_Well", *features]
+    with pytest.raises(ValueError):
+        loader.load_profile(s3_obj, ["Missing"])
+
+
+def test_profile_readers_match(monkeypatch, tmp_path):
+    """Test both engines parse features to the same, closest, floats"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path))
+    features = list(FEATURE_SET[:4])
+    values = np.random.default_rng(0).normal(0, 500, (384, len(features)))
+    wells = [f"{row}{col:02d}" for row in "ABCDEFGHIJKLMNOP" for col in range(1, 25)]
+    rows = [
+        ",".join([well, *(f"{value:.17g}" for value in row)])
+        for well, row in zip(wells, values)
+    ]
+    (tmp_path / "P1.csv").write_text(
+        ",".join(["Metadata_Well", *features]) + "\n" + "\n".join(rows) + "\n"
+    )
+    s3_obj = {"path": f"{loader.CONFIG['aws_prefix']}P1.csv"}
+    profiles = []
+    for engine in ("pandas", "pyarrow"):
+        monkeypatch.setitem(loader.CONFIG, "profile_reader", engine)
+        profiles.append(loader.load_profile(s3_obj))
+    pd.testing.assert_frame_equal(profiles[0], profiles[1])
+    assert (profiles[0][features].to_numpy() == values).all()
+
+
+@pytest.mark.parametrize("engine", ["pandas", "pyarrow"])
+def test_load_profile_precision(monkeypatch, tmp_path, engine):
+    """Test features are loaded as float32 and their relative errors"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path))
+    monkeypatch.setitem(loader.CONFIG, "profile_reader", engine)
+    monkeypatch.setitem(loader.CONFIG, "feature_precision", "float32")
+    features = list(FEATURE_SET[:3])
+    header = ["Metadata_Well", *features]
+    (tmp_path / "P1.csv").write_text(
+        ",".join(header) + "\nA01,0.1,0,1e-50\nA02,2.5,,-0.3\n"
+    )
+    s3_obj = {"path": f"{loader.CONFIG['aws_prefix']}P1.csv"}
+
+    profile = loader.load_profile(s3_obj)
+    assert (profile[features].dtypes == "float32").all()
+    reference = loader.load_profile(s3_obj, precision="float64")
+    assert (reference[features].dtypes == "float64").all()
+
+    errors = loader.relative_errors(reference, profile[features])
+    assert errors.index.tolist() == features
+    assert 0 < errors[features[0]] < 1e-7
+    assert errors[features[1]] == 0
+    # 1e-50 is 0 in float32
+    assert errors[features[2]] == 1
+    with pytest.raises(ValueError):
+        loader.load_profile(s3_obj, precision="float16")
+
+
+def test_load_platemap_cache(monkeypatch, tmp_path):
+    """Test platemaps are parsed once per process, or once for all of them
+    with the Feather cache, and callers can edit them"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path / "inputs"))
+    monkeypatch.setitem(loader.CONFIG, "frame_cache_path", str(tmp_path / "cache"))
+    monkeypatch.setattr(loader, "FRAMES", loader.OrderedDict())
+    (tmp_path / "inputs").mkdir()
+    (tmp_path / "inputs" / "pm1.txt").write_text(
+        "plate_map_name\twell_position\tbroad_sample\npm1\ta1\t\npm1\tA2\tBRD\n"
+    )
+    s3_obj = {"path": f"{loader.CONFIG['aws_prefix']}pm1.txt", "size": 1, "date": "d"}
+    reads = []
+    read_platemap = loader.read_platemap
+    monkeypatch.setattr(
+        loader, "read_platemap", lambda obj: reads.append(obj) or read_platemap(obj)
+    )
+
+    platemap = loader.load_platemap(s3_obj)
+    assert platemap["Metadata_Well"].tolist() == ["A01", "A02"]
+    platemap.fillna({"broad_sample": "DMSO"}, inplace=True)
+    platemap.loc[1, "Metadata_Well"] = "B01"
+    expected = loader.load_platemap(s3_obj)
+    assert expected["broad_sample"].isna().tolist() == [True, False]
+    assert expected["Metadata_Well"].tolist() == ["A01", "A02"]
+    assert len(reads) == 1
+
+    # Other processes read the Feather file
+    loader.FRAMES.clear()
+    pd.testing.assert_frame_equal(
+        loader.load_platemap(s3_obj), expected, check_dtype=False
+    )
+    assert len(reads) == 1
+    loader.load_platemap({**s3_obj, "size": 2})
+    assert len(reads) == 2
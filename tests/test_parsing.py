@@ -1,7 +1,23 @@
 """Tests"""
+import pickle
 import pytest
 
-from jump.parsing import process_line, datasets
+from create_structure import parse_file, parse_file_parallel
+from jump import parsing
+
+from jump.io import serialize
+from jump.dao import DuplicateError, S3Object, ImageColumns
+from jump.parsing import (
+    classify,
+    process_line,
+    process_path,
+    parse,
+    datasets,
+    merge_datasets,
+    read_shard,
+    select_subtrees,
+    split_shards,
+)
 
 
 @pytest.fixture(autouse=True, scope="function")
@@ -249,5 +265,236 @@ def test_line_25():
     process_line(line)
 
 
+def test_merge_shards():
+    """Test duplicates across shards are rejected as in a serial parse"""
+    prefix = (
+        "2023-02-09 17:47:37   22161878 cpg0000-jump-pilot/source_4/workspace/"
+        "profiles/2020_11_04_CPJUMP1/BR00116996/"
+    )
+    first = prefix + "BR00116996.csv.gz"
+    shard_lines = [
+        prefix + "BR00116996.csv",
+        prefix + "extra/BR00116996.csv",
+        prefix + "BR00116996_normalized.csv",
+    ]
+    process_line(first)
+    shard_0 = dict(datasets)
+    datasets.clear()
+    errors = []
+    for line in shard_lines:
+        try:
+            process_line(line)
+        except DuplicateError as exc:
+            errors.append(exc)
+    shard_1 = dict(datasets)
+    datasets.clear()
+
+    assert not merge_datasets(shard_0)
+    conflicts = merge_datasets(shard_1)
+    assert len(conflicts) == 1
+    s3_obj, kept = conflicts[0].s3_obj, conflicts[0].kept
+    assert s3_obj.path.endswith("BR00116996/BR00116996.csv")
+    assert kept.path.endswith("BR00116996.csv.gz")
+    assert conflicts[0].key == "default"
+    assert str(conflicts[0]) == f"Duplicated profile for default: {kept}, {s3_obj}"
+    assert [str(exc) for exc in errors] == [
+        f"Duplicated profile for default: {s3_obj}, {shard_lines[1].split()[-1]}"
+    ]
+    assert errors[0].kept is s3_obj
+
+    plate = datasets["source_4"].get_batch("2020_11_04_CPJUMP1").plates["BR00116996"]
+    assert list(plate.profiles) == ["default", "normalized"]
+    assert plate.profiles["default"] is kept
+
+
+def test_parse_file_parallel(tmp_path):
+    """Test parallel parses report the same errors as serial ones"""
+    prefix = "2023-02-09 17:47:37   22161878 jump/source_4/"
+    lines = []
+    for plate_id in ("P1", "P2", "P3"):
+        lines += [
+            f"images/B1/illum/{plate_id}/{plate_id}_IllumDNA.npy",
+            f"images/B1/illum/{plate_id}/x/{plate_id}_IllumDNA.npy",
+            f"workspace/analysis/B1/{plate_id}/analysis/{plate_id}-A01-1/Cells.csv",
+            f"workspace/analysis/B1/{plate_id}/analysis/{plate_id}-A01-1/Cells.csv.gz",
+            f"workspace/profiles/B1/{plate_id}/{plate_id}.csv.gz",
+            f"workspace/profiles/B1/{plate_id}/{plate_id}.csv",
+            f"workspace/profiles/B1/{plate_id}/x/{plate_id}.csv",
+            f"workspace/other/B1/{plate_id}.csv",
+        ]
+    listing = tmp_path / "listing.txt"
+    listing.write_text("".join(f"{prefix}{line}\n" for line in lines))
+    serial = tmp_path / "serial.csv"
+    assert parse_file(listing, serial) == 15
+    expected = serialize(datasets["source_4"].get_batch("B1"), "source_4")
+    for num_workers in (2, 5, 24):
+        datasets.clear()
+        errorpath = tmp_path / f"parallel_{num_workers}.csv"
+        assert parse_file_parallel(listing, errorpath, num_workers) == 15
+        assert errorpath.read_text() == serial.read_text()
+        batch = datasets["source_4"].get_batch("B1")
+        assert serialize(batch, "source_4") == expected
+
+
+def test_read_shard(tmp_path):
+    """Test shards cover every line exactly once"""
+    lines = [f"line {i}{'x' * (i % 7)}\n" for i in range(100)]
+    listing = tmp_path / "listing.txt"
+    listing.write_text("".join(lines))
+    for num_shards in (1, 3, 8, 200):
+        shards = split_shards(listing, num_shards)
+        read = [
+            line for start, end in shards for _, line in read_shard(listing, start, end)
+        ]
+        assert read == lines
+
+
+def test_image_columns():
+    """Test images stored in columns are serialized as S3 objects"""
+    lines = [
+        "2021-11-10 08:07:26    2226012 jump/source_3/images/CP_25_all_Phenix1/images/"
+        "C13443aW__2021-09-18T06_57_42-Measurement1/Images/r07c21f02p01-ch1sk1fk1fl1.tiff",
+        "2021-11-10 08:07:27    2226013 jump/source_3/images/CP_25_all_Phenix1/images/"
+        "C13443aW__2021-09-18T06_57_42-Measurement1/Images/r07c21f02p01-ch2sk1fk1fl1.tiff",
+        "1999-12-31 23:59:59          0 jump/source_3/images/CP_25_all_Phenix1/images/"
+        "C13443aW__2021-09-18T06_57_42-Measurement2/Images/é.tiff",
+    ]
+    for line in lines:
+        process_line(line)
+    plate = datasets["source_3"].get_batch("CP_25_all_Phenix1").plates["C13443aW"]
+    assert len(plate.images) == 3
+    expected = [dict(zip(("date", "size", "path"), parse(line))) for line in lines]
+    assert plate.images.to_list() == expected
+    assert list(plate.images) == [S3Object(*parse(line)) for line in lines]
+
+    copy = ImageColumns()
+    copy.extend(pickle.loads(pickle.dumps(plate.images)))
+    copy.extend(plate.images)
+    assert copy.to_list() == expected + expected
+
+
+def test_classify():
+    """Test paths are resolved to their route and ids"""
+    route, ids = classify(
+        "jump/source_3/workspace/Analysis/CP_25/C13451aW/analysis/"
+        "C13451aW-F08/outlines/F08_s3--nuclei_outlines.png"
+    )
+    assert route == "analysis"
+    assert ids == {
+        "dataset": "source_3",
+        "batch": "CP_25",
+        "plate": "C13451aW",
+        "dir": "C13451aW-F08",
+        "subdir": "outlines",
+        "file": "F08_s3--nuclei_outlines.png",
+    }
+    route, ids = classify("jump/source_3/images/CP_25/images/C13443aW__2021/x.tiff")
+    assert route == "image"
+    assert ids == {"dataset": "source_3", "batch": "CP_25", "folder": "C13443aW__2021"}
+    assert classify("jump/source_3/workspace/qc/CP_25/x.csv") == (None, {})
+    assert classify("jump/source_3/images/CP_25/illum") == (None, {})
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "jump/source_4/workspace/profiles/2020_11_04_CPJUMP1/BR00116996/BR00116996.csv",
+        "jump/source_4/workspace/PROFILES/2020_11_04_CPJUMP1/BR00116996/x.csv",
+        "jump/source_4/workspace/analysis/B1/P1/analysis/P1-A01-1/Cells.csv",
+        "jump/source_4/workspace/analysis/B1/P1/analysis/P1-A01-1/outlines",
+        "jump/source_4/workspace/analysis/B1/P1/analysis/P1-A01-1",
+        "jump/source_4/workspace/analysis/B1/P1/other/P1-A01-1/Cells.csv",
+        "jump/source_4/workspace/backend/B1/P1/P1.sqlite",
+        "jump/source_4/workspace/backend/B1/P1/P1.parquet",
+        "jump/source_4/workspace/load_data_csv/B1/P1/load_data_illum.csv.gz",
+        "jump/source_4/workspace/load_data_csv/B1/P1/other.csv",
+        "jump/source_4/workspace/metadata/platemaps/B1/barcode_platemap.csv",
+        "jump/source_4/workspace/metadata/platemaps/B1/other.csv",
+        "jump/source_4/workspace/metadata/platemaps/B1",
+        "jump/source_4/workspace/metadata/external_metadata/meta.tsv",
+        "jump/source_4/images/B1/illum/P1/P1_IllumDNA.npy",
+        "jump/source_4/images/B1/illum/P1/P1_IllumDNA.tiff",
+        "jump/source_4/images/B1/images/ab_cd/x.tiff",
+        "jump/source_4/images/B1/images",
+        "jump/source_4/other/B1/images",
+    ],
+)
+def test_routes_match_legacy(path):
+    """Test the table driven dispatch behaves as the per folder dispatch"""
+
+    def process_legacy(line):
+        date, size, path = parse(line)
+        process_path(path, S3Object(date, size, path))
+
+    line = f"2023-02-09 17:47:37   22161878 {path}"
+    outcomes = []
+    for process in (process_line, process_legacy):
+        datasets.clear()
+        try:
+            process(line)
+            outcome = None
+        except (ValueError, IndexError, AssertionError) as exc:
+            outcome = (type(exc), str(exc))
+        outcomes.append((outcome, pickle.dumps(datasets)))
+    assert outcomes[0] == outcomes[1]
+
+
+def test_image_folder_cache(monkeypatch):
+    """Test images are added through the bounded folder cache"""
+    monkeypatch.setattr(parsing, "IMAGE_FOLDER_CACHE_SIZE", 2)
+    monkeypatch.setattr(parsing, "image_folders", {})
+    prefix = "2023-02-09 17:47:37   22161878 jump/source_4/images/B1/images/"
+    for plate_id in ("PLATE1", "PLATE2", "PLATE3"):
+        for site in range(3):
+            process_line(f"{prefix}{plate_id}__2021/Images/r01c01f0{site}.tiff")
+    assert list(parsing.image_folders) == [
+        "jump/source_4/images/B1/images/PLATE2__2021/Images/",
+        "jump/source_4/images/B1/images/PLATE3__2021/Images/",
+    ]
+    plates = datasets["source_4"].get_batch("B1").plates
+    assert [len(plate.images) for plate in plates.values()] == [3, 3, 3]
+
+    # Folders cached for a previous parse are ignored
+    datasets.clear()
+    process_line(f"{prefix}PLATE3__2021/Images/r01c01f04.tiff")
+    plates = datasets["source_4"].get_batch("B1").plates
+    assert len(plates["PLATE3"].images) == 1
+
+
+def test_reset(monkeypatch):
+    """Test resetting the datasets forgets the image folders of their plates"""
+    monkeypatch.setattr(parsing, "image_folders", {})
+    prefix = "2023-02-09 17:47:37   22161878 jump/source_4/images/B1/images/"
+    process_line(f"{prefix}PLATE1__2021/Images/r01c01f01.tiff")
+    process_line(f"{prefix.replace('source_4', 'source_5')}PLATE1__2021/Images/x.tiff")
+    assert len(parsing.image_folders) == 2
+    parsing.reset("source_4")
+    assert list(datasets) == ["source_5"]
+    assert not parsing.image_folders
+    parsing.reset()
+    assert not datasets
+
+
+def test_select_subtrees(monkeypatch):
+    """Test lines out of the selected subtrees are skipped"""
+    monkeypatch.setattr(parsing, "skip_rgx", None)
+    prefix = "2023-02-09 17:47:37   22161878 jump/source_4/"
+    select_subtrees(["profiles", "metadata"])
+    process_line(f"{prefix}images/B1/images/PLATE1__2021/Images/r01c01f01.tiff")
+    process_line(f"{prefix}workspace/Analysis/B1/P1/analysis/P1-A01-1/Cells.csv")
+    process_line(f"{prefix}workspace/backend/B1/P1/P1.parquet")
+    assert not datasets
+    process_line(f"{prefix}workspace/metadata/platemaps/B1/barcode_platemap.csv")
+    process_line(f"{prefix}workspace/profiles/B1/P1/P1.csv.gz")
+    plates = datasets["source_4"].get_batch("B1").plates
+    assert list(plates["P1"].profiles) == ["default"]
+    with pytest.raises(ValueError, match="Invalid subtrees"):
+        select_subtrees(["profile"])
+
+    select_subtrees(None)
+    process_line(f"{prefix}images/B1/images/PLATE1__2021/Images/r01c01f01.tiff")
+    assert len(plates["PLATE1"].images) == 1
+
+
 if __name__ == "__main__":
     test_line_25()
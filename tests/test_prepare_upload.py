@@ -0,0 +1,45 @@
+"""Tests"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import loader
+from prepare_upload import write_parquet
+from jump.utils import FEATURE_SET
+
+pytest.importorskip("pyarrow")
+
+
+def test_write_parquet_report(monkeypatch, tmp_path):
+    """Test the parquet file does not depend on the precision report"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path))
+    monkeypatch.setitem(loader.CONFIG, "feature_precision", "float32")
+    monkeypatch.setitem(loader.CONFIG, "profile_reader", "pyarrow")
+    values = np.random.default_rng(0).normal(0, 500, (2, len(FEATURE_SET)))
+    profile = pd.DataFrame(values, columns=FEATURE_SET)
+    profile.insert(0, "Metadata_Well", ["A01", "A02"])
+    profile.insert(0, "Metadata_Plate", "P1")
+    profile.to_csv(tmp_path / "P1.csv", index=False, float_format="%.17g")
+    # Just above the midpoint of two float32, which is a float64
+    with open(tmp_path / "P1.csv", "a", encoding="utf8") as f_out:
+        f_out.write(
+            "P1,A03,"
+            + ",".join(["1.00000005960464477539062500001"] * len(FEATURE_SET))
+            + "\n"
+        )
+    plate = {
+        "plate_id": "P1",
+        "profiles": {"default": {"path": f"{loader.CONFIG['aws_prefix']}P1.csv"}},
+    }
+
+    frames = []
+    for report in (False, True):
+        output = tmp_path / f"report_{report}"
+        errors = write_parquet(plate, "source_4", "B1", output, report=report)
+        assert (errors is None) != report
+        frames.append(
+            pd.read_parquet(output / "source_4/workspace/profiles/B1/P1/P1.parquet")
+        )
+    pd.testing.assert_frame_equal(frames[0], frames[1], check_exact=True)
+    assert (frames[0][FEATURE_SET].dtypes == "float32").all()
+    assert (errors < 1e-7).all()
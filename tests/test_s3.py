@@ -0,0 +1,96 @@
+"""Tests"""
+import socket
+
+import pytest
+
+from create_structure import process_file
+from jump.parsing import datasets, format_line
+from jump.s3 import ObjectLister, split_url, url_name
+
+KEYS = [
+    "jump/source_4/.DS_Store",
+    "jump/source_4/images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "jump/source_4/images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "jump/source_4/images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "jump/source_4/images/B1/images/PLATE1__2021/Images/r01c01f03.tiff",
+    "jump/source_4/images/B2/images/PLATE2__2021/Images/r01c01f01.tiff",
+    "jump/source_4/unknown.txt",
+    "jump/source_4/workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "jump/source_4/workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "jump/source_4/workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+    "jump/source_4/workspace/profiles/B2/PLATE2/PLATE2.csv.gz",
+    "jump/source_40/workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+@pytest.fixture(scope="module")
+def endpoint_url():
+    """Bucket with the test objects served by moto"""
+    pytest.importorskip("aiobotocore")
+    boto3 = pytest.importorskip("boto3")
+    moto_server = pytest.importorskip("moto.server")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+        server.start()
+        url = f"http://127.0.0.1:{port}"
+        client = boto3.client("s3", endpoint_url=url)
+        client.create_bucket(Bucket="bucket")
+        for key in KEYS:
+            client.put_object(Bucket="bucket", Key=key, Body=key.encode())
+        yield url
+        server.stop()
+
+
+def test_split_url():
+    """Test bucket and prefix of s3 urls"""
+    assert split_url("s3://bucket/jump/source_4/") == ("bucket", "jump/source_4/")
+    assert url_name("s3://bucket/jump/source_4/") == "source_4"
+    with pytest.raises(ValueError):
+        split_url("bucket/jump/source_4/")
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_object_lister(endpoint_url, depth):
+    """Test the objects are listed in key order with small pages"""
+    objects = ObjectLister(
+        "s3://bucket/jump/source_4/",
+        endpoint_url=endpoint_url,
+        depth=depth,
+        max_requests=2,
+        queue_pages=1,
+        page_size=2,
+    )
+    keys = [key for key in KEYS if key.startswith("jump/source_4/")]
+    assert [key for key, _, _ in objects] == keys
+    assert [size for _, size, _ in objects] == [len(key) for key in keys]
+
+
+def test_process_bucket(endpoint_url, tmp_path):
+    """Test listing a bucket writes the same files as parsing its listing"""
+    url = "s3://bucket/jump/source_4/"
+    objects = list(ObjectLister(url, endpoint_url=endpoint_url))
+    list_file = tmp_path / "source_4.txt"
+    list_file.write_text("".join(f"{format_line(*obj[::-1])}\n" for obj in objects))
+    process_file(list_file, tmp_path / "listing")
+    datasets.clear()
+    process_file(url, tmp_path / "bucket", s3_options={"endpoint_url": endpoint_url})
+    for name in [
+        "structure.json",
+        "structure_extensive.json",
+        "image_counts.csv",
+        "unknown_objects.csv",
+    ]:
+        listing = (tmp_path / "listing" / "source_4" / name).read_bytes()
+        assert (tmp_path / "bucket" / "source_4" / name).read_bytes() == listing
@@ -0,0 +1,174 @@
+"""Tests"""
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import loader
+import validate_profiles
+from validate_profiles import FeatureReport, FeatureResult
+from jump.cache import ValidationCache
+from jump.utils import FEATURE_SET
+
+PREFIX = "jump/source_4/workspace/metadata/platemaps/B1/platemap/"
+
+
+def test_match_platemaps(monkeypatch, caplog):
+    """Test plates are matched with the platemap of their barcode"""
+    barcode = pd.DataFrame(
+        {
+            "Assay_Plate_Barcode": ["P1", "P2", "P2", "P3", "P4", "P5", np.nan],
+            "Plate_Map_Name": ["pm1", "pm2", "pm3", "pm4", "m5", "Apm1", "pm9"],
+        }
+    )
+    monkeypatch.setattr(validate_profiles, "load_barcode", lambda batch: barcode)
+    platemaps = [
+        {"path": f"{PREFIX}{name}"} for name in ("pm1.txt", "Apm1.txt", "pm5.txt")
+    ]
+    batch = {
+        "platemaps": platemaps,
+        "plates": [{"plate_id": f"P{ix}"} for ix in range(1, 7)],
+    }
+    validate_profiles.match_platemaps(batch)
+
+    # Plate map names match the end of the file names
+    assert batch["plates"] == [
+        {"plate_id": "P4", "platemap": platemaps[2], "platemap_name": "m5"},
+        {"plate_id": "P5", "platemap": platemaps[1], "platemap_name": "Apm1"},
+    ]
+    empty = barcode["Plate_Map_Name"].iloc[[]]
+    assert [record.getMessage() for record in caplog.records] == [
+        f"Multiple platemap files for P1: {platemaps[:2]}",
+        f"multiple platemaps for plate P2: {barcode['Plate_Map_Name'].iloc[1:3]}",
+        "Missing platemap file for P3: pm4 not found",
+        f"platemap not found for plate P6: {empty}",
+        "removing 4 invalid plates",
+    ]
+
+
+def test_check_profile(monkeypatch, tmp_path):
+    """Test profile columns are read from the headers of the files"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path))
+    prefix = loader.CONFIG["aws_prefix"]
+    (tmp_path / "pm1.txt").write_text(
+        "plate_map_name\twell_position\tbroad_id\npm1\tA1\tX\n"
+    )
+    features = list(FEATURE_SET[:2])
+    with gzip.open(tmp_path / "P1.csv.gz", "wt") as f_out:
+        f_out.write(",".join(["Metadata_Well", *features, "extra"]) + "\nA01,1,2,3\n")
+    plate = {
+        "plate_id": "P1",
+        "platemap": {"path": f"{prefix}pm1.txt"},
+        "profiles": {"default": {"path": f"{prefix}P1.csv.gz"}},
+    }
+    expected = loader.load_plate(plate, "default").columns
+    assert loader.load_plate_columns(plate, "default") == list(expected)
+
+    _, result = validate_profiles.check_profile(plate, "default")
+    assert not result.is_valid()
+    assert result.missing() == FEATURE_SET[2:]
+    assert set(result.additional) == set(expected) - set(features)
+
+
+@pytest.mark.parametrize(
+    "rows, error, message",
+    [
+        ("", ValueError, "platemap empty"),
+        ("pm1\tA1\tX\npm1\tA01\tY\n", ValueError, "duplicated wells"),
+        ("pm1\tA1B\tX\n", TypeError, None),
+    ],
+)
+def test_check_profile_platemap(monkeypatch, tmp_path, rows, error, message):
+    """Test the wells of the platemap are still checked with the profile"""
+    monkeypatch.setitem(loader.CONFIG, "local_copy_path", str(tmp_path))
+    prefix = loader.CONFIG["aws_prefix"]
+    (tmp_path / "pm1.txt").write_text(
+        "plate_map_name\twell_position\tbroad_id\n" + rows
+    )
+    (tmp_path / "P1.csv").write_text("Metadata_Well,x\nA01,1\n")
+    plate = {
+        "plate_id": "P1",
+        "platemap": {"path": f"{prefix}pm1.txt"},
+        "profiles": {"default": {"path": f"{prefix}P1.csv"}},
+    }
+    with pytest.raises(error, match=message):
+        validate_profiles.check_profile(plate, "default")
+
+
+def test_remove_invalid_profiles_cache(tmp_path):
+    """Test cached profile checks are reused while their files are unchanged"""
+    prefix = loader.CONFIG["aws_prefix"]
+    s3_obj = {"path": f"{prefix}P1.csv.gz", "size": 10, "date": "2023-02-09"}
+    plate = {
+        "plate_id": "P1",
+        "platemap": {"path": f"{prefix}pm1.txt", "size": 5, "date": "2023-02-09"},
+        "profiles": {"default": s3_obj},
+    }
+    key = validate_profiles.profile_cache_key(plate, "default")
+    with ValidationCache(tmp_path / "cache.sqlite", {}) as cache:
+        # Every feature but the first one, as if the files had been read
+        result = FeatureResult.from_columns([*FEATURE_SET[1:], "extra"])
+        cache.put(key, result.to_json())
+        dataset = {
+            "dataset_id": "source_4",
+            "batches": [{"batch_id": "B1", "plates": [plate]}],
+        }
+        report = validate_profiles.remove_invalid_profiles(dataset, "default", cache)
+    assert dataset["batches"][0]["plates"] == []
+    assert report.plate_ids == ["P1"]
+    assert report.additional == [["extra"]]
+    assert report.matrix.tobytes() == result.present
+    assert key != validate_profiles.profile_cache_key(
+        {**plate, "profiles": {"default": {**s3_obj, "size": 11}}}, "default"
+    )
+
+
+def test_feature_report():
+    """Test the summary and long form of the features of several plates"""
+    report = FeatureReport()
+    report.append("B1", "P1", FeatureResult.from_columns(FEATURE_SET))
+    report.append("B1", "P2", FeatureResult.from_columns(FEATURE_SET[2:]))
+    report.append("B2", "P3", FeatureResult.from_columns(["x", *FEATURE_SET[2:]]))
+    report.append("B2", "P4", FeatureResult.from_columns(FEATURE_SET[2:]))
+    assert report.matrix.shape == (4, (len(FEATURE_SET) + 7) // 8)
+    assert report.invalid_counts().to_dict() == {"B1": 1, "B2": 2}
+
+    signatures = report.signatures()
+    assert signatures.to_dict("records") == [
+        {
+            "num_plates": 1,
+            "num_missing": 0,
+            "missing": "",
+            "additional": "",
+            "plates": "B1/P1",
+        },
+        {
+            "num_plates": 2,
+            "num_missing": 2,
+            "missing": ";".join(FEATURE_SET[:2]),
+            "additional": "",
+            "plates": "B1/P2;B2/P4",
+        },
+        {
+            "num_plates": 1,
+            "num_missing": 2,
+            "missing": ";".join(FEATURE_SET[:2]),
+            "additional": "x",
+            "plates": "B2/P3",
+        },
+    ]
+
+    long_form = report.long_form()
+    counts = long_form.groupby(["plate_id", "status"]).size().to_dict()
+    assert counts == {
+        ("P1", "valid"): len(FEATURE_SET),
+        ("P2", "missing"): 2,
+        ("P2", "valid"): len(FEATURE_SET) - 2,
+        ("P3", "additional"): 1,
+        ("P3", "missing"): 2,
+        ("P3", "valid"): len(FEATURE_SET) - 2,
+        ("P4", "missing"): 2,
+        ("P4", "valid"): len(FEATURE_SET) - 2,
+    }
+    assert list(long_form.columns) == ["feature", "status", "plate_id", "batch_id"]
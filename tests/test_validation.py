@@ -0,0 +1,161 @@
+"""Tests"""
+import copy
+
+import orjson
+import pytest
+from jsonschema.validators import validator_for
+
+from create_validated_structure import remove_invalid_elements, stream_dataset
+from jump import io
+from jump.parsing import datasets, process_line
+from jump.validation import CompiledValidator
+
+PREFIX = "2023-02-09 17:47:37   22161878 jump/source_4/"
+LINES = [
+    "images/B1/illum/PLATE1/PLATE1_IllumDNA.npy",
+    "images/B1/images/PLATE1__2021/Images/r01c01f01.tiff",
+    "images/B1/images/PLATE1__2021/Images/r01c01f02.tiff",
+    "images/B1/images/PLATE2__2021/Images/r01c01f01.tiff",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/Cells.csv",
+    "workspace/analysis/B1/PLATE1/analysis/PLATE1-A01-1/outlines/A01_s1--cell_outlines.png",
+    "workspace/analysis/B1/PLATE2/analysis/PLATE2-A01-1/Cells.csv",
+    "workspace/backend/B1/PLATE1/PLATE1.csv",
+    "workspace/load_data_csv/B1/PLATE1/load_data.csv",
+    "workspace/metadata/platemaps/B1/barcode_platemap.csv",
+    "workspace/metadata/platemaps/B1/platemap/pm1.txt",
+    "workspace/profiles/B1/PLATE1/PLATE1.csv.gz",
+    "workspace/profiles/B1/PLATE2/PLATE2.csv.gz",
+]
+# Changes to the structure, as (path, key, value). A value of None deletes it
+MUTATIONS = [
+    (("batches", 0, "plates", 0), "profiles", None),
+    (("batches", 0, "plates", 1, "profiles", "default"), "size", 5),
+    (("batches", 0, "plates", 1, "profiles", "default"), "date", 1),
+    (("batches", 0, "plates", 0), "unknown", {"date": 1}),
+    (("batches", 0, "platemaps"), 0, {"path": "p", "extra": 1, "other": 2}),
+    (("batches", 0), "platemaps", []),
+    (("batches", 0), "barcode_platemap", "path"),
+    ((), "batches", [{}]),
+    ((), "dataset_id", None),
+]
+
+
+@pytest.fixture(autouse=True, scope="function")
+def reset_messages():
+    """Clearing datasets for every test"""
+    datasets.clear()
+
+
+@pytest.fixture(name="structures")
+def fixture_structures(tmp_path):
+    """Structure json files of the objects in LINES"""
+    for line in LINES:
+        process_line(f"{PREFIX}{line}")
+    paths = tmp_path / "structure.json", tmp_path / "structure_extensive.json"
+    io.to_json(datasets["source_4"], *paths, tmp_path / "image_counts.csv")
+    return [io.load_structure(path) for path in paths]
+
+
+def mutate(dataset: dict, mutations) -> dict:
+    """Apply some of the MUTATIONS to a copy of a dataset"""
+    dataset = copy.deepcopy(dataset)
+    for path, key, value in mutations:
+        parent = dataset
+        for elem in path:
+            parent = parent[elem]
+        if value is None:
+            del parent[key]
+        else:
+            parent[key] = value
+    return dataset
+
+
+def errors(validator, dataset) -> list:
+    """Attributes of the errors of a dataset"""
+    return [
+        (error.json_path, list(error.absolute_path), error.message, error.validator)
+        for error in validator.iter_errors(dataset)
+    ]
+
+
+@pytest.mark.parametrize("extensive", [False, True])
+def test_compiled_validator(structures, extensive):
+    """Test the compiled validator reports the same errors as jsonschema"""
+    schemafile = "schema_extensive.json" if extensive else "schema.json"
+    with open(schemafile, "rb") as f_in:
+        schema = orjson.loads(f_in.read())
+    expected = validator_for(schema)(schema)
+    validator = CompiledValidator(schema)
+    # The sites of the extensive structure miss some required containers
+    dataset = structures[extensive]
+    assert validator.is_valid(dataset) is not extensive
+    assert errors(validator, dataset) == errors(expected, dataset)
+    for ix in range(len(MUTATIONS)):
+        for mutations in (MUTATIONS[ix : ix + 1], MUTATIONS[: ix + 1]):
+            invalid = mutate(dataset, mutations)
+            assert errors(validator, invalid) == errors(expected, invalid)
+            assert validator.is_valid(invalid) == expected.is_valid(invalid)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_remove_invalid_elements(structures, caplog, workers):
+    """Test invalid plates and batches are dropped with their warnings"""
+    with open("schema.json", "rb") as f_in:
+        validator = CompiledValidator(orjson.loads(f_in.read()))
+    dataset = mutate(structures[0], MUTATIONS[1:3])
+    dataset["batches"].append(copy.deepcopy(dataset["batches"][0]))
+    dataset["batches"][1]["batch_id"] = "B2"
+    dataset["batches"][1]["plates"] = [dataset["batches"][1]["plates"][1]]
+    remove_invalid_elements(dataset, validator, workers)
+    assert [batch["batch_id"] for batch in dataset["batches"]] == ["B1"]
+    assert [plate["plate_id"] for plate in dataset["batches"][0]["plates"]] == [
+        "PLATE1"
+    ]
+    assert [record.getMessage() for record in caplog.records] == [
+        "Deleting invalid plate B1.PLATE2: "
+        "$.batches[0].plates[1].profiles.default.date 1 is not of type 'string'",
+        "Deleting invalid plate B1.PLATE2: "
+        "$.batches[0].plates[1].profiles.default.size "
+        "5 is less than the minimum of 10",
+        "Deleting invalid plate B2.PLATE2: "
+        "$.batches[1].plates[0].profiles.default.date 1 is not of type 'string'",
+        "Deleting invalid plate B2.PLATE2: "
+        "$.batches[1].plates[0].profiles.default.size "
+        "5 is less than the minimum of 10",
+        "Deleting invalid batch B2: $.batches[1].plates [] should be non-empty",
+    ]
+
+
+@pytest.mark.parametrize("mutations", [[], MUTATIONS[1:3], MUTATIONS[4:6]])
+def test_stream_dataset(tmp_path, structures, caplog, mutations):
+    """Test streaming removes the same plates and batches"""
+    with open("schema_extensive.json", "rb") as f_in:
+        schema = orjson.loads(f_in.read())
+    # Make the sites valid and write batch_id after the plates
+    del schema["$defs"]["site"]["properties"]["containers"]
+    validator = CompiledValidator(schema)
+    dataset = mutate(structures[1], mutations)
+    dataset["batches"].append(copy.deepcopy(dataset["batches"][0]))
+    dataset["batches"][1]["batch_id"] = "B2"
+    dataset["batches"][1]["batch_id"] = dataset["batches"][1].pop("batch_id")
+    jsonfile = tmp_path / "structure_extensive.json"
+    jsonfile.write_bytes(orjson.dumps(dataset))
+
+    remove_invalid_elements(dataset, validator)
+    expected = [record.getMessage() for record in caplog.records]
+    caplog.clear()
+    stream_dataset(jsonfile, tmp_path / "validated.json", validator)
+    assert (tmp_path / "validated.json").read_bytes() == orjson.dumps(dataset)
+    assert sorted(
+        record.getMessage()
+        for record in caplog.records
+        if record.getMessage().startswith("Deleting")
+    ) == sorted(expected)
+
+
+def test_unsupported_schema():
+    """Test schemas with other keywords are not compiled"""
+    with pytest.raises(ValueError):
+        CompiledValidator({"type": "string", "pattern": "^a"})
+    with pytest.raises(ValueError):
+        CompiledValidator({"$ref": "other.json"})
@@ -1,102 +1,318 @@
 """Prepare files to be uploaded in S3"""
 import re
 from functools import partial
-from tqdm.auto import tqdm
-from tqdm.contrib.concurrent import process_map
+import numpy as np
 import pandas as pd
 
-from loader import load_barcode, load_plate
+from loader import load_barcode, load_plate_columns, profile_size
+from jump.cache import cache_key
+from jump.executor import map_largest_first
 from jump.utils import get_logger, FEATURE_SET
 
 logger = get_logger(__name__, "INFO")
 
 
-def match_platemaps(batch: dict, remove_invalid=True):
-    """Match platemaps with plates in batch"""
+TXT_RGX = re.compile(r"\.txt$")
+
+
+def index_platemaps(platemaps: list) -> dict:
+    """
+    Map every suffix of the file names of the platemaps, with and without
+    their .txt extension, to the platemaps whose path ends with it
+    """
+    index = {}
+    for pmap in platemaps:
+        names = {
+            pmap["path"].rsplit("/", 1)[-1],
+            TXT_RGX.sub("", pmap["path"]).rsplit("/", 1)[-1],
+        }
+        suffixes = {name[start:] for name in names for start in range(len(name) + 1)}
+        for suffix in suffixes:
+            index.setdefault(suffix, []).append(pmap)
+    return index
+
+
+def find_platemaps(fname, platemaps: list, index: dict) -> list:
+    """Platemaps whose path, with or without the .txt extension, ends with
+    `fname`"""
+    if isinstance(fname, str) and "/" not in fname:
+        # The suffix is within the file name
+        return index.get(fname, [])
+    return [
+        pmap
+        for pmap in platemaps
+        if pmap["path"].endswith(fname) or TXT_RGX.sub("", pmap["path"]).endswith(fname)
+    ]
+
+
+def platemap_matches(batch: dict) -> list:
+    """
+    Match the plates of a batch with their platemap. Return, for every plate,
+    the index of its platemap in the batch and its platemap name, or None and
+    the warning of why it is invalid
+    """
     barcode = load_barcode(batch)
-    reg = re.compile(r"\.txt$")
-    invalid_plates = []
+    names = barcode["Plate_Map_Name"]
+    positions = barcode.groupby("Assay_Plate_Barcode", sort=False).indices
+    index = index_platemaps(batch["platemaps"])
+    pmap_ixs = {id(pmap): ix for ix, pmap in enumerate(batch["platemaps"])}
+    matches = []
     for plate in batch["plates"]:
         plate_id = plate["plate_id"]
 
-        fname = barcode.query(f'Assay_Plate_Barcode=="{plate_id}"').Plate_Map_Name
+        fname = names.iloc[positions.get(plate_id, [])]
         if len(fname) == 0:
-            logger.warning(f"platemap not found for plate {plate_id}: {fname}")
-            invalid_plates.append(plate)
+            matches.append((None, f"platemap not found for plate {plate_id}: {fname}"))
             continue
         if len(fname) > 1:
-            logger.warning(f"multiple platemaps for plate {plate_id}: {fname}")
-            invalid_plates.append(plate)
+            matches.append((None, f"multiple platemaps for plate {plate_id}: {fname}"))
             continue
 
         fname = fname.iloc[0]
-        pmaps = []
-        for pmap in batch["platemaps"]:
-            if pmap["path"].endswith(fname):
-                pmaps.append(pmap)
-            elif reg.sub("", pmap["path"]).endswith(fname):
-                pmaps.append(pmap)
+        pmaps = find_platemaps(fname, batch["platemaps"], index)
         if len(pmaps) == 0:
-            invalid_plates.append(plate)
-            logger.warning(f"Missing platemap file for {plate_id}: {fname} not found")
+            msg = f"Missing platemap file for {plate_id}: {fname} not found"
+            matches.append((None, msg))
             continue
         if len(pmaps) > 1:
-            invalid_plates.append(plate)
-            logger.warning(f"Multiple platemap files for {plate_id}: {pmaps}")
+            msg = f"Multiple platemap files for {plate_id}: {pmaps}"
+            matches.append((None, msg))
             continue
 
-        plate["platemap"] = pmaps[0]
-        plate["platemap_name"] = fname
+        matches.append((pmap_ixs[id(pmaps[0])], fname))
+    return matches
+
+
+def match_platemaps(batch: dict, remove_invalid=True, cache=None):
+    """Match platemaps with plates in batch. Matches are looked up in and
+    saved to `cache` if given"""
+    matches = None
+    if cache is not None and batch.get("barcode_platemap"):
+        key = cache_key(
+            "platemaps",
+            batch["barcode_platemap"],
+            batch["platemaps"],
+            [plate["plate_id"] for plate in batch["plates"]],
+        )
+        matches = cache.get(key)
+    if matches is None:
+        matches = platemap_matches(batch)
+        if cache is not None:
+            cache.put(key, matches)
+
+    invalid_plates = []
+    for plate, (pmap_ix, value) in zip(batch["plates"], matches):
+        if pmap_ix is None:
+            logger.warning(value)
+            invalid_plates.append(plate)
+            continue
+        plate["platemap"] = batch["platemaps"][pmap_ix]
+        plate["platemap_name"] = value
 
     if remove_invalid and invalid_plates:
         logger.warning(f"removing {len(invalid_plates)} invalid plates")
-        for plate in invalid_plates:
-            batch["plates"].remove(plate)
+        invalid = {id(plate) for plate in invalid_plates}
+        batch["plates"][:] = [
+            plate for plate in batch["plates"] if id(plate) not in invalid
+        ]
 
 
 COLUMN_SET = set(FEATURE_SET)
+FEATURE_INDEX = {feature: ix for ix, feature in enumerate(FEATURE_SET)}
+ALL_PRESENT = np.packbits(np.ones(len(FEATURE_SET), dtype=bool)).tobytes()
+
+
+class FeatureResult:
+    """Features of the profile of a plate: a bitset of the FEATURE_SET
+    columns it has, packed with np.packbits, and its additional columns"""
+
+    __slots__ = ("present", "additional")
+
+    def __init__(self, present: bytes, additional: list):
+        self.present = present
+        self.additional = additional
+
+    @classmethod
+    def from_columns(cls, columns) -> "FeatureResult":
+        """Result of a profile with these columns"""
+        present = np.zeros(len(FEATURE_SET), dtype=bool)
+        additional = []
+        for column in columns:
+            ix = FEATURE_INDEX.get(column)
+            if ix is None:
+                additional.append(column)
+            else:
+                present[ix] = True
+        return cls(np.packbits(present).tobytes(), additional)
+
+    def bits(self) -> np.ndarray:
+        """Boolean array of the FEATURE_SET columns the profile has"""
+        packed = np.frombuffer(self.present, dtype=np.uint8)
+        return np.unpackbits(packed, count=len(FEATURE_SET)).astype(bool)
+
+    def missing(self) -> list:
+        """FEATURE_SET columns the profile does not have"""
+        return [FEATURE_SET[ix] for ix in np.flatnonzero(~self.bits())]
+
+    def is_valid(self) -> bool:
+        """Whether the profile has every FEATURE_SET column"""
+        return self.present == ALL_PRESENT
+
+    def to_json(self) -> list:
+        """Serialize this result in a json list"""
+        return [self.present.hex(), self.additional]
+
+    @classmethod
+    def from_json(cls, value: list) -> "FeatureResult":
+        """Result serialized by `to_json`"""
+        return cls(bytes.fromhex(value[0]), value[1])
+
+    def __eq__(self, other):
+        if not isinstance(other, FeatureResult):
+            return NotImplemented
+        return (self.present, self.additional) == (other.present, other.additional)
+
+    def __repr__(self):
+        return (
+            f"FeatureResult(missing={len(self.missing())}, "
+            f"additional={self.additional!r})"
+        )
+
+
+class FeatureReport:
+    """
+    Feature results of the profiles of many plates, as a (plates x features)
+    matrix packed with np.packbits and the additional columns of every plate
+    """
+
+    def __init__(self):
+        self.batch_ids = []
+        self.plate_ids = []
+        self.additional = []
+        self.rows = []
+
+    def append(self, batch_id: str, plate_id: str, result: FeatureResult):
+        """Add the result of a plate"""
+        self.batch_ids.append(batch_id)
+        self.plate_ids.append(plate_id)
+        self.additional.append(result.additional)
+        self.rows.append(result.present)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Packed boolean matrix of the FEATURE_SET columns of every plate"""
+        packed = np.frombuffer(b"".join(self.rows), dtype=np.uint8)
+        return packed.reshape(len(self.rows), len(ALL_PRESENT))
+
+    def invalid_counts(self) -> pd.Series:
+        """Number of plates with missing features per batch"""
+        invalid = [row != ALL_PRESENT for row in self.rows]
+        plates = pd.DataFrame({"batch_id": self.batch_ids, "plate_id": self.plate_ids})
+        return plates[invalid].groupby("batch_id")["plate_id"].nunique()
+
+    def signatures(self) -> pd.DataFrame:
+        """Distinct sets of columns of the profiles, with the number of
+        features they miss and the plates that share them"""
+        groups = {}
+        for ix, (row, additional) in enumerate(zip(self.rows, self.additional)):
+            groups.setdefault((row, tuple(sorted(additional))), []).append(ix)
+        records = []
+        for (row, additional), ixs in groups.items():
+            missing = FeatureResult(row, list(additional)).missing()
+            records.append(
+                {
+                    "num_plates": len(ixs),
+                    "num_missing": len(missing),
+                    "missing": ";".join(missing),
+                    "additional": ";".join(additional),
+                    "plates": ";".join(
+                        f"{self.batch_ids[ix]}/{self.plate_ids[ix]}" for ix in ixs
+                    ),
+                }
+            )
+        columns = ["num_plates", "num_missing", "missing", "additional", "plates"]
+        return pd.DataFrame.from_records(records, columns=columns)
+
+    def long_form(self) -> pd.DataFrame:
+        """Status (valid, missing or additional) of every feature of every
+        plate, one row each"""
+        bits = np.unpackbits(self.matrix, axis=1, count=len(FEATURE_SET))
+        bits = bits.astype(bool)
+        features = np.array(FEATURE_SET, dtype=object)
+        frames = []
+        for ix, additional in enumerate(self.additional):
+            for status, names in (
+                ("valid", features[bits[ix]]),
+                ("missing", features[~bits[ix]]),
+                ("additional", additional),
+            ):
+                frame = pd.DataFrame({"feature": list(names)}, dtype=object)
+                frame["status"] = status
+                frame["plate_id"] = self.plate_ids[ix]
+                frame["batch_id"] = self.batch_ids[ix]
+                frames.append(frame)
+        columns = ["feature", "status", "plate_id", "batch_id"]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)[columns]
+
+
+def profile_features(plate: dict, profile_key: str) -> FeatureResult:
+    """Feature result of the profile of a plate. Only the header of the
+    profile is read"""
+    if profile_key not in plate["profiles"]:
+        return FeatureResult.from_columns([])
+    return FeatureResult.from_columns(load_plate_columns(plate, profile_key))
 
 
 def check_profile(plate: dict, profile_key: str):
     """Check profile has all the feature columns.  Returns plate and result of
     the validation.
     """
-    if profile_key in plate["profiles"]:
-        profile = load_plate(plate, profile_key)
-        columns = set(profile.columns)
-        missing = list(COLUMN_SET - columns)
-        valid = list(COLUMN_SET & columns)
-        additional = list(columns - COLUMN_SET)
-    else:
-        missing, valid, additional = FEATURE_SET, [], []
-
-    missing = pd.DataFrame({"feature": missing})
-    missing["status"] = "missing"
-    valid = pd.DataFrame({"feature": valid})
-    valid["status"] = "valid"
-    additional = pd.DataFrame({"feature": additional})
-    additional["status"] = "additional"
-    result = pd.concat([valid, missing, additional])
-    result["plate_id"] = plate["plate_id"]
-
-    return plate, result
-
-
-def remove_invalid_profiles(dataset: dict, profile_key: str):
+    return plate, profile_features(plate, profile_key)
+
+
+def profile_cache_key(plate: dict, profile_key: str) -> str:
+    """Cache key of the feature result of the profile of a plate"""
+    profile = plate["profiles"].get(profile_key)
+    return cache_key("profile", profile_key, profile, plate.get("platemap"))
+
+
+def remove_invalid_profiles(dataset: dict, profile_key: str, cache=None):
     """
-    Remove plates that are not valid in-place. Return a pd.DataFrame with
-    missing columns in the profiles.
+    Remove plates that are not valid in-place. Return a FeatureReport with
+    the features of the profiles. Only the plates whose profile or platemap
+    are not in `cache`, if given, are checked, all the batches at once.
     """
-    par_func = partial(check_profile, profile_key=profile_key)
-    removed = []
-    for batch in tqdm(dataset["batches"], desc=dataset["dataset_id"]):
-        output = process_map(par_func, batch["plates"], leave=False)
+    results = {}
+    keys = {}
+    todo = []
+    for batch in dataset["batches"]:
+        for plate in batch["plates"]:
+            if cache is not None:
+                keys[id(plate)] = key = profile_cache_key(plate, profile_key)
+                if (value := cache.get(key)) is not None:
+                    results[id(plate)] = FeatureResult.from_json(value)
+                    continue
+            todo.append(plate)
+    par_func = partial(profile_features, profile_key=profile_key)
+    sizes = [profile_size(plate, profile_key) for plate in todo]
+    output = map_largest_first(
+        par_func, todo, sizes=sizes, leave=False, desc=dataset["dataset_id"]
+    )
+    for plate, result in zip(todo, output):
+        results[id(plate)] = result
+        if cache is not None:
+            cache.put(keys[id(plate)], result.to_json())
+
+    report = FeatureReport()
+    for batch in dataset["batches"]:
         plates = []
-        for plate, result in output:
-            if "missing" not in result["status"].values:
+        for plate in batch["plates"]:
+            result = results[id(plate)]
+            if result.is_valid():
                 plates.append(plate)
-            result["batch_id"] = batch["batch_id"]
-            removed.append(result)
+            report.append(batch["batch_id"], plate["plate_id"], result)
 
         batch["plates"] = plates
-    return pd.concat(removed)
+    return report